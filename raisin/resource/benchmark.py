@@ -0,0 +1,535 @@
+"""Benchmark of all resources against a local stand-in for the databases
+
+The Grape tables of the projects are created in SQLite databases and filled
+with synthetic data at a configurable scale of projects, replicates, lanes
+and reads. Every entry of the STATS_REGISTRY is then requested in every
+content type, and the timings are written as JSON, so that they can be
+compared between releases:
+
+    python -m raisin.resource.benchmark --replicates 4 --output bench.json
+
+SQLite is not MySQL, so the numbers are only comparable between runs of the
+benchmark, not with the numbers of a production server. The queries are
+translated where the dialects differ, see StandInDatabase.
+"""
+
+import re
+import sys
+import time
+import random
+import sqlite3
+import threading
+import optparse
+import platform
+
+try:
+    import simplejson as json
+except ImportError:
+    import json  # NOQA
+
+from restish import http
+import root
+from root import STATS_REGISTRY
+from root import STREAMED_SEPARATORS
+from root import COLUMNAR_CONTENT_TYPE
+from root import DATATABLE_CONTENT_TYPES
+from pool import Result
+from cache import get_response_cache
+from utils import invalidate_configurations
+from utils import refresh_dashboard_cache
+from warmup import get_routes
+from queries import table_name
+from instrumentation import get_statistics
+from instrumentation import reset_statistics
+
+# All content types the resources can be requested in
+ACCEPT_TYPES = (['text/javascript', COLUMNAR_CONTENT_TYPE] +
+                sorted(STREAMED_SEPARATORS.keys()) +
+                list(DATATABLE_CONTENT_TYPES))
+
+# The parameters defining the experiments, as configured for the web server
+PARAMETER_LABELS = {'read_length': ('Read Length', 'number'),
+                    'cell': ('Cell Type', 'string'),
+                    'rnaExtract': ('RNA Type', 'string'),
+                    'localization': ('Localization', 'string'),
+                    }
+PARAMETER_COLUMNS = {'read_length': 'read_length',
+                     'cell': 'CellType',
+                     'rnaExtract': 'RNAType',
+                     'localization': 'Compartment',
+                     }
+PARAMETER_LIST = ['read_length', 'cell', 'rnaExtract', 'localization']
+
+# The experiments the replicates are assigned to in turn
+EXPERIMENTS = [(76, 'K562', 'LONGPOLYA', 'CELL'),
+               (76, 'GM12878', 'LONGPOLYA', 'NUCLEUS'),
+               ]
+
+# The number of positions along the reads
+READ_LENGTH = 76
+
+# Identifiers starting with a digit have to be quoted in SQLite
+_DIGIT_IDENTIFIER = re.compile(r'(?<![\w`"\'.])(\d+[A-Za-z_]\w*)')
+
+# The placeholders and escaped percent signs of MySQLdb
+_MYSQLDB_FORMAT = re.compile(r'%([s%])')
+
+# The tables of each replicate in the RNAseqPipeline database
+REPLICATE_TABLES = {
+    'dataset': ['pair_id', 'lane_id'],
+    'read_stats': ['LaneName', 'TotalReads', 'NoAmbiguousBases',
+                   'AmbiguousBases', 'UniqueReads'],
+    'merged_mapping': ['LaneName', 'totalReads', 'uniqueReads',
+                       'mappedReads', '"100uniqueReads"'],
+    'genome_mapping': ['LaneName', 'totalReads', 'mappedReads',
+                       'uniqueReads', '"100uniqueReads"'],
+    'junctions_mapping': ['LaneName', 'totalReads', 'mappedReads',
+                          'uniqueReads', '"100uniqueReads"'],
+    'split_mapping': ['LaneName', 'totalReads', 'mappedReads',
+                      'uniqueReads', '"100uniqueReads"'],
+    'qualitiespos': ['LaneName', 'position', 'mean'],
+    'ambiguous': ['LaneName', 'position', 'ambiguous'],
+    'read_dist_transcripts': ['LaneName', 'start', 'position', 'hits'],
+    'gene_RPKM': ['LaneName', 'gene_id', 'RPKM'],
+    'gene_RPKM_dist': ['LaneName', 'rpkm', 'support'],
+    'inclusion_dist': ['LaneName', 'incl_percent', 'support'],
+    'expression_summary': ['type', 'total', 'detected'],
+    'detected_genes': ['type', 'reliability', 'detected'],
+    'splicing_summary': ['junc_type', 'detected', 'total'],
+    'exon_inclusion_reads': ['chr', 'start', 'end', 'ExIncl', 'JuncInc',
+                             'JuncExc', 'inc_rate', 'sample_id'],
+    'novel_junctions_summary': ['chr', 'start', 'end', 'support', 'sample'],
+    'split_mapping_breakdown': ['start_chr', 'end_chr', 'start', 'end',
+                                'number', 'filename', 'type'],
+    'top_genes_expressed': ['gene_id', 'length', 'strand', 'locus',
+                            'no_exons', 'no_transcripts'],
+    'top_transcripts_expressed': ['transcript_id', 'length', 'strand',
+                                  'locus', 'no_exons'],
+    'top_exons_expressed': ['exon_id', 'length', 'strand', 'locus'],
+}
+
+# The tables in the RNAseqPipelineCommon database
+COMMON_TABLES = {
+    'projects': ['project_id', 'proj_description', 'species'],
+    'experiments': ['experiment_id', 'project_id', 'species_id', 'genome_id',
+                    'annotation_id', 'template_file', 'read_length integer',
+                    'mismatches', 'exp_description', 'expDate date',
+                    'CellType', 'RNAType', 'Compartment',
+                    'Bioreplicate integer', 'partition',
+                    'annotation_version', 'lab', 'paired'],
+    'species_info': ['species_id', 'species', 'genus', 'sp_alias',
+                     'abbreviation'],
+    'genome_files': ['genome_id', 'species_id', 'genome', 'location',
+                     'assembly', 'source', 'gender'],
+    'annotation_files': ['annotation_id', 'species_id', 'annotation',
+                         'location', 'version', 'source'],
+}
+
+# The tables in the RNA dashboard database
+DASHBOARD_TABLES = {
+    'technology': ['name', 'displayName', 'description', 'descriptionUrl'],
+    'rnaExtract': ['ucscName', 'displayName', 'description'],
+    'localization': ['ucscName', 'displayName', 'description'],
+    'cell': ['ucscName', 'displayName', 'description', 'tier', 'sex'],
+    'sample': ['id', 'grantName', 'cell', 'localization', 'rnaExtract',
+               'replicate', 'internalName'],
+    'experiment': ['id', 'lab', 'readType', 'insertLength', 'techReplicate',
+                   'sampleName', 'technology'],
+    'fileType': ['name', 'rawType'],
+    'fileView': ['name', 'displayName', 'deNovo'],
+    'file': ['url', 'allAttributes', 'atUcsc', 'fileType', 'fileView', 'lab',
+             'size', 'dateSubmitted date', 'experiment_data_processing'],
+}
+
+
+class StandInDatabase(object):
+    """A SQLite database answering the queries written for MySQL.
+
+    The queries are translated before they are run:
+
+    - the %s placeholders of MySQLdb are replaced by ?, and %% by %
+    - identifiers starting with a digit, like 100uniqueReads, are quoted
+    - information_schema.tables exists, but has no update times, so the
+      resources are served without a Last-Modified date
+
+    The rows are fetched while holding a lock, so the database can be used by
+    the threads of the executor.
+    """
+
+    def __init__(self, path=':memory:'):
+        # Columns declared as date are returned as dates, like by MySQLdb,
+        # and statements are committed right away, like by MyISAM tables
+        self.connection = sqlite3.connect(path,
+                                          check_same_thread=False,
+                                          detect_types=sqlite3.PARSE_DECLTYPES,
+                                          isolation_level=None)
+        # MySQLdb returns strings, not unicode
+        self.connection.text_factory = str
+        self.connection.create_function('database', 0, lambda: 'main')
+        self.connection.execute("attach ':memory:' as information_schema")
+        self.connection.execute("""
+create table information_schema.tables (table_schema,
+                                        table_name,
+                                        update_time)""")
+        self._lock = threading.Lock()
+
+    def query(self, sql, args=None):
+        """Run the query and return its rows like a buffered cursor"""
+        if args is None:
+            args = ()
+        else:
+            sql = _MYSQLDB_FORMAT.sub(lambda m: m.group(1) == 's' and '?' or
+                                      '%', sql)
+        sql = _DIGIT_IDENTIFIER.sub(r'"\1"', sql)
+        self._lock.acquire()
+        try:
+            cursor = self.connection.execute(sql, tuple(args))
+            rows = cursor.fetchall()
+            return Result(rows, cursor.description, len(rows))
+        finally:
+            self._lock.release()
+
+    def create(self, table, columns, rows):
+        """Create a table with the columns and insert the rows"""
+        self.connection.execute('create table %s (%s)' %
+                                (table, ', '.join(columns)))
+        sql = 'insert into %s values (%s)' % (table,
+                                              ', '.join('?' * len(columns)))
+        self.connection.executemany(sql, rows)
+        self.connection.commit()
+
+
+def _replicate_rows(rng, lanes, reads, genes):
+    """Return the rows of the replicate tables of one replicate"""
+    laneids = ['L%s' % lane for lane in range(1, lanes + 1)]
+    readids = [(laneid, '%s.%s' % (laneid, read))
+               for laneid in laneids
+               for read in range(1, reads + 1)]
+    rows = dict((suffix, []) for suffix in REPLICATE_TABLES)
+    for laneid, readid in readids:
+        total = rng.randint(10 ** 6, 10 ** 7)
+        unique = total - rng.randint(0, total / 4)
+        ambiguous = rng.randint(0, total / 10)
+        mapped = unique - rng.randint(0, unique / 4)
+        rows['dataset'].append((laneid, readid))
+        rows['read_stats'].append((readid, total, total - ambiguous,
+                                   ambiguous, unique))
+        rows['merged_mapping'].append((readid, total, unique, mapped,
+                                       mapped / 2))
+        for suffix in ('genome_mapping', 'junctions_mapping',
+                       'split_mapping'):
+            mapped = rng.randint(0, total)
+            rows[suffix].append((readid, total, mapped, mapped / 2,
+                                 mapped / 3))
+        for position in range(1, READ_LENGTH + 1):
+            rows['qualitiespos'].append((readid, position,
+                                         rng.uniform(20, 40)))
+            rows['ambiguous'].append((readid, position,
+                                      rng.uniform(0, 0.1)))
+    for laneid in laneids:
+        for start in (0, 1000, 5000):
+            for position in range(100):
+                rows['read_dist_transcripts'].append(
+                    (laneid, start, position, rng.randint(0, 1000)))
+        for gene in range(genes):
+            rows['gene_RPKM'].append((laneid, 'ENSG%011d' % gene,
+                                      rng.expovariate(0.01)))
+        for rpkm in range(50):
+            rows['gene_RPKM_dist'].append((laneid, rpkm,
+                                           rng.randint(0, genes)))
+        for percent in range(101):
+            rows['inclusion_dist'].append((laneid, percent,
+                                           rng.randint(0, genes)))
+    for feature_type in ('Genes', 'Transcripts', 'Exons'):
+        total = genes * rng.randint(1, 10)
+        rows['expression_summary'].append((feature_type, total,
+                                           rng.randint(0, total)))
+    for biotype in ('protein_coding', 'lincRNA', 'miRNA'):
+        for reliability in ('KNOWN', 'NOVEL'):
+            rows['detected_genes'].append((biotype, reliability,
+                                           rng.randint(0, genes)))
+    for junc_type in ('Known', 'Novel', 'Unannotated'):
+        total = genes * rng.randint(1, 10)
+        rows['splicing_summary'].append((junc_type, rng.randint(0, total),
+                                         total))
+    for gene in range(genes):
+        chromosome = 'chr%s' % rng.randint(1, 22)
+        start = rng.randint(1, 10 ** 8)
+        end = start + rng.randint(100, 10 ** 5)
+        locus = '%s:%s-%s' % (chromosome, start, end)
+        strand = rng.choice('+-')
+        rows['exon_inclusion_reads'].append(
+            (chromosome, start, end, rng.randint(0, 100),
+             rng.randint(0, 100), rng.randint(0, 100), rng.random(),
+             'sample'))
+        rows['novel_junctions_summary'].append(
+            (chromosome, start, end, rng.randint(0, 1000), 'sample'))
+        rows['split_mapping_breakdown'].append(
+            (chromosome, chromosome, start, end, rng.randint(0, 1000),
+             'file', rng.choice(['close', 'far', 'chromosome'])))
+        values = [rng.expovariate(0.01) for _ in laneids]
+        rows['top_genes_expressed'].append(
+            tuple(['ENSG%011d' % gene, end - start, strand, locus,
+                   rng.randint(1, 20), rng.randint(1, 5)] + values))
+        rows['top_transcripts_expressed'].append(
+            tuple(['ENST%011d' % gene, end - start, strand, locus,
+                   rng.randint(1, 20)] + values))
+        rows['top_exons_expressed'].append(
+            tuple(['ENSE%011d' % gene, end - start, strand, locus] +
+                  values))
+    return laneids, rows
+
+
+def create_databases(projects=1, replicates=2, lanes=2, reads=2,
+                     genes=1000, seed=0):
+    """Return the databases of the projects filled with synthetic data.
+
+    The result is used as request.environ['dbs']. Every project has its own
+    RNAseqPipeline and RNAseqPipelineCommon database, and the first project
+    also has the RNA dashboard database.
+    """
+    rng = random.Random(seed)
+    dbs = {}
+    dashboard = _create_dashboard(rng)
+    for project in range(1, projects + 1):
+        projectid = 'P%s' % project
+        pipeline = StandInDatabase()
+        common = StandInDatabase()
+        experiments = []
+        for replicate in range(1, replicates + 1):
+            replicateid = 'R%s' % replicate
+            laneids, rows = _replicate_rows(rng, lanes, reads, genes)
+            for suffix, columns in REPLICATE_TABLES.items():
+                if suffix.startswith('top_'):
+                    columns = columns + ['`%s`' % laneid for laneid in laneids]
+                pipeline.create(table_name(projectid, replicateid, suffix),
+                                columns,
+                                rows[suffix])
+            read_length, cell, rna_extract, localization = \
+                EXPERIMENTS[(replicate - 1) % len(EXPERIMENTS)]
+            experiments.append((replicateid, projectid, 1, 1, 1, 'template',
+                                read_length, 2, 'Replicate %s' % replicate,
+                                '2012-01-01', cell, rna_extract,
+                                localization, replicate, None, 'v1', 'LAB',
+                                '\x01'))
+        common.create('projects',
+                      COMMON_TABLES['projects'],
+                      [(projectid, 'Project %s' % project, 'Homo sapiens')])
+        common.create('experiments', COMMON_TABLES['experiments'],
+                      experiments)
+        common.create('species_info', COMMON_TABLES['species_info'],
+                      [(1, 'Homo sapiens', 'Homo', 'human', 'hs')])
+        common.create('genome_files', COMMON_TABLES['genome_files'],
+                      [(1, 1, 'H.sapiens', '/genomes/hg19', 'hg19', 'UCSC',
+                        'female')])
+        common.create('annotation_files', COMMON_TABLES['annotation_files'],
+                      [(1, 1, 'gencode', '/annotations/gencode', 'v7',
+                        'GENCODE')])
+        dbs[projectid] = {'RNAseqPipeline': pipeline,
+                          'RNAseqPipelineCommon': common,
+                          'downloads': None,
+                          }
+    dbs['P1']['hg19_RNA_dashboard'] = dashboard
+    return dbs
+
+
+def _create_dashboard(rng):
+    """Return the RNA dashboard database with a few samples"""
+    dashboard = StandInDatabase()
+    rows = {'technology': [('RNASEQ', 'RNA-Seq', 'Sequencing', 'http://')],
+            'rnaExtract': [('LONGPOLYA', 'PolyA+', 'Long PolyA+')],
+            'localization': [('CELL', 'Whole Cell', 'Cell'),
+                             ('NUCLEUS', 'Nucleus', 'Nucleus')],
+            'cell': [('K562', 'K562', 'Leukemia', 1, 'F'),
+                     ('GM12878', 'GM12878', 'Lymphoblastoid', 1, 'F')],
+            'fileType': [('FASTQ', 1)],
+            'fileView': [('RawData', 'Raw Data', 0)],
+            'sample': [],
+            'experiment': [],
+            'file': [],
+            }
+    for index, (_, cell, rna_extract, localization) in enumerate(EXPERIMENTS):
+        sample = 'S%s' % index
+        experiment = 'E%s' % index
+        rows['sample'].append((sample, 'grant', cell, localization,
+                               rna_extract, 1, 'internal'))
+        rows['experiment'].append((experiment, 'LAB', '2x76', '200', 1,
+                                   sample, 'RNASEQ'))
+        rows['file'].append(('http://files/%s.fastq.gz' % sample,
+                             'cell=%s; localization=%s' % (cell,
+                                                           localization),
+                             1, 'FASTQ', 'RawData', 'LAB',
+                             rng.randint(1, 10 ** 9), '2012-01-01',
+                             experiment))
+    for table, columns in DASHBOARD_TABLES.items():
+        dashboard.create(table, columns, rows[table])
+    return dashboard
+
+
+def get_environ(dbs):
+    """Return the WSGI environ entries set up by the web server"""
+    return {'dbs': dbs,
+            'parameter_labels': PARAMETER_LABELS,
+            'parameter_columns': PARAMETER_COLUMNS,
+            'parameter_mapping': dict((projectid, PARAMETER_LIST)
+                                      for projectid in dbs),
+            }
+
+
+def get_targets(values):
+    """Return the URL parameters for requesting each registry key.
+
+    Keys that can't be requested with any parameters are returned with None.
+    """
+    targets = {}
+    for key, names in get_routes().items():
+        if names is None:
+            targets[key] = None
+        else:
+            targets[key] = dict((name, values[name]) for name in names)
+    return targets
+
+
+def clear_caches():
+    """Forget everything the resources have cached"""
+    get_response_cache().invalidate()
+    invalidate_configurations()
+    refresh_dashboard_cache()
+
+
+def time_request(environ, key, kwargs, accept, repeat=3, cold=True):
+    """Request the resource repeatedly and return its timings.
+
+    Errors raised by the resource are reported with the status 500.
+    """
+    result = {'key': key,
+              'level': STATS_REGISTRY[key][1],
+              'accept': accept,
+              }
+    timings = []
+    for _ in range(repeat):
+        if cold:
+            clear_caches()
+        reset_statistics()
+        request = http.Request.blank('/')
+        request.environ.update(environ)
+        request.headers['Accept'] = accept
+        started = time.time()
+        try:
+            response = root.Resource(key, **kwargs)(request)
+            # Streamed bodies are only written while reading them
+            body = ''.join(response.app_iter)
+        except Exception, err:  # pylint: disable-msg=W0703
+            result['status'] = 500
+            result['error'] = '%s: %s' % (err.__class__.__name__, err)
+            return result
+        timings.append(time.time() - started)
+    timings.sort()
+    totals = get_statistics().get(key, {})
+    result.update({'status': response.status_int,
+                   'seconds': {'min': timings[0],
+                               'median': timings[len(timings) // 2],
+                               'max': timings[-1],
+                               },
+                   'queries': totals.get('queries', 0),
+                   'rows': totals.get('rows', 0),
+                   'bytes': len(body),
+                   })
+    return result
+
+
+def run_benchmark(projects=1, replicates=2, lanes=2, reads=2, genes=1000,
+                  repeat=3, cold=True, accept_types=None, keys=None,
+                  seed=0):
+    """Run the benchmark and return the report as a dictionary"""
+    if accept_types is None:
+        accept_types = ACCEPT_TYPES
+    started = time.time()
+    dbs = create_databases(projects, replicates, lanes, reads, genes, seed)
+    environ = get_environ(dbs)
+    parameter_values = '-'.join([str(value) for value in EXPERIMENTS[0]])
+    targets = get_targets({'projectid': 'P1',
+                           'parameter_list': '-'.join(PARAMETER_LIST),
+                           'parameter_values': parameter_values,
+                           'replicateid': 'R1',
+                           'laneid': 'L1',
+                           'hgversion': 'hg19',
+                           })
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version,
+              'scale': {'projects': projects,
+                        'replicates': replicates,
+                        'lanes': lanes,
+                        'reads': reads,
+                        'genes': genes,
+                        },
+              'repeat': repeat,
+              'cold': cold,
+              'setup_seconds': time.time() - started,
+              'results': [],
+              'skipped': [],
+              }
+    for key in sorted(targets):
+        if not keys is None and not key in keys:
+            continue
+        if targets[key] is None:
+            report['skipped'].append(key)
+            continue
+        for accept in accept_types:
+            report['results'].append(time_request(environ,
+                                                  key,
+                                                  targets[key],
+                                                  accept,
+                                                  repeat,
+                                                  cold))
+    report['seconds'] = time.time() - started
+    return report
+
+
+def main(argv=None):
+    """Run the benchmark from the command line"""
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--projects', type='int', default=1)
+    parser.add_option('--replicates', type='int', default=2,
+                      help="replicates per project")
+    parser.add_option('--lanes', type='int', default=2,
+                      help="lanes per replicate")
+    parser.add_option('--reads', type='int', default=2,
+                      help="reads per lane")
+    parser.add_option('--genes', type='int', default=1000,
+                      help="genes, junctions and exons per replicate")
+    parser.add_option('--repeat', type='int', default=3,
+                      help="requests per resource and content type")
+    parser.add_option('--warm', action='store_true', default=False,
+                      help="keep the caches between the requests")
+    parser.add_option('--accept', action='append', dest='accept_types',
+                      help="content type to request, may be repeated")
+    parser.add_option('--key', action='append', dest='keys',
+                      help="registry key to request, may be repeated")
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--output', default=None,
+                      help="file to write the JSON report to")
+    options, _ = parser.parse_args(argv)
+    report = run_benchmark(projects=options.projects,
+                           replicates=options.replicates,
+                           lanes=options.lanes,
+                           reads=options.reads,
+                           genes=options.genes,
+                           repeat=options.repeat,
+                           cold=not options.warm,
+                           accept_types=options.accept_types,
+                           keys=options.keys,
+                           seed=options.seed)
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+    else:
+        output = open(options.output, 'w')
+        try:
+            json.dump(report, output, indent=1, sort_keys=True)
+        finally:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
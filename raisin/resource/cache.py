@@ -0,0 +1,450 @@
+"""Caches used for avoiding repeated queries to the databases"""
+
+import os
+import re
+import sys
+import time
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Groups of cache entries whose names can be used in file names as they are
+GROUP_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+
+
+class TTLCache(object):
+    """A thread safe cache with a bounded size and expiring entries.
+
+    maxsize: The maximum number of entries kept. The least recently used
+             entries are evicted first.
+
+    ttl:     The number of seconds after which an entry expires.
+    """
+
+    def __init__(self, maxsize=128, ttl=300, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """Return the value for the key, or the default if it is missing"""
+        self._lock.acquire()
+        try:
+            if not key in self._entries:
+                return default
+            expires, value = self._entries.pop(key)
+            if expires < self.timer():
+                return default
+            # Reinsert to mark the entry as the most recently used one
+            self._entries[key] = (expires, value)
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        """Store the value for the key"""
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                del self._entries[key]
+            self._entries[key] = (self.timer() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, predicate=None):
+        """Remove all entries, or only those whose key match the predicate"""
+        self._lock.acquire()
+        try:
+            if predicate is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if predicate(k)]:
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MemoryBackend(object):
+    """Keep the entries in memory, bounded by the total size of the entries.
+
+    maxbytes: The maximum number of bytes kept. The least recently used
+              entries are evicted first.
+
+    The entries can be stored in a group, like the project they belong to,
+    so that all entries of the group can be removed at once.
+    """
+
+    def __init__(self, maxbytes=64 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def get(self, key, group=None):
+        """Return the entry stored for the key, or None"""
+        self._lock.acquire()
+        try:
+            if not key in self._entries:
+                return None
+            stored = self._entries.pop(key)
+            self._entries[key] = stored
+            return stored[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, entry, size, group=None):
+        """Store the entry of the given size for the key"""
+        if size > self.maxbytes:
+            return
+        self._lock.acquire()
+        try:
+            self.delete(key)
+            self._entries[key] = (entry, size, group)
+            self._size = self._size + size
+            while self._size > self.maxbytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._size = self._size - evicted
+        finally:
+            self._lock.release()
+
+    def delete(self, key, group=None):
+        """Remove the entry of the key if there is one"""
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                _, size, _ = self._entries.pop(key)
+                self._size = self._size - size
+        finally:
+            self._lock.release()
+
+    def invalidate(self, group=None):
+        """Remove the entries of a group, or all entries"""
+        self._lock.acquire()
+        try:
+            for key, (_, _, entry_group) in self._entries.items():
+                if group is None or entry_group == group:
+                    self.delete(key)
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        """Return the keys of all entries"""
+        return list(self._entries.keys())
+
+
+class DiskBackend(object):
+    """Keep the entries as files in a directory, bounded by their total size.
+
+    directory: The directory used for storing the files. It is created if
+               it does not exist yet.
+
+    maxbytes:  The maximum number of bytes kept on disk. The files that have
+               not been used for the longest time are removed first.
+
+    The size of the files is counted as they are written, and the directory
+    is only listed once it is larger than maxbytes. The files are then
+    removed until a tenth of maxbytes is free, so that this is not done
+    again for the next file. Files written by other processes sharing the
+    directory are counted the next time the directory is listed.
+
+    The group of an entry, like its project, is put into the file name, so
+    that the files of a group can be removed without reading them.
+    """
+
+    def __init__(self, directory, maxbytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # The total size of the files, None until the directory is listed
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _prefix(self, group):
+        """Return the start of the names of the files of a group"""
+        if group is None:
+            return '-'
+        group = str(group)
+        if GROUP_NAME.match(group) is None:
+            group = hashlib.sha1(group).hexdigest()
+        return group + '-'
+
+    def _path(self, key, group=None):
+        """Return the path of the file used for the key"""
+        name = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory,
+                            self._prefix(group) + name + '.cache')
+
+    def _load(self, path):
+        """Return the key and entry stored in the file, or None"""
+        try:
+            cache_file = open(path, 'rb')
+            try:
+                return pickle.load(cache_file)
+            finally:
+                cache_file.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _add_size(self, size):
+        """Count bytes written to, or removed from, the directory"""
+        self._lock.acquire()
+        try:
+            if not self._size is None:
+                self._size = self._size + size
+            return self._size
+        finally:
+            self._lock.release()
+
+    def _remove(self, path):
+        """Remove a file and stop counting its size"""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self._add_size(-size)
+
+    def get(self, key, group=None):
+        """Return the entry stored for the key, or None"""
+        path = self._path(key, group)
+        stored = self._load(path)
+        if stored is None or stored[0] != key:
+            return None
+        try:
+            # Mark the file as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return stored[1]
+
+    def set(self, key, entry, size, group=None):
+        """Store the entry for the key"""
+        if size > self.maxbytes:
+            return
+        path = self._path(key, group)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        handle, temporary = tempfile.mkstemp(dir=self.directory)
+        cache_file = os.fdopen(handle, 'wb')
+        try:
+            pickle.dump((key, entry), cache_file, pickle.HIGHEST_PROTOCOL)
+            written = cache_file.tell()
+        finally:
+            cache_file.close()
+        os.rename(temporary, path)
+        total = self._add_size(written - replaced)
+        if total is None or total > self.maxbytes:
+            self._evict()
+
+    def delete(self, key, group=None):
+        """Remove the entry of the key if there is one"""
+        self._remove(self._path(key, group))
+
+    def invalidate(self, group=None):
+        """Remove the entries of a group, or all entries"""
+        prefix = ''
+        if not group is None:
+            prefix = self._prefix(group)
+        for name in self._names():
+            if name.startswith(prefix):
+                self._remove(os.path.join(self.directory, name))
+
+    def keys(self):
+        """Return the keys of all entries"""
+        keys = []
+        for name in self._names():
+            stored = self._load(os.path.join(self.directory, name))
+            if not stored is None:
+                keys.append(stored[0])
+        return keys
+
+    def _names(self):
+        """Return the names of all cache files"""
+        return [name for name in os.listdir(self.directory)
+                if name.endswith('.cache')]
+
+    def _evict(self):
+        """List the files and remove the least recently used files until a
+        tenth of maxbytes is free"""
+        files = []
+        total = 0
+        for name in self._names():
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total = total + stat.st_size
+        if total > self.maxbytes:
+            files.sort()
+            for _, size, path in files:
+                if total <= self.maxbytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total = total - size
+        self._lock.acquire()
+        try:
+            self._size = total
+        finally:
+            self._lock.release()
+
+
+class ResponseCache(object):
+    """Cache the serialized responses of the resources.
+
+    The entries are dictionaries holding at least the content type and the
+    body of the response. They are kept in the backend for ttl seconds.
+    """
+
+    def __init__(self, backend=None, ttl=3600, timer=time.time):
+        if backend is None:
+            backend = MemoryBackend()
+        self.backend = backend
+        self.ttl = ttl
+        self.timer = timer
+
+    def get(self, key):
+        """Return the response stored for the key, or None"""
+        projectid = get_response_projectid(key)
+        stored = self.backend.get(key, projectid)
+        if stored is None:
+            return None
+        expires, response = stored
+        if expires < self.timer():
+            self.backend.delete(key, projectid)
+            return None
+        return response
+
+    def set(self, key, response):
+        """Store the response for the key"""
+        stored = (self.timer() + self.ttl, response)
+        self.backend.set(key, stored, len(response['body']),
+                         get_response_projectid(key))
+
+    def invalidate(self, projectid=None):
+        """Forget the responses of one project, or all responses"""
+        self.backend.invalidate(projectid)
+
+
+class SingleFlight(object):
+    """Run a function only once for concurrent calls with the same key.
+
+    The first call for a key runs the function. Calls with the same key
+    made while it is running wait for it and return the same result, or
+    raise the same error. If the first call has not finished after timeout
+    seconds, the waiting calls run the function themselves.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """Return the result of the function, and whether it was returned by
+        the call of another thread"""
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key, None)
+            first = call is None
+            if first:
+                call = {'done': threading.Event(),
+                        'result': None,
+                        'error': None,
+                        }
+                self._calls[key] = call
+        finally:
+            self._lock.release()
+        if not first:
+            call['done'].wait(self.timeout)
+            if not call['done'].isSet():
+                return function(), False
+            if not call['error'] is None:
+                exc_type, exc_value, exc_traceback = call['error']
+                raise exc_type, exc_value, exc_traceback
+            return call['result'], True
+        try:
+            call['result'] = function()
+        except:
+            call['error'] = sys.exc_info()
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call['done'].set()
+        return call['result'], False
+
+
+def get_response_cache_key(registry_key, kwargs, accept_header):
+    """Return the key of a response in the response cache"""
+    return (registry_key, tuple(sorted(kwargs.items())), accept_header)
+
+
+RESPONSE_CACHE = ResponseCache()
+
+# The response caches kept on disk, by directory, ttl and size
+DISK_RESPONSE_CACHES = {}
+DISK_RESPONSE_CACHES_LOCK = threading.Lock()
+
+# The responses being rendered, so identical requests arriving at the same
+# time wait for the first one instead of querying the databases again
+RESPONSES_IN_FLIGHT = SingleFlight()
+
+
+def get_response_projectid(key):
+    """Return the project of a key of the response cache, or None"""
+    return dict(key[1]).get('projectid', None)
+
+
+def get_response_cache(environ=None):
+    """Return the cache used for the responses of the resources.
+
+    If the web server sets response_cache_dir in the WSGI environ, the
+    responses are kept in that directory, where other processes, like
+    raisin-resource-warmup, store them as well. The number of seconds they
+    are kept and the size of the directory can be set with
+    response_cache_ttl and response_cache_maxbytes.
+
+    Otherwise the cache set with set_response_cache is used, which is kept
+    in memory by default.
+    """
+    if environ is None or not environ.get('response_cache_dir', None):
+        return RESPONSE_CACHE
+    key = (os.path.abspath(environ['response_cache_dir']),
+           int(environ.get('response_cache_ttl', 3600)),
+           int(environ.get('response_cache_maxbytes', 1024 * 1024 * 1024)))
+    DISK_RESPONSE_CACHES_LOCK.acquire()
+    try:
+        if not key in DISK_RESPONSE_CACHES:
+            directory, ttl, maxbytes = key
+            DISK_RESPONSE_CACHES[key] = ResponseCache(DiskBackend(directory,
+                                                                  maxbytes),
+                                                      ttl=ttl)
+        return DISK_RESPONSE_CACHES[key]
+    finally:
+        DISK_RESPONSE_CACHES_LOCK.release()
+
+
+def set_response_cache(response_cache):
+    """Replace the cache used for the responses of the resources"""
+    global RESPONSE_CACHE  # pylint: disable-msg=W0603
+    RESPONSE_CACHE = response_cache
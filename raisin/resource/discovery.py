@@ -1,7 +1,9 @@
 """Summary statistics for discovery of novel junctions"""
 
 from utils import register_resource
-from utils import collect
+from utils import top_rows
+from queries import fetch_all
+from queries import replicate_table
 
 
 @register_resource(resolution="replicate", partition=False)
@@ -21,15 +23,15 @@ def novel_junctions_from_annotated_exons(dbs, confs):
         """Insert replicateid"""
         return (row[: -1] + (conf['replicateid'], row[-1]))
 
-    stats = collect(dbs,
-                    confs['configurations'],
-                    _top_novel_junctions_from_annotated_exons,
-                    strategy)
+    stats = top_rows(dbs,
+                     confs['configurations'],
+                     _top_novel_junctions_from_annotated_exons,
+                     strategy,
+                     lambda row: row[3],
+                     select=_top_novel_junctions_from_annotated_exons_select)
 
     if stats:
-        stats = sorted(stats, key=lambda row: row[3])
-        stats.reverse()
-        chart['table_data'] = stats[:20]
+        chart['table_data'] = stats
     else:
         chart['table_data'] = [[None] * len(chart['table_description'])]
     return chart
@@ -44,10 +46,8 @@ select chr,
        support,
        sample
 from
-    %(projectid)s_%(replicateid)s_novel_junctions_summary;""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    %s;""" % replicate_table(conf, 'novel_junctions_summary')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
 
 
@@ -61,17 +61,29 @@ select chr,
        support,
        sample
 from
-    %(projectid)s_%(replicateid)s_novel_junctions_summary
+    %s
 order by
     support desc
 ) x
-limit 20;""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+limit 20;""" % replicate_table(conf, 'novel_junctions_summary')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
 
 
+def _top_novel_junctions_from_annotated_exons_select(conf):
+    """Return the select statement for the top junctions of a replicate"""
+    sql = """
+select chr,
+       start,
+       end,
+       support as top_value,
+       %%s,
+       sample
+from
+    %s""" % replicate_table(conf, 'novel_junctions_summary')
+    return sql, (conf['replicateid'], )
+
+
 @register_resource(resolution="replicate", partition=False)
 def novel_junctions_from_unannotated_exons(dbs, confs):
     """List novel junctions from unannotated exons."""
@@ -90,15 +102,15 @@ def novel_junctions_from_unannotated_exons(dbs, confs):
         """Insert replicateid"""
         return (row[:-1] + (conf['replicateid'], row[-1]))
 
-    stats = collect(dbs,
-                    confs['configurations'],
-                    _top_novel_junctions_from_unannotated_exons,
-                    strategy)
+    stats = top_rows(dbs,
+                     confs['configurations'],
+                     _top_novel_junctions_from_unannotated_exons,
+                     strategy,
+                     lambda row: row[4],
+                     select=_top_novel_junctions_from_unannotated_exons_select)
 
     if stats:
-        stats = sorted(stats, key=lambda row: row[4])
-        stats.reverse()
-        chart['table_data'] = stats[:20]
+        chart['table_data'] = stats
     else:
         chart['table_data'] = [[None] * len(chart['table_description'])]
     return chart
@@ -115,12 +127,10 @@ select
     number,
     filename
 from
-    %(projectid)s_%(replicateid)s_split_mapping_breakdown
+    %s
 where
-    type != 'close';""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    type != 'close';""" % replicate_table(conf, 'split_mapping_breakdown')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
 
 
@@ -136,14 +146,30 @@ select
     number,
     filename
 from
-    %(projectid)s_%(replicateid)s_split_mapping_breakdown
+    %s
 where
     type != 'close'
 order by
     number desc
 ) x
-limit 20;""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+limit 20;""" % replicate_table(conf, 'split_mapping_breakdown')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
+
+
+def _top_novel_junctions_from_unannotated_exons_select(conf):
+    """Return the select statement for the top junctions of a replicate"""
+    sql = """
+select
+    start_chr,
+    end_chr,
+    start,
+    end,
+    number as top_value,
+    %%s,
+    filename
+from
+    %s
+where
+    type != 'close'""" % replicate_table(conf, 'split_mapping_breakdown')
+    return sql, (conf['replicateid'], )
@@ -0,0 +1,301 @@
+"""Serializers writing the tables of the resources without a gviz DataTable
+
+The cells are formatted by the same functions the gviz DataTable uses, so the
+output is the same as the one of the DataTable methods.
+"""
+
+import csv
+import struct
+import numbers
+import decimal
+import cStringIO
+from gvizapi.gviz_api import DataTable
+from gvizapi.gviz_api import DataTableException
+from gvizapi.gviz_api import DataTableJSONEncoder
+
+
+def _to_str(value):
+    """Return the value as a UTF-8 encoded str"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _parse_description(table_description):
+    """Return the column ids, types and labels of a table description"""
+    columns = [DataTable.ColumnTypeParser(d) for d in table_description]
+    return [(c['id'], c['type'], c['label']) for c in columns]
+
+
+def iter_csv(data, separator=',', chunk_rows=1000):
+    """Yield the table of a chart as CSV, in chunks of chunk_rows rows.
+
+    This produces the same output as DataTable.ToCsv, but the rows are
+    written as they are taken from the table data.
+    """
+    columns = _parse_description(data['table_description'])
+    buffer = cStringIO.StringIO()
+    writer = csv.writer(buffer, delimiter=separator)
+    writer.writerow([_to_str(label) for _, _, label in columns])
+    written = 0
+    for row in data['table_data']:
+        cells = []
+        for index, (_, column_type, _) in enumerate(columns):
+            value = ''
+            if index < len(row) and not row[index] is None:
+                value = DataTable.CoerceValue(row[index], column_type)
+            if isinstance(value, tuple):
+                # Formatted values are only used for date and time types
+                if column_type in ('date', 'datetime', 'timeofday'):
+                    value = value[1]
+                else:
+                    value = value[0]
+            cells.append(_to_str(DataTable.ToString(value)))
+        writer.writerow(cells)
+        written = written + 1
+        if written % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def to_json(data):
+    """Return the table of a chart in the Google Visualization JSON format.
+
+    This produces the same output as DataTable.ToJSon, but the function
+    coercing and encoding the cells is chosen once per column instead of
+    validating every cell while appending it to a DataTable.
+    """
+    columns = [DataTable.ColumnTypeParser(description)
+               for description in data['table_description']]
+    ids = [column['id'] for column in columns]
+    if len(set(ids)) != len(ids):
+        # The DataTable keeps only one value per column id
+        table = DataTable(data['table_description'])
+        table.AppendData(data['table_data'])
+        return table.ToJSon()
+
+    encoder = DataTableJSONEncoder()
+    col_objs = []
+    for column in columns:
+        col_obj = {"id": column["id"],
+                   "label": column["label"],
+                   "type": column["type"]}
+        if column.get("custom_properties"):
+            col_obj["p"] = column["custom_properties"]
+        col_objs.append(col_obj)
+    # Let the encoder write the frame, so the keys come in the same order
+    frame = encoder.encode({"cols": col_objs, "rows": []})
+
+    cell_encoders = [_get_cell_encoder(encoder, column['type'])
+                     for column in columns]
+    width = len(columns)
+    rows = []
+    for row in data['table_data']:
+        if not hasattr(row, '__iter__') or isinstance(row, dict):
+            raise DataTableException("Expected iterable object, got %s" %
+                                     type(row))
+        row = list(row)
+        if len(row) > width:
+            raise DataTableException("Too many elements given in data")
+        cells = [cell_encoders[index](value)
+                 for index, value in enumerate(row)]
+        cells.extend(['null'] * (width - len(row)))
+        rows.append('{"c":[%s]}' % ','.join(cells))
+
+    # A quoted key can't appear unescaped inside an encoded string
+    result = frame.replace('"rows":[]', '"rows":[%s]' % ','.join(rows), 1)
+    if not isinstance(result, str):
+        result = result.encode('utf-8')
+    return result
+
+
+def _get_cell_encoder(encoder, column_type):
+    """Return the function encoding the cells of a column type"""
+    encode = encoder.encode
+
+    def number_cell(value):
+        """Encode a cell of a number column"""
+        if value is None:
+            return 'null'
+        if isinstance(value, numbers.Integral):
+            return '{"v":%s}' % encode(int(value))
+        if isinstance(value, (numbers.Real, decimal.Decimal)):
+            return '{"v":%s}' % encode(float(value))
+        return _encode_cell(encoder, value, column_type)
+
+    def string_cell(value):
+        """Encode a cell of a string column"""
+        if value is None:
+            return 'null'
+        if isinstance(value, unicode):
+            pass
+        elif isinstance(value, str):
+            value = unicode(value, encoding='utf-8')
+        elif isinstance(value, tuple):
+            return _encode_cell(encoder, value, column_type)
+        else:
+            value = unicode(value)
+        return '{"v":%s}' % encode(value)
+
+    def other_cell(value):
+        """Encode a cell of any other column type"""
+        return _encode_cell(encoder, value, column_type)
+
+    if column_type == 'number':
+        return number_cell
+    elif column_type == 'string':
+        return string_cell
+    return other_cell
+
+
+def _encode_cell(encoder, value, column_type):
+    """Encode a cell the way the DataTable does"""
+    value = DataTable.CoerceValue(value, column_type)
+    if value is None:
+        return 'null'
+    if isinstance(value, tuple):
+        cell = {"v": value[0]}
+        if len(value) > 1 and value[1] is not None:
+            cell["f"] = value[1]
+        if len(value) == 3:
+            cell["p"] = value[2]
+        return encoder.encode(cell)
+    return encoder.encode({"v": value})
+
+
+# Magic bytes and version at the start of the columnar format
+COLUMNS_MAGIC = 'RCOL\x01'
+
+
+def _pack_string(value):
+    """Return the UTF-8 encoded value prefixed by its length"""
+    value = _to_str(value)
+    return struct.pack('<I', len(value)) + value
+
+
+def _pack_array(typecode, values):
+    """Return the values packed as a little endian array"""
+    return struct.pack('<%d%s' % (len(values), typecode), *values)
+
+
+def _column_values(data, index, column_type):
+    """Return the values of a column, with None for the missing cells"""
+    values = []
+    for row in data['table_data']:
+        if not hasattr(row, '__iter__') or isinstance(row, dict):
+            raise DataTableException("Expected iterable object, got %s" %
+                                     type(row))
+        if index >= len(row) or row[index] is None:
+            values.append(None)
+            continue
+        value = row[index]
+        if column_type != 'number' or not isinstance(value, (int, long,
+                                                             float)):
+            value = DataTable.CoerceValue(value, column_type)
+            if isinstance(value, tuple):
+                # Only the values are kept, not their formatting
+                value = value[0]
+        values.append(value)
+    return values
+
+
+def to_columns(data):
+    """Return the table of a chart in a compact columnar binary format.
+
+    All integers are little endian. The body starts with the magic bytes
+    'RCOL\\x01', followed by the number of columns and the number of rows as
+    unsigned 32 bit integers. Each column then consists of:
+
+    - its id, label and type, each as a length prefixed UTF-8 string
+    - one byte per row that is 0 for a missing cell and 1 otherwise
+    - a one byte type code and the values of the column:
+      'q' 64 bit integers, 'd' 64 bit floats, 'B' bytes for booleans, or
+      's' length prefixed UTF-8 strings for all other column types
+
+    Missing cells hold 0 or an empty string.
+    """
+    columns = _parse_description(data['table_description'])
+    width = len(columns)
+    for row in data['table_data']:
+        if hasattr(row, '__len__') and len(row) > width:
+            raise DataTableException("Too many elements given in data")
+    count = len(data['table_data'])
+    parts = [COLUMNS_MAGIC, struct.pack('<II', width, count)]
+    for index, (column_id, column_type, label) in enumerate(columns):
+        values = _column_values(data, index, column_type)
+        parts.append(_pack_string(column_id))
+        parts.append(_pack_string(label))
+        parts.append(_pack_string(column_type))
+        parts.append(_pack_array('B', [int(not v is None) for v in values]))
+        if column_type == 'number':
+            present = [v for v in values if not v is None]
+            if all(isinstance(v, (int, long)) and
+                   -2 ** 63 <= v < 2 ** 63 for v in present):
+                parts.append('q')
+                parts.append(_pack_array('q', [v or 0 for v in values]))
+            else:
+                parts.append('d')
+                parts.append(_pack_array('d', [float(v or 0)
+                                               for v in values]))
+        elif column_type == 'boolean':
+            parts.append('B')
+            parts.append(_pack_array('B', [int(bool(v)) for v in values]))
+        else:
+            parts.append('s')
+            for value in values:
+                if value is None:
+                    parts.append(_pack_string(''))
+                else:
+                    parts.append(_pack_string(DataTable.ToString(value)))
+    return ''.join(parts)
+
+
+def read_columns(body):
+    """Return the table description and columns of a columnar body.
+
+    The columns are lists of values, with None for the missing cells. Dates
+    and times are returned as the strings they were written as.
+    """
+    if not body.startswith(COLUMNS_MAGIC):
+        raise ValueError("Not a columnar table")
+    offset = len(COLUMNS_MAGIC)
+    width, count = struct.unpack_from('<II', body, offset)
+    offset = offset + 8
+
+    def read_string(offset):
+        """Return a length prefixed string and the offset following it"""
+        length, = struct.unpack_from('<I', body, offset)
+        start = offset + 4
+        return body[start:start + length].decode('utf-8'), start + length
+
+    def read_array(typecode, offset):
+        """Return an array of count values and the offset following it"""
+        layout = '<%d%s' % (count, typecode)
+        values = struct.unpack_from(layout, body, offset)
+        return list(values), offset + struct.calcsize(layout)
+
+    description = []
+    columns = []
+    for _ in range(width):
+        column_id, offset = read_string(offset)
+        label, offset = read_string(offset)
+        column_type, offset = read_string(offset)
+        present, offset = read_array('B', offset)
+        typecode = body[offset]
+        offset = offset + 1
+        if typecode == 's':
+            values = []
+            for _ in range(count):
+                value, offset = read_string(offset)
+                values.append(value)
+        else:
+            values, offset = read_array(typecode, offset)
+            if typecode == 'B':
+                values = [bool(value) for value in values]
+        description.append((column_id, str(column_type), label))
+        columns.append([value if flag else None
+                        for value, flag in zip(values, present)])
+    return {'table_description': description, 'columns': columns}
@@ -0,0 +1,164 @@
+"""Executors used for running the queries of several configurations"""
+
+import sys
+import time
+import threading
+from instrumentation import activate
+from instrumentation import current_stats
+
+
+class SerialExecutor(object):
+    """Run the calls one after the other in the calling thread."""
+
+    def map(self, function, items, group=None, timeout=None, default=None):
+        """Return the results of calling the function for each item.
+
+        If a timeout is given, the items not started after that many seconds
+        are given the default as result. A call that has been started can't
+        be stopped, so it may go on after the timeout.
+        """
+        # pylint: disable-msg=W0613
+        # The group is only needed when running concurrently
+        if timeout is None:
+            return [function(item) for item in items]
+        deadline = time.time() + timeout
+        results = []
+        for item in items:
+            if time.time() < deadline:
+                results.append(function(item))
+            else:
+                results.append(default)
+        return results
+
+
+class ThreadPoolExecutor(object):
+    """Run the calls concurrently using a bounded number of threads.
+
+    max_workers: The maximum number of threads used for one call to map
+
+    max_per_group: The maximum number of calls belonging to the same group,
+                   usually the project database, that may run at the same time
+    """
+
+    def __init__(self, max_workers=8, max_per_group=4):
+        self.max_workers = max_workers
+        self.max_per_group = max_per_group
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, group):
+        """Return the semaphore limiting the calls for a group"""
+        self._lock.acquire()
+        try:
+            if not group in self._semaphores:
+                semaphore = threading.BoundedSemaphore(self.max_per_group)
+                self._semaphores[group] = semaphore
+            return self._semaphores[group]
+        finally:
+            self._lock.release()
+
+    def map(self, function, items, group=None, timeout=None, default=None):
+        """Return the results of calling the function for each item.
+
+        The results are returned in the order of the items, independently of
+        the order in which the calls have finished.
+
+        If a timeout is given, the calls that have not finished after that
+        many seconds are given the default as result. They can't be stopped,
+        so they go on in the background, but their results are dropped. The
+        calls that have not been started yet are not started anymore. A
+        call going on in the background keeps its pooled connection until
+        its query has returned, and then gives it back to the pool.
+        """
+        items = list(items)
+        workers = min(self.max_workers, len(items))
+        if workers < 2 and timeout is None:
+            return [function(item) for item in items]
+
+        results = [None] * len(items)
+        finished = [False] * len(items)
+        errors = []
+        pending = list(enumerate(items))
+        pending.reverse()
+        lock = threading.Lock()
+        # The queries run by the threads count for the current request
+        stats = current_stats()
+
+        def work():
+            """Take the next item until there is nothing left to do"""
+            activate(stats)
+            while True:
+                try:
+                    index, item = pending.pop()
+                except IndexError:
+                    return
+                semaphore = None
+                if not group is None:
+                    semaphore = self._semaphore(group(item))
+                    semaphore.acquire()
+                try:
+                    result = function(item)
+                    lock.acquire()
+                    try:
+                        results[index] = result
+                        finished[index] = True
+                    finally:
+                        lock.release()
+                except:
+                    lock.acquire()
+                    try:
+                        errors.append((index, sys.exc_info()))
+                        finished[index] = True
+                    finally:
+                        lock.release()
+                finally:
+                    if not semaphore is None:
+                        semaphore.release()
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(max(workers, 1))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        if timeout is None:
+            for thread in threads:
+                thread.join()
+        else:
+            deadline = time.time() + timeout
+            for thread in threads:
+                thread.join(max(deadline - time.time(), 0))
+        lock.acquire()
+        try:
+            # Calls still running or not started yet are given up, and the
+            # lists are copied as they are still updated by these calls
+            del pending[:]
+            answered = list(results)
+            failed = list(errors)
+            for index, done in enumerate(finished):
+                if not done:
+                    answered[index] = default
+        finally:
+            lock.release()
+
+        if failed:
+            # Raise the error of the first item that failed
+            failed.sort()
+            exc_type, exc_value, exc_traceback = failed[0][1]
+            raise exc_type, exc_value, exc_traceback
+        return answered
+
+
+# The resources query the databases through the connection pools of the pool
+# module, so the queries can run concurrently, each using its own connection.
+EXECUTOR = ThreadPoolExecutor()
+
+
+def get_executor():
+    """Return the executor used for running queries"""
+    return EXECUTOR
+
+
+def set_executor(executor):
+    """Replace the executor used for running queries"""
+    global EXECUTOR  # pylint: disable-msg=W0603
+    EXECUTOR = executor
@@ -1,13 +1,12 @@
 """Run related resources"""
 
-from utils import get_rna_extract_display_mapping
-from utils import get_cell_display_mapping
-from utils import get_localization_display_mapping
 from utils import get_parameter_list
+from utils import get_experiment_info
 from utils import get_experiment_where
 from utils import get_experiment_dict
 from utils import get_parameter_values
 from utils import register_resource
+from queries import fetch_all
 
 
 @register_resource(resolution="replicate", partition=False)
@@ -32,96 +31,20 @@ def replicate_info(dbs, confs):
                    ]
     chart = {}
     chart['table_description'] = description
-    result = []
-    conf = confs['configurations'][0]
-    sql = """
-select experiment_id,
-       project_id,
-       species_id,
-       genome_id,
-       annotation_id,
-       template_file,
-       read_length,
-       mismatches,
-       exp_description,
-       expDate,
-       CellType,
-       RNAType,
-       Compartment,
-       Bioreplicate,
-       partition,
-       paired
-from experiments
-where project_id='%(projectid)s'
-      and experiment_id='%(replicateid)s'""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-
-    species_id = rows[0][2]
-    genome_id = rows[0][3]
-    annotation_id = rows[0][4]
-    result.append(int(rows[0][6]))
-    result.append(int(rows[0][7]))
-    result.append(rows[0][8])
-    result.append(str(rows[0][9]))
-    # Use labels instead of the raw values
-    mapping = get_cell_display_mapping(dbs)
-    result.append(mapping.get(rows[0][10], rows[0][10]))
-    mapping = get_rna_extract_display_mapping(dbs)
-    result.append(mapping.get(rows[0][11], rows[0][11]))
-    mapping = get_localization_display_mapping(dbs)
-    result.append(mapping.get(rows[0][12], rows[0][12]))
-    result.append(rows[0][13])
-    result.append(rows[0][14])
-    result.append(rows[0][15])
-    if not result[-1] is None:
-        result[-1] = ord(result[-1])
-    sql = """
-select species_id,
-       species,
-       genus,
-       sp_alias,
-       abbreviation
-from species_info
-where species_id='%s'
-""" % species_id
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    result.append(rows[0][1])
-
-    sql = """
-select annotation_id,
-       species_id,
-       annotation,
-       location,
-       version,
-       source
-from annotation_files where annotation_id='%s'
-""" % annotation_id
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    result.append(rows[0][4])
-    result.append(rows[0][5])
-
-    sql = """
-select genome_id,
-       species_id,
-       genome,
-       location,
-       assembly,
-       source,
-       gender
-from genome_files where genome_id='%s'
-""" % genome_id
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    result.append(rows[0][4])
-    result.append(rows[0][5])
-    result.append(rows[0][6])
+    conf = confs['kwargs']
+    if not 'replicateid' in conf:
+        # Show the first replicate at the project and experiment levels
+        conf = confs['configurations'][0]
+    where = """where
+    experiments.project_id = %s
+and
+    experiments.experiment_id = %s"""
+    result = get_experiment_info(dbs,
+                                 conf['projectid'],
+                                 where,
+                                 (conf['projectid'], conf['replicateid']))
+    if result is None:
+        result = [None] * len(description)
     chart['table_data'] = [result, ]
     return chart
 
@@ -188,17 +111,17 @@ from experiments,
      genome_files,
      annotation_files
 where
-      project_id='%s'
+      project_id=%s
 and
       experiments.species_id = species_info.species_id
 and
       experiments.genome_id = genome_files.genome_id
 and
       experiments.annotation_id = annotation_files.annotation_id;
-""" % projectid
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+"""
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipelineCommon'],
+                     sql,
+                     (projectid, ))
 
     url = ('/project/%(projectid)s/'
            '%(parameter_list)s/%(parameter_values)s/'
@@ -263,17 +186,17 @@ from experiments,
      genome_files,
      annotation_files
 where
-      project_id='%s'
+      project_id=%s
 and
       experiments.species_id = species_info.species_id
 and
       experiments.genome_id = genome_files.genome_id
 and
       experiments.annotation_id = annotation_files.annotation_id;
-""" % projectid
-    cursor = dbs[projectid]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+"""
+    rows = fetch_all(dbs[projectid]['RNAseqPipelineCommon'],
+                     sql,
+                     (projectid, ))
 
     results = []
     for row in rows:
@@ -299,15 +222,14 @@ def experiment_replicates(dbs, confs):
     parameter_values = confs['kwargs']['parameter_values']
     meta = get_experiment_dict(confs)
     # Only return the experiment infos if this is an official project
+    where, args = get_experiment_where(confs, meta)
     sql = """
 select experiment_id
 from experiments
 %s
 order by
-    experiment_id;""" % get_experiment_where(confs, meta)
-    cursor = dbs[projectid]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    experiment_id;""" % where
+    rows = fetch_all(dbs[projectid]['RNAseqPipelineCommon'], sql, args)
     replicateids = [row[0] for row in rows]
     results = []
     url = '/project/%s/%s/%s/replicate/%s'
@@ -1,10 +1,29 @@
 """Summary statistics of expression"""
 
-import math
-import random
+import time
+import threading
+from restish import http
 from utils import register_resource
 from utils import aggregate
-from utils import run
+from utils import run_batched
+from utils import pivot_partitions
+from utils import top_rows
+from queries import column_name
+from queries import fetch_all
+from queries import placeholders
+from queries import replicate_table
+from sampling import StratifiedSample
+
+# The number of genes shown by gene_expression_levels
+LEVELS_GENES = 100
+
+# The number of seconds gene_expression_levels waits for the replicates, for
+# both of its queries together
+LEVELS_TIMEOUT = 60
+
+# The number of points of the gene expression profiles above the replicate
+# level, which are sampled when there are more
+PROFILE_POINTS = 4000
 
 
 @register_resource(resolution="replicate", partition=False)
@@ -44,10 +63,8 @@ def _expression_summary(dbs, conf):
 select type,
        total,
        detected
-from %(projectid)s_%(replicateid)s_expression_summary""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+from %s""" % replicate_table(conf, 'expression_summary')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     result = {}
     for feature_type, total, detected in rows:
         result[(feature_type, 'total')] = total
@@ -149,12 +166,10 @@ def _detected_genes(dbs, conf):
 select type,
        reliability,
        sum(detected)
-from %(projectid)s_%(replicateid)s_detected_genes
+from %s
 group by type, reliability;
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+""" % replicate_table(conf, 'detected_genes')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     cells = {}
     for row in rows:
         key = (conf['replicateid'], row[0], row[1])
@@ -177,57 +192,30 @@ def gene_expression_profile(dbs, confs):
     for partition in partition_keys:
         description.append((partition, 'number'))
     chart['table_description'] = description
-
-    coords = {}
-
-    datapoints = 0
     partition_length = len(partition_keys)
-    for partition in partition_keys:
-        index = partition_keys.index(partition)
-        for partition_conf in confs['configurations'][partition]:
-            stats, success = run(dbs, _gene_expression_profile, partition_conf)
-            if success:
-                for x, y in stats:
-                    datapoints = datapoints + 1
-                    if y in coords:
-                        coords[y].append((index, x, y))
-                    else:
-                        coords[y] = [(index, x, y)]
 
-    sample = []
-    if confs['level']['id'] in ['lane', 'replicate'] or datapoints < 4000:
+    if confs['level']['id'] in ['lane', 'replicate']:
         # no random sampling
-        for y, values in coords.items():
-            sample = sample + values
+        sample = StratifiedSample(None)
     else:
         # There are a lot of entries for x between 1 and 10
         # This population can be sampled in order to reduce the dataset
-        for y, values in coords.items():
-            # take a random sample of items if the dataset is too big
-            if len(values) > 1:
-                # Divide the number of values by the logaritm to get a sample
-                # size that reflects the size of the population
-                size = int(len(values) / math.log(len(values)))
-                if size <= len(values):
-                    sample = sample + random.sample(values, size)
-            else:
-                sample = sample + values
-
-    result = []
-    for index, x, y in sample:
-        y = int(y)
-        found = False
-        for res in result:
-            if res[0] == x and res[index + 1] == None:
-                res[index + 1] = y
-                found = True
-                break
-        if found:
-            pass
-        else:
-            line = [None] * partition_length
-            line[index] = y
-            result.append([x] + line)
+        sample = StratifiedSample(PROFILE_POINTS)
+
+    # The points are added to the sample while the replicates are read, so
+    # only the rows of the replicates being read are held besides the sample
+    sample_lock = threading.Lock()
+    profile_confs = []
+    for index, partition in enumerate(partition_keys):
+        for conf in confs['configurations'][partition]:
+            conf['profile'] = (index, sample, sample_lock)
+            profile_confs.append(conf)
+    for found in run_batched(dbs, profile_confs, _gene_expression_profile):
+        if found == http.not_found:
+            print "Error running sql method."
+
+    points = [(index, x, int(y)) for index, x, y in sample.items()]
+    result = pivot_partitions(points, partition_length)
 
     if result:
         chart['table_data'] = result
@@ -236,68 +224,72 @@ def gene_expression_profile(dbs, confs):
     return chart
 
 
-def _gene_expression_profile(dbs, conf):
-    """Query the database for the gene expression profile."""
+def _gene_expression_profile(dbs, confs):
+    """Query the database for the gene expression profiles of the lanes of a
+    replicate, and add their points to the sample of the configurations.
+
+    Returns the number of points of each lane."""
+    laneids = [conf['laneid'] for conf in confs]
     sql = """
 select
+    LaneName,
     rpkm,
     support
 from
-    %(projectid)s_%(replicateid)s_gene_RPKM_dist
+    %s
 where
-    LaneName = '%(laneid)s'
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    return rows
+    LaneName in (%s)
+""" % (replicate_table(confs[0], 'gene_RPKM_dist'), placeholders(laneids))
+    rows = fetch_all(dbs[confs[0]['projectid']]['RNAseqPipeline'],
+                     sql,
+                     laneids)
+    lanes = dict((laneid, []) for laneid in laneids)
+    for conf in confs:
+        lanes[conf['laneid']].append(conf)
+    points = dict((laneid, 0) for laneid in laneids)
+    _, sample, sample_lock = confs[0]['profile']
+    sample_lock.acquire()
+    try:
+        for laneid, rpkm, support in rows:
+            for conf in lanes[laneid]:
+                index = conf['profile'][0]
+                sample.add(support, (index, rpkm, support))
+            points[laneid] = points[laneid] + 1
+    finally:
+        sample_lock.release()
+    return [points[conf['laneid']] for conf in confs]
 
 
 @register_resource(resolution="lane", partition=False)
 def gene_expression_levels(dbs, confs):
     """
-    Implement a greedy strategy of getting just enough of the top rpkms from any lane to be
-    sure to be able to finish the selection of at least 100 genes.
-    The selection process gives each lane a chance to contribute using randomization strategy.
-    Minimally, a lane may contribute 0 genes, which is the case when we have not found
-    any gene from this lane after 100 rounds.
-    Maximally, a lane can contribute 100 genes if all of the top genes come from one
-    lane.
-    On average, given a random distribution of top rpkms across the lanes, each lane is
-    given an equal chance of contributing a gene.
-    In the worst case, the maximum amount of data points we need is 100*#lanes, which is only
-    going to be the case when all lanes have the same genes and are found in alternating order.
-
-    Now that the top genes are decided, get the top 100 values from the different lanes for
-    these genes.
+    Select up to LEVELS_GENES genes among the most highly expressed genes of
+    the lanes, and show their expression levels in all lanes.
+
+    The top genes of all lanes of a replicate are loaded in one query. The
+    lanes then take turns in contributing their next top gene that has not
+    been selected yet, so each lane is given an equal chance of contributing
+    a gene. The selection stops when enough genes are selected, or when the
+    lanes have no more top genes, which is the case when there are fewer
+    genes in total.
+
+    Now that the top genes are decided, get the values for these genes from
+    all lanes of a replicate in one query.
+
+    Replicates that do not answer both queries within LEVELS_TIMEOUT seconds
+    are left out. The queries still running then are not waited for, see
+    the executors.
     """
     chart = {}
+    configurations = confs['configurations']
 
-    topgenes = {}
-    for conf in confs['configurations']:
-        key = (conf['replicateid'], conf['laneid'])
-        topgenes[key] = _top_gene_expression_levels(dbs, conf)
-        # Reverse. Items will be popped starting with most highly expressed.
-        topgenes[key].reverse()
-
-    # Compose the random seed from the laneids
-    random.seed(tuple([c['laneid'] for c in confs['configurations']]))
-
-    # These keys can be used to select from the top genes
-    replicateid_laneid_keys = topgenes.keys()
-
-    genes = []
-    while len(genes) < 100:
-        # Take out a random replicateid and laneid to choose the next
-        # gene candidate
-        replicateid, laneid = random.choice(replicateid_laneid_keys)
-        try:
-            gene = topgenes[(replicateid, laneid)].pop()
-        except IndexError:
-            # This lane does not provide any more values
-            continue
-        if not gene in genes:
-            genes.append(gene)
+    deadline = time.time() + LEVELS_TIMEOUT
+    topgenes = run_batched(dbs,
+                           configurations,
+                           _top_gene_expression_levels,
+                           timeout=LEVELS_TIMEOUT)
+    genes = select_round_robin([t for t in topgenes if t != http.not_found],
+                               LEVELS_GENES)
 
     columns = [('Gene Name', 'string'), ]
     # Assemble the columns consisting of the gene names
@@ -305,9 +297,20 @@ def gene_expression_levels(dbs, confs):
         columns.append((gene, 'number'))
     chart['table_description'] = columns
 
+    for conf in configurations:
+        conf['genes'] = genes
+    remaining = deadline - time.time()
+    if remaining > 0:
+        levels = run_batched(dbs,
+                             configurations,
+                             _selected_gene_expression_levels,
+                             timeout=remaining)
+    else:
+        levels = [http.not_found] * len(configurations)
     result = []
-    for conf in confs['configurations']:
-        selected = _selected_gene_expression_levels(dbs, conf, genes)
+    for conf, selected in zip(configurations, levels):
+        if selected == http.not_found:
+            selected = {}
         ordered = []
         for gene in genes:
             ordered.append(selected.get(gene, None))
@@ -317,46 +320,88 @@ def gene_expression_levels(dbs, confs):
     return chart
 
 
-def _top_gene_expression_levels(dbs, conf):
-    """Query the database for the top 100 gene expression levels."""
-    # Get the Top 100 genes for a lane
-    sql = """
-select
-    gene_id
-from
-    %(projectid)s_%(replicateid)s_gene_RPKM
-where
-    LaneName = '%(laneid)s'
-order by
-    RPKM desc
-limit 100""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    return [row[0] for row in rows]
+def select_round_robin(candidates, limit):
+    """Select up to limit different items from lists of candidates, taking
+    the first remaining candidate of each list in turn.
+
+    >>> select_round_robin([['a', 'b', 'c'], ['b', 'd']], 3)
+    ['a', 'b', 'd']
+    """
+    selected = []
+    seen = set()
+    for rank in range(max([len(c) for c in candidates] + [0])):
+        for items in candidates:
+            if len(selected) == limit:
+                return selected
+            if rank < len(items) and not items[rank] in seen:
+                seen.add(items[rank])
+                selected.append(items[rank])
+    return selected
+
+
+def _top_gene_expression_levels(dbs, confs):
+    """Query the database for the top gene expression levels of the lanes
+    of a replicate."""
+    parts = []
+    for number in range(len(confs)):
+        parts.append("""select * from (
+    select
+        LaneName,
+        gene_id,
+        RPKM
+    from
+        %s
+    where
+        LaneName = %%s
+    order by
+        RPKM desc
+    limit %s) as lane_%s""" % (replicate_table(confs[0], 'gene_RPKM'),
+                               LEVELS_GENES,
+                               number))
+    rows = fetch_all(dbs[confs[0]['projectid']]['RNAseqPipeline'],
+                     "\nunion all\n".join(parts),
+                     [conf['laneid'] for conf in confs])
+    topgenes = dict((conf['laneid'], []) for conf in confs)
+    for laneid, gene, rpkm in rows:
+        topgenes[laneid].append((rpkm, gene))
+    result = []
+    for conf in confs:
+        # The most highly expressed gene first
+        lane_topgenes = sorted(topgenes[conf['laneid']],
+                               key=lambda row: row[0],
+                               reverse=True)
+        result.append([gene for rpkm, gene in lane_topgenes])
+    return result
 
 
-def _selected_gene_expression_levels(dbs, conf, genes):
-    """Query the database for selected gene expression levels."""
+def _selected_gene_expression_levels(dbs, confs):
+    """Query the database for the expression levels of the selected genes
+    in the lanes of a replicate."""
+    genes = confs[0]['genes']
+    laneids = [conf['laneid'] for conf in confs]
+    result = dict((laneid, {}) for laneid in laneids)
+    if not genes:
+        return [result[laneid] for laneid in laneids]
     # For each gene, we need the value for all the lanes
     sql = """
 select
+    LaneName,
     gene_id,
     RPKM
 from
-    %(projectid)s_%(replicateid)s_gene_RPKM
+    %s
 where
-    LaneName = '%(laneid)s'""" % conf
-    sql = """%s
+    LaneName in (%s)
 and
-    gene_id in ('%s')""" % (sql, "','".join(genes))
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    result = {}
-    for row in rows:
-        result[row[0]] = row[1]
-    return result
+    gene_id in (%s)""" % (replicate_table(confs[0], 'gene_RPKM'),
+                          placeholders(laneids),
+                          placeholders(genes))
+    rows = fetch_all(dbs[confs[0]['projectid']]['RNAseqPipeline'],
+                     sql,
+                     laneids + list(genes))
+    for laneid, gene, rpkm in rows:
+        result[laneid][gene] = rpkm
+    return [result[laneid] for laneid in laneids]
 
 
 @register_resource(resolution="lane", partition=False)
@@ -373,17 +418,18 @@ def top_genes(dbs, confs):
                                   ('Replicate Id', 'string'),
                                   ('Lane Id', 'string'),
                                   ]
-    result = []
-    for conf in confs['configurations']:
-        stats, success = run(dbs, _top_genes, conf)
-        if success:
-            for row in stats:
-                line = row + (conf['replicateid'], conf['laneid'])
-                result.append(line)
+    def strategy(conf, row):
+        """Add the replicate and lane ids"""
+        return row + (conf['replicateid'], conf['laneid'])
+
+    result = top_rows(dbs,
+                      confs['configurations'],
+                      _top_genes,
+                      strategy,
+                      lambda row: row[6],
+                      select=_top_genes_select)
     if result:
-        result = sorted(result, key=lambda row: row[6])
-        result.reverse()
-        chart['table_data'] = result[:20]
+        chart['table_data'] = result
     else:
         chart['table_data'] = [[None] * len(chart['table_description'])]
     return chart
@@ -391,6 +437,8 @@ def top_genes(dbs, confs):
 
 def _all_genes(dbs, conf):
     """Query the database for all genes."""
+    names = {'lane': column_name(conf['laneid']),
+             'table': replicate_table(conf, 'top_genes_expressed')}
     sql = """
 select gene_id,
        length,
@@ -398,17 +446,17 @@ select gene_id,
        locus,
        no_exons,
        no_transcripts,
-       %(laneid)s
+       %(lane)s
 from
-    %(projectid)s_%(replicateid)s_top_genes_expressed""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    %(table)s""" % names
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
 
 
 def _top_genes(dbs, conf):
     """Query the database for the top 20 genes."""
+    names = {'lane': column_name(conf['laneid']),
+             'table': replicate_table(conf, 'top_genes_expressed')}
     sql = """
 select * from (
 select gene_id,
@@ -417,19 +465,36 @@ select gene_id,
        locus,
        no_exons,
        no_transcripts,
-       %(laneid)s
+       %(lane)s
 from
-    %(projectid)s_%(replicateid)s_top_genes_expressed
+    %(table)s
 order by
-    %(laneid)s desc
+    %(lane)s desc
 ) x
-limit 20;""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+limit 20;""" % names
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
 
 
+def _top_genes_select(conf):
+    """Return the select statement for the top genes of a lane"""
+    names = {'lane': column_name(conf['laneid']),
+             'table': replicate_table(conf, 'top_genes_expressed')}
+    sql = """
+select gene_id,
+       length,
+       strand,
+       locus,
+       no_exons,
+       no_transcripts,
+       %(lane)s as top_value,
+       %%s,
+       %%s
+from
+    %(table)s""" % names
+    return sql, (conf['replicateid'], conf['laneid'])
+
+
 @register_resource(resolution="lane", partition=False)
 def top_transcripts(dbs, confs):
     """Query the database for the top 20 transcripts."""
@@ -444,18 +509,19 @@ def top_transcripts(dbs, confs):
                    ]
     chart = {}
     chart['table_description'] = description
-    result = []
-    for conf in confs['configurations']:
-        stats, success = run(dbs, _top_transcripts, conf)
-        if success:
-            for row in stats:
-                line = row + (conf['replicateid'], conf['laneid'])
-                result.append(line)
 
+    def strategy(conf, row):
+        """Add the replicate and lane ids"""
+        return row + (conf['replicateid'], conf['laneid'])
+
+    result = top_rows(dbs,
+                      confs['configurations'],
+                      _top_transcripts,
+                      strategy,
+                      lambda row: row[5],
+                      select=_top_transcripts_select)
     if result:
-        result = sorted(result, key=lambda row: row[5])
-        result.reverse()
-        chart['table_data'] = result[:20]
+        chart['table_data'] = result
     else:
         chart['table_data'] = [[None] * len(chart['table_description'])]
     return chart
@@ -463,23 +529,25 @@ def top_transcripts(dbs, confs):
 
 def _all_transcripts(dbs, conf):
     """Query the database for all transcripts."""
+    names = {'lane': column_name(conf['laneid']),
+             'table': replicate_table(conf, 'top_transcripts_expressed')}
     sql = """
 select transcript_id,
        length,
        strand,
        locus,
        no_exons,
-       %(laneid)s
+       %(lane)s
 from
-    %(projectid)s_%(replicateid)s_top_transcripts_expressed""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    %(table)s""" % names
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
 
 
 def _top_transcripts(dbs, conf):
     """Query the database for the top 20 transcripts."""
+    names = {'lane': column_name(conf['laneid']),
+             'table': replicate_table(conf, 'top_transcripts_expressed')}
     sql = """
 select * from (
 select transcript_id,
@@ -487,19 +555,35 @@ select transcript_id,
        strand,
        locus,
        no_exons,
-       %(laneid)s
+       %(lane)s
 from
-    %(projectid)s_%(replicateid)s_top_transcripts_expressed
+    %(table)s
 order by
-    %(laneid)s desc
+    %(lane)s desc
 ) x
-limit 20;""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+limit 20;""" % names
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
 
 
+def _top_transcripts_select(conf):
+    """Return the select statement for the top transcripts of a lane"""
+    names = {'lane': column_name(conf['laneid']),
+             'table': replicate_table(conf, 'top_transcripts_expressed')}
+    sql = """
+select transcript_id,
+       length,
+       strand,
+       locus,
+       no_exons,
+       %(lane)s as top_value,
+       %%s,
+       %%s
+from
+    %(table)s""" % names
+    return sql, (conf['replicateid'], conf['laneid'])
+
+
 @register_resource(resolution="lane", partition=False)
 def top_exons(dbs, confs):
     """Return the top 20 exons."""
@@ -513,18 +597,19 @@ def top_exons(dbs, confs):
                    ('Lane Id', 'string'),
                    ]
     chart['table_description'] = description
-    result = []
-    for conf in confs['configurations']:
-        stats, success = run(dbs, _top_exons, conf)
-        if success:
-            for row in stats:
-                line = row + (conf['replicateid'], conf['laneid'])
-                result.append(line)
-                
+
+    def strategy(conf, row):
+        """Add the replicate and lane ids"""
+        return row + (conf['replicateid'], conf['laneid'])
+
+    result = top_rows(dbs,
+                      confs['configurations'],
+                      _top_exons,
+                      strategy,
+                      lambda row: row[4],
+                      select=_top_exons_select)
     if result:
-        result = sorted(result, key=lambda row: row[4])
-        result.reverse()
-        chart['table_data'] = result[:20]
+        chart['table_data'] = result
     else:
         chart['table_data'] = [[None] * len(chart['table_description'])]
     return chart
@@ -532,23 +617,25 @@ def top_exons(dbs, confs):
 
 def _all_exons(dbs, conf):
     """Query the database for all exons."""
+    names = {'lane': column_name(conf['laneid']),
+             'table': replicate_table(conf, 'top_exons_expressed')}
     sql = """
 select
     exon_id,
     length,
     strand,
     locus,
-    %(laneid)s
+    %(lane)s
 from
-    %(projectid)s_%(replicateid)s_top_exons_expressed""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    %(table)s""" % names
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
 
 
 def _top_exons(dbs, conf):
     """Query the database for the top exons."""
+    names = {'lane': column_name(conf['laneid']),
+             'table': replicate_table(conf, 'top_exons_expressed')}
     sql = """
 select * from (
 select
@@ -556,14 +643,30 @@ select
     length,
     strand,
     locus,
-    %(laneid)s
+    %(lane)s
 from
-    %(projectid)s_%(replicateid)s_top_exons_expressed
+    %(table)s
 order by
-    %(laneid)s desc
+    %(lane)s desc
 ) x
-limit 20;""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+limit 20;""" % names
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return rows
+
+
+def _top_exons_select(conf):
+    """Return the select statement for the top exons of a lane"""
+    names = {'lane': column_name(conf['laneid']),
+             'table': replicate_table(conf, 'top_exons_expressed')}
+    sql = """
+select
+    exon_id,
+    length,
+    strand,
+    locus,
+    %(lane)s as top_value,
+    %%s,
+    %%s
+from
+    %(table)s""" % names
+    return sql, (conf['replicateid'], conf['laneid'])
@@ -0,0 +1,233 @@
+"""Counting the queries and the time spent per request
+
+Each request to a resource gets a RequestStats instance that is active in the
+thread serving the request, and in the threads of the executor running the
+queries for it. The queries run through queries.fetch_all and the calls
+wrapped by timed or run_method_using_mysqldb are recorded in it.
+
+When the request is finished, its numbers are added up per resource, so the
+statistics costing the most queries and time can be found using the /_stats
+resource.
+"""
+
+import time
+import threading
+from functools import wraps
+from raisin import mysqldb
+
+# The statistics of the request handled by the current thread
+_CURRENT = threading.local()
+
+# The numbers of the finished requests, by resource key
+TOTALS = {}
+TOTALS_LOCK = threading.Lock()
+
+
+class RequestStats(object):
+    """The queries run and the time spent for one request"""
+
+    def __init__(self, key, timer=time.time):
+        self.key = key
+        self.timer = timer
+        self.started = timer()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.max_query_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.failures = 0
+        self.cache_hit = False
+        # Set when the response was rendered for an identical request
+        self.coalesced = False
+        # Set when the request is finished by finish_streamed
+        self.streamed = False
+        # The number of calls and the seconds spent, by span name
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def add_query(self, seconds, rows):
+        """Record a query returning the number of rows"""
+        self._lock.acquire()
+        try:
+            self.queries = self.queries + 1
+            self.query_seconds = self.query_seconds + seconds
+            self.max_query_seconds = max(self.max_query_seconds, seconds)
+            self.rows = self.rows + rows
+        finally:
+            self._lock.release()
+
+    def add_span(self, name, seconds):
+        """Record a call of the named span"""
+        self._lock.acquire()
+        try:
+            calls, total = self.spans.get(name, (0, 0.0))
+            self.spans[name] = (calls + 1, total + seconds)
+        finally:
+            self._lock.release()
+
+    def add_failure(self):
+        """Record a method that could not be run"""
+        self._lock.acquire()
+        try:
+            self.failures = self.failures + 1
+        finally:
+            self._lock.release()
+
+    def server_timing(self):
+        """Return the value of the Server-Timing header.
+
+        Durations are in milliseconds. Spans running in several threads are
+        summed over the threads, so they can add up to more than the total.
+        """
+        if self.cache_hit:
+            metrics = ['cache;desc="hit"']
+        elif self.coalesced:
+            metrics = ['cache;desc="coalesced"']
+        else:
+            metrics = ['db;dur=%.1f;desc="%s queries, %s rows"' %
+                       (self.query_seconds * 1000, self.queries, self.rows)]
+        for name in sorted(self.spans):
+            calls, seconds = self.spans[name]
+            metrics.append('%s;dur=%.1f;desc="%s calls"' %
+                           (name, seconds * 1000, calls))
+        metrics.append('total;dur=%.1f' %
+                       ((self.timer() - self.started) * 1000))
+        return ', '.join(metrics)
+
+
+def current_stats():
+    """Return the statistics of the request of this thread, or None"""
+    return getattr(_CURRENT, 'stats', None)
+
+
+def activate(stats):
+    """Record into the statistics in this thread, or stop recording if None"""
+    _CURRENT.stats = stats
+
+
+def start_request(key):
+    """Start recording the statistics of a request to the resource key"""
+    stats = RequestStats(key)
+    activate(stats)
+    return stats
+
+
+def finish_request(stats):
+    """Stop recording and add the statistics to the totals of the resource"""
+    if current_stats() is stats:
+        activate(None)
+    seconds = stats.timer() - stats.started
+    TOTALS_LOCK.acquire()
+    try:
+        if not stats.key in TOTALS:
+            TOTALS[stats.key] = {'requests': 0,
+                                 'cache_hits': 0,
+                                 'coalesced': 0,
+                                 'failures': 0,
+                                 'queries': 0,
+                                 'query_seconds': 0.0,
+                                 'max_query_seconds': 0.0,
+                                 'rows': 0,
+                                 'bytes': 0,
+                                 'seconds': 0.0,
+                                 'max_seconds': 0.0,
+                                 }
+        totals = TOTALS[stats.key]
+        totals['requests'] = totals['requests'] + 1
+        totals['cache_hits'] = totals['cache_hits'] + int(stats.cache_hit)
+        totals['coalesced'] = totals['coalesced'] + int(stats.coalesced)
+        totals['failures'] = totals['failures'] + stats.failures
+        totals['queries'] = totals['queries'] + stats.queries
+        totals['query_seconds'] = totals['query_seconds'] + stats.query_seconds
+        totals['max_query_seconds'] = max(totals['max_query_seconds'],
+                                          stats.max_query_seconds)
+        totals['rows'] = totals['rows'] + stats.rows
+        totals['bytes'] = totals['bytes'] + stats.bytes
+        totals['seconds'] = totals['seconds'] + seconds
+        totals['max_seconds'] = max(totals['max_seconds'], seconds)
+    finally:
+        TOTALS_LOCK.release()
+
+
+def finish_streamed(stats, chunks):
+    """Return the chunks of a streamed body, counting their bytes, and finish
+    the request once all chunks are written"""
+    stats.streamed = True
+    return _count_chunks(stats, chunks)
+
+
+def _count_chunks(stats, chunks):
+    """Yield the chunks, adding their length to the bytes of the request"""
+    try:
+        for chunk in chunks:
+            stats.bytes = stats.bytes + len(chunk)
+            yield chunk
+    finally:
+        finish_request(stats)
+
+
+def get_statistics():
+    """Return copies of the totals by resource key"""
+    TOTALS_LOCK.acquire()
+    try:
+        return dict((key, dict(totals)) for key, totals in TOTALS.items())
+    finally:
+        TOTALS_LOCK.release()
+
+
+def reset_statistics():
+    """Forget the totals of all resources"""
+    TOTALS_LOCK.acquire()
+    try:
+        TOTALS.clear()
+    finally:
+        TOTALS_LOCK.release()
+
+
+def record_query(seconds, rows):
+    """Record a query in the statistics of the current request"""
+    stats = current_stats()
+    if not stats is None:
+        stats.add_query(seconds, rows)
+
+
+def record_span(name, seconds):
+    """Record a span in the statistics of the current request"""
+    stats = current_stats()
+    if not stats is None:
+        stats.add_span(name, seconds)
+
+
+def timed(name):
+    """Decorator recording the calls of a function as the named span"""
+    def decorator(function):
+        """Wrap the function"""
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            """Call the function and record the time spent"""
+            stats = current_stats()
+            if stats is None:
+                return function(*args, **kwargs)
+            started = stats.timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.add_span(name, stats.timer() - started)
+        return wrapper
+    return decorator
+
+
+def run_method_using_mysqldb(method, dbs, confs, marker):
+    """Run the method like raisin.mysqldb.run_method_using_mysqldb, recording
+    the time spent and whether it failed"""
+    stats = current_stats()
+    if stats is None:
+        return mysqldb.run_method_using_mysqldb(method, dbs, confs, marker)
+    started = stats.timer()
+    try:
+        data = mysqldb.run_method_using_mysqldb(method, dbs, confs, marker)
+    finally:
+        stats.add_span('method', stats.timer() - started)
+    if data == marker:
+        stats.add_failure()
+    return data
@@ -1,9 +1,13 @@
 """Summary statistics related to mapping"""
 
 from utils import register_resource
-from utils import aggregate
+from utils import aggregate_reads
+from utils import register_rollup
 from utils import collect
-from raisin.mysqldb import run_method_using_mysqldb
+from utils import get_lane_name_rows
+from queries import fetch_all
+from queries import replicate_table
+from instrumentation import run_method_using_mysqldb
 from restish import http
 
 
@@ -71,28 +75,25 @@ select LaneName,
        start,
        position,
        hits
-from %(projectid)s_%(replicateid)s_read_dist_transcripts
+from %s
 where
-    LaneName = '%(laneid)s'
+    LaneName = %%s
 order by start,
-         position""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+         position""" % replicate_table(conf, 'read_dist_transcripts')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'],
+                     sql,
+                     (conf['laneid'], ))
     return rows
 
 
-@register_resource(resolution="read", partition=False)
+@register_resource(resolution="read", partition=False, rollup=True)
 def mapping_summary(dbs, confs):
     """Return an overview of the results after mapping"""
     chart = {}
 
-    stats, failed = aggregate(dbs,
-                              confs['configurations'],
-                              _mapping_summary,
-                              lambda x, y: x + y)
-
-    average_by = len(confs['configurations']) - failed
+    stats, average_by = aggregate_reads(dbs,
+                                        confs['configurations'],
+                                        _mapping_summary)
 
     if average_by == 0:
         label = ''
@@ -111,30 +112,29 @@ def mapping_summary(dbs, confs):
     return chart
 
 
-def _mapping_summary(dbs, conf):
+def _mapping_summary(dbs, confs):
     """Query the database for the mapping statistics per read"""
-    sql = """
-select
-    totalReads,
-    uniqueReads,
-    mappedReads
-from
-    %(projectid)s_%(replicateid)s_merged_mapping
-where
-    LaneName = '%(readid)s'""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    if rows:
-        total, unique, mapped = rows[0]
-        data = {'total': total,
-                'unique': unique,
-                'multimapped': mapped - unique,
-                'unmapped': total - mapped,
-                }
-    else:
-        data = None
-    return data
+    columns = ['totalReads',
+               'uniqueReads',
+               'mappedReads',
+               ]
+    rows = get_lane_name_rows(dbs, confs, 'merged_mapping', columns)
+    result = []
+    for conf in confs:
+        row = rows.get(conf['readid'], None)
+        if row is None:
+            result.append(None)
+        else:
+            total, unique, mapped = row
+            result.append({'total': total,
+                           'unique': unique,
+                           'multimapped': mapped - unique,
+                           'unmapped': total - mapped,
+                           })
+    return result
+
+
+register_rollup(_mapping_summary)
 
 
 def _percentage_mapping_summary(data, average_by):
@@ -162,25 +162,25 @@ def _percentage_mapping_summary(data, average_by):
     return result
 
 
-@register_resource(resolution="read", partition=True)
+@register_resource(resolution="read", partition=True, rollup=True)
 def merged_mapped_reads(dbs, confs):
     """Summary of all the reads that were mapped"""
     return mapped_reads(dbs, confs, 'merged_mapping')
 
 
-@register_resource(resolution="read", partition=True)
+@register_resource(resolution="read", partition=True, rollup=True)
 def genome_mapped_reads(dbs, confs):
     """Summary of the reads mapping to the genome"""
     return mapped_reads(dbs, confs, 'genome_mapping')
 
 
-@register_resource(resolution="read", partition=True)
+@register_resource(resolution="read", partition=True, rollup=True)
 def junction_mapped_reads(dbs, confs):
     """Summary of the reads mapping to the junctions library"""
     return mapped_reads(dbs, confs, 'junctions_mapping')
 
 
-@register_resource(resolution="read", partition=True)
+@register_resource(resolution="read", partition=True, rollup=True)
 def split_mapped_reads(dbs, confs):
     """Summary of those reads split-mapped to the genome"""
     return mapped_reads(dbs, confs, 'split_mapping')
@@ -206,13 +206,10 @@ def mapped_reads(dbs, confs, tableid):
 
 def _mapped_reads(dbs, confs, partition, tableid):
     """Calculate read mappings using different SQL tables"""
-    stats, failed = aggregate(dbs,
-                              confs,
-                              _raw_mapped_reads,
-                              lambda x, y: x + y,
-                              tableid=tableid)
-
-    average_by = len(confs) - failed
+    stats, average_by = aggregate_reads(dbs,
+                                        confs,
+                                        _raw_mapped_reads,
+                                        tableid=tableid)
 
     if average_by == 0:
         return [partition, None, None, None, None]
@@ -224,28 +221,30 @@ def _mapped_reads(dbs, confs, partition, tableid):
     return [partition, total, mapped, unique, onezerozero]
 
 
-def _raw_mapped_reads(dbs, conf):
+def _raw_mapped_reads(dbs, confs):
     """Query the database for mapped reads using different SQL tables"""
-    sql = """
-select
-    totalReads,
-    mappedReads,
-    uniqueReads,
-    100uniqueReads
-from
-    %(projectid)s_%(replicateid)s_%(tableid)s
-where
-     LaneName = '%(readid)s'
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    if rows:
-        data = {'totalReads': rows[0][0],
-                'mappedReads': rows[0][1],
-                'uniqueReads': rows[0][2],
-                '100uniqueReads': rows[0][3],
-                }
-    else:
-        data = {}
-    return data
+    columns = ['totalReads',
+               'mappedReads',
+               'uniqueReads',
+               '100uniqueReads',
+               ]
+    rows = get_lane_name_rows(dbs, confs, confs[0]['tableid'], columns)
+    result = []
+    for conf in confs:
+        row = rows.get(conf['readid'], None)
+        if row is None:
+            result.append({})
+        else:
+            result.append({'totalReads': row[0],
+                           'mappedReads': row[1],
+                           'uniqueReads': row[2],
+                           '100uniqueReads': row[3],
+                           })
+    return result
+
+
+for _tableid in ('merged_mapping',
+                 'genome_mapping',
+                 'junctions_mapping',
+                 'split_mapping'):
+    register_rollup(_raw_mapped_reads, tableid=_tableid)
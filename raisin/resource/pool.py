@@ -0,0 +1,344 @@
+"""Pools of connections to the MySQL databases of the projects
+
+The databases in request.environ['dbs'] are raisin.mysqldb DB instances
+sharing one connection each. pooled_dbs replaces them by connection pools
+with the same query method, so that concurrent requests and the queries run
+by the executor each get a connection of their own.
+"""
+
+import time
+import atexit
+import threading
+from collections import deque
+import MySQLdb
+
+# Options used for new pools, see ConnectionPool
+POOL_OPTIONS = {'max_size': 8,
+                'max_idle': 300,
+                'timeout': 30,
+                }
+
+# MySQL errors telling that the connection itself is broken: server has gone
+# away, lost connection to server during query
+CONNECTION_ERRORS = (2006, 2013)
+
+# The pools by database name, server and port
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection became free in time"""
+
+
+class Result(object):
+    """The rows returned by a query.
+
+    It can be used like the buffered cursor returned by DB.query, but does
+    not hold on to the connection.
+    """
+
+    def __init__(self, rows, description, rowcount):
+        self.rows = rows
+        self.description = description
+        self.rowcount = rowcount
+        self._position = 0
+
+    def fetchone(self):
+        """Return the next row, or None"""
+        if self._position >= len(self.rows):
+            return None
+        row = self.rows[self._position]
+        self._position = self._position + 1
+        return row
+
+    def fetchall(self):
+        """Return the remaining rows"""
+        rows = self.rows[self._position:]
+        self._position = len(self.rows)
+        return rows
+
+    def close(self):
+        """Nothing to close, the connection has been returned already"""
+        pass
+
+
+class ConnectionPool(object):
+    """A pool of connections to one database.
+
+    max_size: The maximum number of connections open at the same time
+
+    max_idle: The number of seconds after which an unused connection is
+              closed instead of being used again
+
+    timeout:  The number of seconds to wait for a free connection
+
+    Connections are pinged when they are taken out of the pool, and replaced
+    if the server has gone away. Pinging, connecting and closing is done
+    without holding the lock of the pool.
+    """
+
+    def __init__(self, connect, max_size=8, max_idle=300, timeout=30,
+                 timer=time.time):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.timer = timer
+        self._idle = deque()
+        self._size = 0
+        self._condition = threading.Condition()
+        self.metrics = {'created': 0,
+                        'reused': 0,
+                        'closed': 0,
+                        'stale': 0,
+                        'waits': 0,
+                        'timeouts': 0,
+                        'queries': 0,
+                        }
+
+    def _count(self, name):
+        """Increment a metric, with the condition held"""
+        self.metrics[name] = self.metrics[name] + 1
+
+    def _close(self, connection):
+        """Close a connection that is no longer used"""
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+
+    def checkout(self):
+        """Return a connection that is not used by anyone else.
+
+        The connections are pinged and opened without holding the lock, so
+        that a slow server does not hold up the other threads.
+        """
+        deadline = self.timer() + self.timeout
+        while True:
+            connection = self._reserve(deadline)
+            if connection is None:
+                break
+            try:
+                connection.ping()
+            except MySQLdb.Error:
+                self._drop(connection, 'stale')
+                continue
+            self._condition.acquire()
+            try:
+                self._count('reused')
+            finally:
+                self._condition.release()
+            return connection
+        try:
+            connection = self.connect()
+        except:
+            self.discard(None)
+            raise
+        self._condition.acquire()
+        try:
+            self._count('created')
+        finally:
+            self._condition.release()
+        return connection
+
+    def _reserve(self, deadline):
+        """Take an idle connection out of the pool, or return None after
+        reserving the place of a new connection"""
+        expired = []
+        self._condition.acquire()
+        try:
+            while True:
+                while self._idle:
+                    # The most recently used connection is the least likely
+                    # to have timed out on the server
+                    connection, returned = self._idle.pop()
+                    if self.timer() - returned > self.max_idle:
+                        self._size = self._size - 1
+                        self._count('closed')
+                        expired.append(connection)
+                        continue
+                    return connection
+                if self._size < self.max_size:
+                    self._size = self._size + 1
+                    return None
+                remaining = deadline - self.timer()
+                if remaining <= 0:
+                    self._count('timeouts')
+                    raise PoolTimeout("No free connection after %s seconds" %
+                                      self.timeout)
+                self._count('waits')
+                self._condition.wait(remaining)
+        finally:
+            self._condition.release()
+            for connection in expired:
+                self._close(connection)
+
+    def checkin(self, connection):
+        """Give a connection back to the pool"""
+        self._condition.acquire()
+        try:
+            self._idle.append((connection, self.timer()))
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def discard(self, connection):
+        """Close a broken connection instead of giving it back.
+
+        None is passed if opening a new connection failed.
+        """
+        if connection is None:
+            self._drop(None, None)
+        else:
+            self._drop(connection, 'closed')
+
+    def _drop(self, connection, metric):
+        """Close a connection, or give up the place reserved for it, and
+        count it in the metric"""
+        if not connection is None:
+            self._close(connection)
+        self._condition.acquire()
+        try:
+            self._size = self._size - 1
+            if not metric is None:
+                self._count(metric)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def query(self, sql, args=None):
+        """Run the query on a connection of the pool and return the rows"""
+        for attempt in (1, 2):
+            connection = self.checkout()
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(sql, args)
+                    result = Result(cursor.fetchall(),
+                                    cursor.description,
+                                    cursor.rowcount)
+                finally:
+                    cursor.close()
+            except MySQLdb.OperationalError, err:
+                if not err.args or not err.args[0] in CONNECTION_ERRORS:
+                    self.checkin(connection)
+                    raise
+                # The connection is broken, so try once more with a new one
+                self.discard(connection)
+                if attempt == 2:
+                    raise
+                continue
+            except:
+                self.checkin(connection)
+                raise
+            self.checkin(connection)
+            self._condition.acquire()
+            try:
+                self._count('queries')
+            finally:
+                self._condition.release()
+            return result
+
+    def close(self):
+        """Close all connections that are not in use"""
+        self._condition.acquire()
+        try:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._size = self._size - 1
+                self._close(connection)
+        finally:
+            self._condition.release()
+
+    def stats(self):
+        """Return the metrics together with the current number of
+        connections"""
+        self._condition.acquire()
+        try:
+            stats = dict(self.metrics)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['max_size'] = self.max_size
+        finally:
+            self._condition.release()
+        return stats
+
+
+def get_pool(database):
+    """Return the pool for the database of a raisin.mysqldb DB instance.
+
+    The pools are kept by database, server, port and user. The password is
+    not part of the key, so it is never shown with the pool statistics.
+    """
+    connection = database.connection
+    key = (database.database,
+           connection['server'],
+           str(connection['port']),
+           connection['user'])
+    POOLS_LOCK.acquire()
+    try:
+        if not key in POOLS:
+            def connect():
+                """Open a new connection to the database"""
+                return MySQLdb.connect(host=connection['server'],
+                                       port=int(connection['port']),
+                                       user=connection['user'],
+                                       passwd=connection['password'],
+                                       db=database.database)
+            POOLS[key] = ConnectionPool(connect, **POOL_OPTIONS)
+        return POOLS[key]
+    finally:
+        POOLS_LOCK.release()
+
+
+def pooled_dbs(dbs):
+    """Return the databases of the projects with the DB instances replaced by
+    connection pools.
+
+    Other values, like the download locations, are kept as they are.
+    """
+    result = {}
+    for projectid, databases in dbs.items():
+        result[projectid] = {}
+        for name, database in databases.items():
+            if hasattr(database, 'database') and \
+               hasattr(database, 'connection'):
+                database = get_pool(database)
+            result[projectid][name] = database
+    return result
+
+
+def get_pool_stats():
+    """Return the metrics of all pools by database name.
+
+    The servers and users are left out. When a database is reached through
+    several pools, the pools after the first are numbered, as in
+    Demo_RNAseqPipeline#2.
+    """
+    POOLS_LOCK.acquire()
+    try:
+        pools = sorted(POOLS.items())
+    finally:
+        POOLS_LOCK.release()
+    result = {}
+    for key, pool in pools:
+        name = key[0]
+        count = 1
+        while name in result:
+            count = count + 1
+            name = '%s#%s' % (key[0], count)
+        result[name] = pool.stats()
+    return result
+
+
+def close_pools():
+    """Close the unused connections of all pools"""
+    POOLS_LOCK.acquire()
+    try:
+        for pool in POOLS.values():
+            pool.close()
+    finally:
+        POOLS_LOCK.release()
+atexit.register(close_pools)
@@ -8,6 +8,7 @@ from raisin.resource.utils import register_resource
 from raisin.resource.utils import get_dashboard_db
 from raisin.resource.utils import get_experiment_dict
 from raisin.resource.utils import escape_html
+from raisin.resource.queries import fetch_all
 
 # http://genome-test.cse.ucsc.edu/ENCODE/otherTerms.html#sex
 # XXX Needs to be verified
@@ -33,11 +34,11 @@ def info(dbs, confs):
 select proj_description,
        species
 from projects
-where project_id='%(projectid)s';
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+where project_id=%s;
+"""
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipelineCommon'],
+                     sql,
+                     (conf['projectid'], ))
     chart['table_data'] = rows
     return chart
 
@@ -77,9 +78,7 @@ select name,
        description,
        descriptionUrl
 from technology"""
-    cursor = dashboard_db.query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dashboard_db, sql)
     results = []
     for row in rows:
         results.append((row[0], row[1], escape_html(row[2]), row[3]))
@@ -104,10 +103,7 @@ select ucscName,
        displayName,
        description
 from rnaExtract"""
-    cursor = dashboard_db.query(sql)
-
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dashboard_db, sql)
     chart['table_data'] = rows
     return chart
 
@@ -129,10 +125,7 @@ select ucscName,
        displayName,
        description
 from localization"""
-    cursor = dashboard_db.query(sql)
-
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dashboard_db, sql)
     chart['table_data'] = rows
     return chart
 
@@ -162,9 +155,7 @@ select file.url,
 from
     file
 """
-    cursor = dashboard_db.query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dashboard_db, sql)
     chart['table_data'] = rows
     return chart
 
@@ -260,10 +251,7 @@ AND
       sample.rnaExtract = rnaExtract.ucscName
 AND
       sample.cell = cell.ucscName"""
-    cursor = dashboard_db.query(sql)
-
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dashboard_db, sql)
 
     results = []
     for row in rows:
@@ -341,8 +329,8 @@ def _rnadashboard_results(dbs, confs):
     chart = {}
     description = _rnadashboard_results_description()
     description_keys = [d[0] for d in description]
-    wheres = _rnadashboard_results_wheres(confs)
-    rows = _rnadashboard_results_sql(dbs, confs, wheres)
+    wheres, args = _rnadashboard_results_wheres(confs)
+    rows = _rnadashboard_results_sql(dbs, confs, wheres, args)
     restricted = _rnadashboard_results_restricted(rows, description_keys)
     results = []
     for rest in restricted:
@@ -406,32 +394,38 @@ def _rnadashboard_results_restricted(rows, description_keys):
 
 
 def _rnadashboard_results_wheres(confs):
-    """Return the RNA dashboard where clause."""
+    """Return the RNA dashboard where clause and the values for its
+    arguments."""
     wheres = ""
+    args = []
     meta = get_experiment_dict(confs)
     if 'cell' in meta:
         wheres = wheres + """
 AND
-    sample.cell = '%(cell)s'""" % meta
+    sample.cell = %s"""
+        args.append(meta['cell'])
 
     if 'localization' in meta:
         wheres = wheres + """
 AND
-    sample.localization = '%(localization)s'""" % meta
+    sample.localization = %s"""
+        args.append(meta['localization'])
 
     if 'rnaExtract' in meta:
         wheres = wheres + """
 AND
-    sample.rnaExtract = '%(rnaExtract)s'""" % meta
+    sample.rnaExtract = %s"""
+        args.append(meta['rnaExtract'])
 
     if 'lab' in meta:
         wheres = wheres + """
 AND
-    file.lab = '%(lab)s'""" % meta
-    return wheres
+    file.lab = %s"""
+        args.append(meta['lab'])
+    return wheres, args
 
 
-def _rnadashboard_results_sql(dbs, confs, wheres=""):
+def _rnadashboard_results_sql(dbs, confs, wheres="", args=None):
     """Query the database for the RNA dashboard."""
     hgversion = confs['configurations'][0]['hgversion']
     dashboard_db = get_dashboard_db(dbs, hgversion)
@@ -491,9 +485,7 @@ AND
 AND
       sample.cell = cell.ucscName
 %s""" % wheres
-    cursor = dashboard_db.query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dashboard_db, sql, args)
     return rows
 
 
@@ -568,8 +560,8 @@ def _rnadashboard_accessions(dbs, confs):
 
     chart['table_description'] = description
 
-    wheres = _rnadashboard_results_wheres(confs)
-    fastqs = _fastqs(dbs, confs, wheres)
+    wheres, args = _rnadashboard_results_wheres(confs)
+    fastqs = _fastqs(dbs, confs, wheres, args)
 
     accession_fastqs = {}
 
@@ -636,7 +628,7 @@ def _parse_all_attributes(all_attributes):
     return result
 
 
-def _fastqs(dbs, confs, wheres=""):
+def _fastqs(dbs, confs, wheres="", args=None):
     """Return the fastq files only."""
     hgversion = confs['configurations'][0]['hgversion']
     dashboard_db = get_dashboard_db(dbs, hgversion)
@@ -705,9 +697,7 @@ AND
 AND
       technology.name = "RNASEQ"
 %s""" % (",".join(selects), wheres)
-    cursor = dashboard_db.query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dashboard_db, sql, args)
     result = []
     for row in rows:
         result.append(dict(zip(selects, row)))
@@ -758,8 +748,8 @@ def rnadashboard_results_pending(dbs, confs):
     """Return the RNA dashboard replicates pending in the pipeline."""
     description = _rnadashboard_results_description()
     description_keys = [d[0] for d in description]
-    wheres = _rnadashboard_results_wheres(confs)
-    rows = _rnadashboard_results_sql(dbs, confs, wheres)
+    wheres, args = _rnadashboard_results_wheres(confs)
+    rows = _rnadashboard_results_sql(dbs, confs, wheres, args)
     restricted = _rnadashboard_results_restricted(rows, description_keys)
     results = {}
     for rest in restricted:
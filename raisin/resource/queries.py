@@ -0,0 +1,84 @@
+"""Helpers for building and running the SQL queries of the resources
+
+Values are never put into the SQL text. They are passed as arguments to the
+query, and the database driver quotes them. Only identifiers, like the names
+of the replicate tables and of the lane columns, are put into the SQL text,
+and only after checking that they consist of safe characters.
+
+When arguments are passed, the driver substitutes them using the % operator,
+so a literal % in the SQL has to be written as %%.
+"""
+
+import re
+import time
+from instrumentation import record_query
+
+# Characters allowed in table names, like the project and replicate ids
+TABLE_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+
+# Characters allowed in column names, like the lane ids
+COLUMN_NAME = re.compile(r'^[A-Za-z0-9_.]+$')
+
+
+def table_name(*parts):
+    """Return the name of a table made of the parts joined by underscores.
+
+    >>> table_name('LID8465', 'TopHat', 'dataset')
+    'LID8465_TopHat_dataset'
+    """
+    name = '_'.join(parts)
+    if TABLE_NAME.match(name) is None:
+        raise ValueError("Not a valid table name: %r" % name)
+    return name
+
+
+def replicate_table(conf, suffix):
+    """Return the name of a table of the replicate of a configuration"""
+    return table_name(conf['projectid'], conf['replicateid'], suffix)
+
+
+def rollup_table(projectid):
+    """Return the name of the table holding the rollups of a project"""
+    return table_name(projectid, 'rollup')
+
+
+def column_name(name):
+    """Return the quoted name of a column.
+
+    >>> column_name('001N.1')
+    '`001N.1`'
+    """
+    if COLUMN_NAME.match(name) is None:
+        raise ValueError("Not a valid column name: %r" % name)
+    return '`%s`' % name
+
+
+def placeholders(values):
+    """Return the placeholders for a list of values, as used with in (...)
+
+    >>> placeholders(['a', 'b', 'c'])
+    '%s, %s, %s'
+    """
+    return ', '.join(['%s'] * len(values))
+
+
+def fetch_all(database, sql, args=None):
+    """Run the query with the arguments and return all rows.
+
+    The query is recorded in the statistics of the current request.
+    """
+    started = time.time()
+    cursor = database.query(sql, args)
+    rows = cursor.fetchall()
+    cursor.close()
+    record_query(time.time() - started, len(rows))
+    return rows
+
+
+def execute(database, sql, args=None):
+    """Run a statement changing the database and commit it"""
+    cursor = database.query(sql, args)
+    cursor.close()
+    connection = getattr(database, 'conn', None)
+    if not connection is None:
+        connection.commit()
@@ -1,17 +1,24 @@
 """Summary statistics related to read quality"""
 
+from restish import http
 from utils import register_resource
-from utils import aggregate
+from utils import aggregate_batched
+from utils import aggregate_reads
+from utils import register_rollup
+from utils import get_lane_name_rows
+from utils import pivot_partitions
+from reduction import add
+from queries import fetch_all
+from queries import replicate_table
 
 
-@register_resource(resolution="read", partition=False)
+@register_resource(resolution="read", partition=False, rollup=True)
 def read_summary(dbs, confs):
     """Return the read summary table"""
     chart = {}
     method = _read_summary
     configurations = confs['configurations']
-    stats, failed = aggregate(dbs, configurations, method, lambda x, y: x + y)
-    average_by = len(configurations) - failed
+    stats, average_by = aggregate_reads(dbs, configurations, method)
     if average_by == 0:
         label = ''
     elif average_by == 1:
@@ -27,29 +34,29 @@ def read_summary(dbs, confs):
     return chart
 
 
-def _read_summary(dbs, conf):
+def _read_summary(dbs, confs):
     """Query the database for the read summary table"""
-    # Add a line for the totals
-    sql = """
-select
-    TotalReads,
-    NoAmbiguousBases,
-    AmbiguousBases,
-    UniqueReads
-from
-    %(projectid)s_%(replicateid)s_read_stats
-where
-     LaneName = '%(readid)s'
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    data = {'total': rows[0][0],
-            'unambiguous': rows[0][1],
-            'ambiguous': rows[0][2],
-            'unique': rows[0][3],
-            }
-    return data
+    columns = ['TotalReads',
+               'NoAmbiguousBases',
+               'AmbiguousBases',
+               'UniqueReads',
+               ]
+    rows = get_lane_name_rows(dbs, confs, 'read_stats', columns)
+    result = []
+    for conf in confs:
+        row = rows.get(conf['readid'], None)
+        if row is None:
+            result.append(http.not_found)
+        else:
+            result.append({'total': row[0],
+                           'unambiguous': row[1],
+                           'ambiguous': row[2],
+                           'unique': row[3],
+                           })
+    return result
+
+
+register_rollup(_read_summary)
 
 
 def _percentage_read_summary(data, average_by):
@@ -94,7 +101,7 @@ def reads_containing_ambiguous_nucleotides(dbs, confs):
 def _partition_reads_containing_ambiguous_nucleotides(dbs, confs, partition_id):
     """Return reads containing ambiguous nucleotides for the partition"""
     method = _reads_containing_ambiguous_nucleotides
-    stats, failed = aggregate(dbs, confs, method, lambda x, y: x + y)
+    stats, failed = aggregate_batched(dbs, confs, method, add)
     if len(confs) - failed == 0:
         percent = None
     else:
@@ -104,24 +111,22 @@ def _partition_reads_containing_ambiguous_nucleotides(dbs, confs, partition_id):
     return [partition_id, percent]
 
 
-def _reads_containing_ambiguous_nucleotides(dbs, conf):
+def _reads_containing_ambiguous_nucleotides(dbs, confs):
     """Query the database for reads containing ambiguous nucleotides"""
-    sql = """
-select
-    TotalReads,
-    AmbiguousBases
-from
-    %(projectid)s_%(replicateid)s_read_stats
-where
-     LaneName = '%(readid)s'
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    data = {'total_number_of_reads': rows[0][0],
-            'reads_containing_ambiguous_nucleotides': rows[0][1],
-            }
-    return data
+    columns = ['TotalReads',
+               'AmbiguousBases',
+               ]
+    rows = get_lane_name_rows(dbs, confs, 'read_stats', columns)
+    result = []
+    for conf in confs:
+        row = rows.get(conf['readid'], None)
+        if row is None:
+            result.append(http.not_found)
+        else:
+            result.append({'total_number_of_reads': row[0],
+                           'reads_containing_ambiguous_nucleotides': row[1],
+                           })
+    return result
 
 
 @register_resource(resolution="read", partition=True)
@@ -147,7 +152,7 @@ def reads_containing_only_unambiguous_nucleotides(dbs, confs):
 def _p_reads_containing_only_unambiguous_nucleotides(dbs, confs, partition_id):
     """Return reads containing only unambiguous nucleotides of the partition"""
     method = _reads_containing_only_unambiguous_nucleotides
-    stats, failed = aggregate(dbs, confs, method, lambda x, y: x + y)
+    stats, failed = aggregate_batched(dbs, confs, method, add)
     if len(confs) - failed == 0:
         percent = None
     else:
@@ -157,24 +162,22 @@ def _p_reads_containing_only_unambiguous_nucleotides(dbs, confs, partition_id):
     return [partition_id, percent]
 
 
-def _reads_containing_only_unambiguous_nucleotides(dbs, conf):
+def _reads_containing_only_unambiguous_nucleotides(dbs, confs):
     """Query the datavase for reads containing only unambiguous nucleotides"""
-    sql = """
-select
-    TotalReads,
-    NoAmbiguousBases
-from
-    %(projectid)s_%(replicateid)s_read_stats
-where
-     LaneName = '%(readid)s'
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    data = {'total_number_of_reads': rows[0][0],
-            'reads_containing_only_unambiguous_nucleotides': rows[0][1],
-            }
-    return data
+    columns = ['TotalReads',
+               'NoAmbiguousBases',
+               ]
+    rows = get_lane_name_rows(dbs, confs, 'read_stats', columns)
+    result = []
+    for conf in confs:
+        row = rows.get(conf['readid'], None)
+        if row is None:
+            result.append(http.not_found)
+        else:
+            result.append({'total_number_of_reads': row[0],
+                           'reads_containing_only_unambiguous_nucleotides': row[1],
+                           })
+    return result
 
 
 @register_resource(resolution="read", partition=True)
@@ -197,10 +200,10 @@ def average_percentage_of_unique_reads(dbs, confs):
 
 def _partition_average_percentage_of_unique_reads(dbs, confs, partition_id):
     """Return the average percentage of unique reads for the partition"""
-    stats, failed = aggregate(dbs,
-                              confs,
-                              _average_percentage_of_unique_reads,
-                              lambda x, y: x + y)
+    stats, failed = aggregate_batched(dbs,
+                                      confs,
+                                      _average_percentage_of_unique_reads,
+                                      add)
 
     average_by = len(confs) - failed
 
@@ -214,24 +217,22 @@ def _partition_average_percentage_of_unique_reads(dbs, confs, partition_id):
     return [partition_id, percent]
 
 
-def _average_percentage_of_unique_reads(dbs, conf):
+def _average_percentage_of_unique_reads(dbs, confs):
     """Query the average percentage of unique reads"""
-    sql = """
-select
-    TotalReads,
-    UniqueReads
-from
-    %(projectid)s_%(replicateid)s_read_stats
-where
-     LaneName = '%(readid)s'
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    data = {'total_number_of_reads': rows[0][0],
-            'unique_reads': rows[0][1],
-            }
-    return data
+    columns = ['TotalReads',
+               'UniqueReads',
+               ]
+    rows = get_lane_name_rows(dbs, confs, 'read_stats', columns)
+    result = []
+    for conf in confs:
+        row = rows.get(conf['readid'], None)
+        if row is None:
+            result.append(http.not_found)
+        else:
+            result.append({'total_number_of_reads': row[0],
+                           'unique_reads': row[1],
+                           })
+    return result
 
 
 @register_resource(resolution="read", partition=True)
@@ -263,10 +264,10 @@ def total_ambiguous_and_unambiguous_reads(dbs, confs):
 
 def _partition_total_ambiguous_and_unambiguous_reads(dbs, confs, partition_id):
     """Return the total ambiguous and unambiguous reads for the partition"""
-    stats, failed = aggregate(dbs,
-                              confs,
-                              _total_ambiguous_and_unambiguous_reads,
-                              lambda x, y: x + y)
+    stats, failed = aggregate_batched(dbs,
+                                      confs,
+                                      _total_ambiguous_and_unambiguous_reads,
+                                      add)
     if failed:
         unambiguous = None
         ambiguous = None
@@ -278,27 +279,24 @@ def _partition_total_ambiguous_and_unambiguous_reads(dbs, confs, partition_id):
     return [partition_id, total, unambiguous, ambiguous]
 
 
-def _total_ambiguous_and_unambiguous_reads(dbs, conf):
+def _total_ambiguous_and_unambiguous_reads(dbs, confs):
     """Query the database for the total ambiguous and unambiguous reads"""
-    # Add a line for the totals
-    sql = """
-select
-    TotalReads,
-    NoAmbiguousBases,
-    AmbiguousBases
-from
-    %(projectid)s_%(replicateid)s_read_stats
-where
-     LaneName = '%(readid)s'
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    data = {'total': rows[0][0],
-            'unambiguous': rows[0][1],
-            'ambiguous': rows[0][2],
-            }
-    return data
+    columns = ['TotalReads',
+               'NoAmbiguousBases',
+               'AmbiguousBases',
+               ]
+    rows = get_lane_name_rows(dbs, confs, 'read_stats', columns)
+    result = []
+    for conf in confs:
+        row = rows.get(conf['readid'], None)
+        if row is None:
+            result.append(http.not_found)
+        else:
+            result.append({'total': row[0],
+                           'unambiguous': row[1],
+                           'ambiguous': row[2],
+                           })
+    return result
 
 
 @register_resource(resolution="read", partition=True)
@@ -323,10 +321,10 @@ def average_and_average_unique_reads(dbs, confs):
 
 def _partition_average_and_average_unique_reads(dbs, confs, partition_id):
     """Return the average and average unique reads for the partition"""
-    stats, failed = aggregate(dbs,
-                              confs,
-                              _average_and_average_unique_reads,
-                              lambda x, y: x + y)
+    stats, failed = aggregate_batched(dbs,
+                                      confs,
+                                      _average_and_average_unique_reads,
+                                      add)
     average_by = len(confs) - failed
     if average_by == 0:
         unique = None
@@ -337,25 +335,22 @@ def _partition_average_and_average_unique_reads(dbs, confs, partition_id):
     return [partition_id, total, unique]
 
 
-def _average_and_average_unique_reads(dbs, conf):
+def _average_and_average_unique_reads(dbs, confs):
     """Query the database for the average and average unique reads"""
-    # Add a line for the totals
-    sql = """
-select
-    TotalReads,
-    UniqueReads
-from
-    %(projectid)s_%(replicateid)s_read_stats
-where
-     LaneName = '%(readid)s'
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    data = {'total': rows[0][0],
-            'unique': rows[0][1],
-            }
-    return data
+    columns = ['TotalReads',
+               'UniqueReads',
+               ]
+    rows = get_lane_name_rows(dbs, confs, 'read_stats', columns)
+    result = []
+    for conf in confs:
+        row = rows.get(conf['readid'], None)
+        if row is None:
+            result.append(http.not_found)
+        else:
+            result.append({'total': row[0],
+                           'unique': row[1],
+                           })
+    return result
 
 
 @register_resource(resolution="read", partition=True)
@@ -369,26 +364,14 @@ def quality_score_by_position(dbs, confs):
         description.append((partition, 'number'))
     chart['table_description'] = description
 
-    result = []
-    partition_length = len(partition_keys)
+    points = []
     for partition in partition_keys:
         partition_index = partition_keys.index(partition)
         for partition_conf in confs['configurations'][partition]:
             for pos, mean in _quality_score_by_position(dbs, partition_conf):
-                found = False
-                for res in result:
-                    if res[0] == pos and res[partition_index + 1] == None:
-                        res[partition_index + 1] = mean
-                        found = True
-                        break
-                if found:
-                    pass
-                else:
-                    line = [None] * partition_length
-                    line[partition_index] = mean
-                    result.append([pos] + line)
+                points.append((partition_index, pos, mean))
 
-    chart['table_data'] = result
+    chart['table_data'] = pivot_partitions(points, len(partition_keys))
     return chart
 
 
@@ -399,15 +382,15 @@ select
     position,
     mean
 from
-    %(projectid)s_%(replicateid)s_qualitiespos
+    %s
 where
-    LaneName = '%(readid)s'
+    LaneName = %%s
 order by
     position
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+""" % replicate_table(conf, 'qualitiespos')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'],
+                     sql,
+                     (conf['readid'], ))
     return rows
 
 
@@ -422,26 +405,14 @@ def ambiguous_bases_per_position(dbs, confs):
         description.append((partition, 'number'))
     chart['table_description'] = description
 
-    result = []
-    partition_length = len(partition_keys)
+    points = []
     for partition in partition_keys:
         partition_index = partition_keys.index(partition)
         for partition_conf in confs['configurations'][partition]:
             for pos, amb in _ambiguous_bases_per_position(dbs, partition_conf):
-                found = False
-                for res in result:
-                    if res[0] == pos and res[partition_index + 1] == None:
-                        res[partition_index + 1] = amb
-                        found = True
-                        break
-                if found:
-                    pass
-                else:
-                    line = [None] * partition_length
-                    line[partition_index] = amb
-                    result.append([pos] + line)
+                points.append((partition_index, pos, amb))
 
-    chart['table_data'] = result
+    chart['table_data'] = pivot_partitions(points, len(partition_keys))
     return chart
 
 
@@ -452,13 +423,13 @@ select
     position,
     ambiguous
 from
-    %(projectid)s_%(replicateid)s_ambiguous
+    %s
 where
-    LaneName = '%(readid)s'
+    LaneName = %%s
 order by
     position
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+""" % replicate_table(conf, 'ambiguous')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'],
+                     sql,
+                     (conf['readid'], ))
     return rows
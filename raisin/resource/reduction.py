@@ -0,0 +1,32 @@
+"""Reduction of the results of several configurations into one result
+
+The results are dictionaries of numbers, one per configuration, that are
+summed up key by key into one dictionary. Summing them up with NumPy was
+tried, but loading the dictionaries into arrays takes longer than adding up
+the values in Python.
+"""
+
+
+def add(value_1, value_2):
+    """Strategy adding up two values, used for summing up results"""
+    return value_1 + value_2
+
+
+def sum_results(results):
+    """Sum up a list of result dictionaries key by key, or return None if
+    there are no results.
+
+    The values of a key are added in the order of the results, so the sums
+    are the same as when merging the dictionaries one after the other using
+    the add strategy. Missing keys count as zero.
+    """
+    if not results:
+        return None
+    stats = dict(results[0])
+    for data in results[1:]:
+        for key, value in data.iteritems():
+            if key in stats:
+                stats[key] = stats[key] + value
+            else:
+                stats[key] = value
+    return stats
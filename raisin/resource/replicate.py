@@ -1,6 +1,6 @@
 """Experiment level resources"""
 
-from utils import run
+from utils import run_projects
 from utils import get_rna_extract_display_mapping
 from utils import get_cell_display_mapping
 from utils import get_localization_display_mapping
@@ -12,7 +12,9 @@ from utils import get_experiment_result
 from utils import get_experiment_order_by
 from utils import get_experiment_labels
 from utils import get_experiment_where
+from utils import get_experiment_info
 from utils import register_resource
+from queries import fetch_all
 
 from project import rnadashboard_results_pending
 
@@ -44,102 +46,10 @@ def experiment_info(dbs, confs):
 
     meta = get_experiment_dict(confs)
 
-    result = []
-
-    sql = """
-select experiment_id,
-       project_id,
-       species_id,
-       genome_id,
-       annotation_id,
-       template_file,
-       read_length,
-       mismatches,
-       exp_description,
-       expDate,
-       CellType,
-       RNAType,
-       Compartment,
-       Bioreplicate,
-       partition,
-       paired
-from experiments
-%s
-order by
-    experiment_id;""" % get_experiment_where(confs, meta)
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-
-    if not rows:
-        chart['table_data'] = [[None] * len(chart['table_description'])]
-        return chart
-
-    species_id = rows[0][2]
-    genome_id = rows[0][3]
-    annotation_id = rows[0][4]
-    result.append(int(rows[0][6]))
-    result.append(int(rows[0][7]))
-    result.append(rows[0][8])
-    result.append(str(rows[0][9]))
-    # Use labels instead of the raw values
-    mapping = get_cell_display_mapping(dbs)
-    result.append(mapping.get(rows[0][10], rows[0][10]))
-    mapping = get_rna_extract_display_mapping(dbs)
-    result.append(mapping.get(rows[0][11], rows[0][11]))
-    mapping = get_localization_display_mapping(dbs)
-    result.append(mapping.get(rows[0][12], rows[0][12]))
-    result.append(rows[0][13])
-    result.append(rows[0][14])
-    result.append(rows[0][15])
-    if not result[-1] is None:
-        result[-1] = ord(result[-1])
-
-    sql = """
-select species_id,
-       species,
-       genus,
-       sp_alias,
-       abbreviation
-from species_info
-where species_id='%s'
-""" % species_id
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    result.append(rows[0][1])
-
-    sql = """
-select annotation_id,
-       species_id,
-       annotation,
-       location,
-       version,
-       source
-from annotation_files where annotation_id='%s'
-""" % annotation_id
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    result.append(rows[0][4])
-    result.append(rows[0][5])
-
-    sql = """
-select genome_id,
-       species_id,
-       genome,
-       location,
-       assembly,
-       source,
-       gender
-from genome_files where genome_id='%s'
-""" % genome_id
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    result.append(rows[0][4])
-    result.append(rows[0][5])
-    result.append(rows[0][6])
+    where, args = get_experiment_where(confs, meta, 'experiments')
+    result = get_experiment_info(dbs, conf['projectid'], where, args)
+    if result is None:
+        result = [None] * len(chart['table_description'])
     chart['table_data'] = [result, ]
     return chart
 
@@ -165,13 +75,7 @@ def experiments(dbs, confs):
                                   ('Description', 'string'),
                                   ]
 
-    results = []
-    for projectid in dbs.keys():
-        rows, success = run(dbs, _experiments, {'projectid': projectid})
-        if success:
-            results = results + list(rows)
-
-    chart['table_data'] = results
+    chart['table_data'] = run_projects(dbs, _experiments)
     return chart
 
 
@@ -197,7 +101,7 @@ from experiments,
      genome_files,
      annotation_files
 where
-      project_id = '%(projectid)s'
+      project_id = %s
 and
       experiments.species_id = species_info.species_id
 and
@@ -205,10 +109,10 @@ and
 and
       experiments.annotation_id = annotation_files.annotation_id
 order by
-     experiment_id;""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+     experiment_id;"""
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipelineCommon'],
+                     sql,
+                     (conf['projectid'], ))
     return rows
 
 
@@ -242,15 +146,7 @@ def replicates_configurations(dbs, confs):
                                   ('Paired', 'number'),
                                   ]
 
-    results = []
-    for projectid in dbs.keys():
-        rows, success = run(dbs,
-                            _replicates_configurations,
-                            {'projectid': projectid})
-        if success:
-            results = results + list(rows)
-
-    chart['table_data'] = results
+    chart['table_data'] = run_projects(dbs, _replicates_configurations)
     return chart
 
 
@@ -267,9 +163,7 @@ select project_id,
        partition,
        paired
 from experiments;"""
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipelineCommon'], sql)
     results = []
     for row in rows:
         row = list(row)
@@ -341,17 +235,17 @@ from experiments,
      genome_files,
      annotation_files
 where
-      project_id='%s'
+      project_id=%s
 and
       experiments.species_id = species_info.species_id
 and
       experiments.genome_id = genome_files.genome_id
 and
       experiments.annotation_id = annotation_files.annotation_id;
-""" % projectid
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+"""
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipelineCommon'],
+                     sql,
+                     (projectid, ))
     results = []
     url = '/project/%(projectid)s/'
     url += '%(parameter_list)s/%(parameter_values)s'
@@ -449,16 +343,19 @@ from experiments,
 """
     if where:
         meta = get_experiment_dict(confs)
+        experiment_where, args = get_experiment_where(confs, meta,
+                                                      'experiments')
         sql = """%s
 %s
 and
-""" % (sql, get_experiment_where(confs, meta))
+""" % (sql, experiment_where)
     else:
         sql = """%s
 where
-    project_id = '%s'
+    experiments.project_id = %%s
 and
-""" % (sql, conf['projectid'])
+""" % sql
+        args = (conf['projectid'], )
 
     sql = """%s
       experiments.species_id = species_info.species_id
@@ -471,9 +368,9 @@ and
     sql = """%s
 %s""" % (sql, get_experiment_order_by(confs))
 
-    cursor = dbs[conf['projectid']]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipelineCommon'],
+                     sql,
+                     args)
     experimentids = {}
 
     rna_extracts = get_rna_extract_display_mapping(dbs)
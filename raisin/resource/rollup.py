@@ -0,0 +1,138 @@
+"""Building the rollup tables of the projects
+
+Statistics like the read summary are sums over the reads. At the project and
+experiment levels, they are computed by expanding every replicate down to its
+lanes and reads, and running one query per replicate and statistic.
+
+After a Grape run has finished, build_rollups sums up the methods registered
+with register_rollup per replicate, and stores the sums and the number of
+reads found in the rollup table of the project:
+
+    raisin-resource-rollup --database Demo_RNAseqPipeline \\
+                           --common-database Demo_RNAseqPipelineCommon Demo
+
+The resources registered with rollup=True then read the sums of all
+replicates of a project or experiment in one query, see aggregate_reads.
+Replicates missing from the rollup table are still summed up from their
+reads, so the table has to be built again when the replicate tables change,
+but can be built at any time.
+"""
+
+import sys
+import optparse
+# The resources register the methods to roll up when they are imported
+import root  # pylint: disable-msg=W0611
+from reduction import add
+from queries import execute
+from queries import rollup_table
+from utils import run
+from utils import aggregate_batched
+from utils import get_experiment_replicates
+from utils import configurations_for_lanes_and_reads
+from utils import ROLLUP_FOUND
+from utils import ROLLUP_REGISTRY
+
+
+def build_rollups(dbs, projectid, replicateids=None):
+    """Store the sums of the registered methods for replicates of a project.
+
+    All replicates of the project are summed up, unless a list of replicate
+    ids is given. The rows stored before for these replicates are replaced.
+
+    Returns the number of replicates stored.
+    """
+    database = dbs[projectid]['RNAseqPipeline']
+    if replicateids is None:
+        replicateids = get_experiment_replicates(dbs,
+                                                 {'kwargs':
+                                                  {'projectid': projectid}})
+    table = rollup_table(projectid)
+    execute(database, """
+create table if not exists %s (
+    replicateid varchar(100) not null,
+    statistic varchar(100) not null,
+    name varchar(100) not null,
+    value bigint not null,
+    primary key (replicateid, statistic, name)
+)""" % table)
+    stored = 0
+    for replicateid in replicateids:
+        conf = {'projectid': projectid, 'replicateid': replicateid}
+        errors = []
+        read_confs = configurations_for_lanes_and_reads(dbs, [conf], errors)
+        if errors:
+            print "Can't find the reads of replicate %s." % replicateid
+            continue
+        rows = []
+        for name in sorted(ROLLUP_REGISTRY):
+            data, success = run(dbs, _rollup_rows, {'name': name,
+                                                    'replicateid': replicateid,
+                                                    'confs': read_confs})
+            if success:
+                rows.extend(data)
+        execute(database,
+                "delete from %s where replicateid = %%s" % table,
+                (replicateid, ))
+        if rows:
+            values = ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+            execute(database,
+                    "insert into %s values %s" % (table, values),
+                    [value for row in rows for value in row])
+        stored = stored + 1
+    return stored
+
+
+def _rollup_rows(dbs, confs):
+    """Return the rows storing the sums of a method for a replicate"""
+    name = confs['name']
+    replicateid = confs['replicateid']
+    method, kwargs = ROLLUP_REGISTRY[name]
+    # The configurations are updated by aggregate_batched, so pass copies
+    read_confs = [conf.copy() for conf in confs['confs']]
+    stats, failed = aggregate_batched(dbs, read_confs, method, add, **kwargs)
+    rows = [(replicateid, name, ROLLUP_FOUND, len(read_confs) - failed)]
+    for key, value in sorted((stats or {}).items()):
+        if not isinstance(value, (int, long)):
+            raise ValueError("Only integers can be stored: %s %r" %
+                             (name, value))
+        rows.append((replicateid, name, key, value))
+    return rows
+
+
+def main(args=None):
+    """Build the rollup tables of projects in a MySQL database"""
+    from raisin.mysqldb import DB
+    parser = optparse.OptionParser(usage="%prog [options] projectid ...")
+    parser.add_option('--server', default='localhost')
+    parser.add_option('--port', default='3306')
+    parser.add_option('--user', default='')
+    parser.add_option('--password', default='')
+    parser.add_option('--database',
+                      help="the RNAseqPipeline database of the projects")
+    parser.add_option('--common-database', dest='common_database',
+                      help="the RNAseqPipelineCommon database")
+    parser.add_option('--replicate', action='append', dest='replicates',
+                      help="only build the rollups of this replicate")
+    options, projectids = parser.parse_args(args)
+    if not projectids:
+        parser.error("no project given")
+    if not options.database or not options.common_database:
+        parser.error("--database and --common-database are required")
+    connection = {'server': options.server,
+                  'port': options.port,
+                  'user': options.user,
+                  'password': options.password,
+                  }
+    databases = {'RNAseqPipeline': DB(options.database, connection),
+                 'RNAseqPipelineCommon': DB(options.common_database,
+                                            connection),
+                 }
+    dbs = dict((projectid, databases) for projectid in projectids)
+    for projectid in projectids:
+        stored = build_rollups(dbs, projectid, options.replicates)
+        print "%s: stored the rollups of %s replicates" % (projectid, stored)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,12 @@
 """Root object dispatching to restish resources"""
 
+import time
 import pickle
+import hashlib
 import logging
+from email.utils import formatdate
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
 from gvizapi import gviz_api
 from gvizapi.gviz_api import DataTableException
 try:
@@ -26,10 +31,40 @@ import expression
 import splicing
 import discovery
 
-from raisin.mysqldb import run_method_using_mysqldb
 from utils import get_configurations
 from utils import to_cfg
 from utils import remove_chars
+from utils import get_last_modified
+from cache import get_response_cache
+from cache import get_response_cache_key
+from cache import RESPONSES_IN_FLIGHT
+from encoders import iter_csv
+from encoders import to_json
+from encoders import to_columns
+from pool import pooled_dbs
+from pool import get_pool_stats
+from instrumentation import activate
+from instrumentation import start_request
+from instrumentation import finish_request
+from instrumentation import finish_streamed
+from instrumentation import record_span
+from instrumentation import get_statistics
+from instrumentation import run_method_using_mysqldb
+
+# Content types that are written row by row instead of using a DataTable
+STREAMED_SEPARATORS = {'text/csv': ',',
+                       'text/tab-separated-values': '\t',
+                       }
+
+# Content type of the columnar binary format, see encoders.to_columns
+COLUMNAR_CONTENT_TYPE = 'application/x-raisin-columns'
+
+# Content types that are still produced using a DataTable
+DATATABLE_CONTENT_TYPES = ('text/plain',
+                           'text/html',
+                           'text/x-cfg',
+                           'text/x-python-pickled-dict',
+                           )
 
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
@@ -48,6 +83,11 @@ class Root(resource.Resource):
 
     # pylint: disable-msg=R0904
     # Too many methods.
+    @resource.child('_stats')
+    def stats(self, request, segments, **kwargs):
+        """Define resource child"""
+        return StatsResource(), segments
+
     @resource.child('projects')
     def projects(self, request, segments, **kwargs):
         """Define resource child"""
@@ -224,6 +264,7 @@ class Resource(resource.Resource):
         """Keep all information about the resource"""
         default = (None, None, None, None)
         method, level, resolution, partition = STATS_REGISTRY.get(key, default)
+        self.key = key
         self.dbs = {}
         self.method = method
         self.level = level
@@ -278,8 +319,80 @@ class Resource(resource.Resource):
             # The method needs to be set at least
             return http.not_found([('Content-type', 'text/javascript')], '')
 
-        # Inject the project specific project databases
-        self.dbs = request.environ['dbs']
+        stats = start_request(self.key)
+        try:
+            return self.respond(request, stats)
+        finally:
+            # Streamed requests are finished once the body has been written
+            if stats.streamed:
+                activate(None)
+            else:
+                finish_request(stats)
+
+    def respond(self, request, stats):
+        """Return the response, recording the bytes sent into the stats"""
+        accept_header = request.headers.get('Accept', 'text/javascript')
+        response_cache = get_response_cache(request.environ)
+        cache_key = get_response_cache_key(self.key,
+                                           self.kwargs,
+                                           accept_header)
+        response = response_cache.get(cache_key)
+        if response is None:
+            def render():
+                """Render the response and cache it"""
+                response = self.render(request)
+                if isinstance(response, http.Response):
+                    # Responses for missing data are not cached
+                    return response
+                if not response['streamed']:
+                    response_cache.set(cache_key, response)
+                return response
+            if accept_header in STREAMED_SEPARATORS:
+                # Streamed bodies can only be sent once
+                response = render()
+            else:
+                response, shared = RESPONSES_IN_FLIGHT.do(cache_key, render)
+                if shared and (isinstance(response, http.Response) or
+                               response['streamed']):
+                    # Responses can't be shared with other requests
+                    response = render()
+                else:
+                    stats.coalesced = shared
+            if isinstance(response, http.Response):
+                return response
+        else:
+            stats.cache_hit = True
+
+        validators = []
+        if not response['etag'] is None:
+            validators.append(('ETag', response['etag']))
+        if not response['last_modified'] is None:
+            validators.append(('Last-Modified',
+                               formatdate(response['last_modified'],
+                                          usegmt=True)))
+        if is_not_modified(request, response):
+            return http.not_modified(validators)
+
+        headers = [('Content-type', response['content_type'])]
+        body = response['body']
+        if response['streamed']:
+            body = finish_streamed(stats, body)
+        else:
+            headers.append(('Content-Length', len(body)))
+            stats.bytes = len(body)
+        headers.append(('Server-Timing', stats.server_timing()))
+        return http.ok(headers + validators, body)
+
+    def render(self, request):
+        """Run the method and serialize the result.
+
+        Returns a dictionary with the content type, the body and the
+        validators used for conditional requests, or a not found response
+        if there is no data.
+        """
+        # Inject the project specific project databases, using a pool of
+        # connections for each of them
+        self.dbs = pooled_dbs(request.environ['dbs'])
 
         # Get the configurations for the given level of detail
         confs = get_configurations(request,
@@ -308,9 +421,34 @@ class Resource(resource.Resource):
 
         accept_header = request.headers.get('Accept', 'text/javascript')
         body = None
+        last_modified = get_last_modified(self.dbs, confs)
+
+        started = time.time()
 
         # Different results are returned depending on whether this is a table
-        if 'table_description' in data and 'table_data' in data:
+        is_table = 'table_description' in data and 'table_data' in data
+        if is_table and accept_header in STREAMED_SEPARATORS:
+            # Large tables are written while they are sent, so there is no
+            # body to cache or to compute an ETag from.
+            separator = STREAMED_SEPARATORS[accept_header]
+            return {'content_type': accept_header,
+                    'body': iter_csv(data, separator=separator),
+                    'streamed': True,
+                    'etag': None,
+                    'last_modified': last_modified,
+                    }
+        elif is_table and accept_header == COLUMNAR_CONTENT_TYPE:
+            body = to_columns(data)
+        elif is_table and not accept_header in DATATABLE_CONTENT_TYPES:
+            # The default JSON format is written without a DataTable
+            try:
+                body = to_json(data)
+            except DataTableException:
+                print self.method
+                print data['table_description']
+                print data['table_data']
+                raise
+        elif is_table:
             #print "Extract table info and return info"
             # This chart is using the google visualization library
             table = gviz_api.DataTable(data['table_description'])
@@ -325,22 +463,8 @@ class Resource(resource.Resource):
                 body = table.ToHtml()
             elif accept_header == 'text/x-cfg':
                 body = to_cfg(data)
-            elif accept_header == 'text/csv':
-                body = table.ToCsv()
-            elif accept_header == 'text/tab-separated-values':
-                body = table.ToCsv(separator="\t")
             elif accept_header == 'text/x-python-pickled-dict':
                 body = pickle.dumps(data)
-            else:
-                try:
-                    body = table.ToJSon()
-                except DataTableException:
-                    print self.method
-                    print data['table_description']
-                    print data['table_data']
-                    raise
-                except:
-                    raise
         else:
             accept_header = request.headers.get('Accept', None)
             if accept_header == 'text/x-python-pickled-dict':
@@ -348,6 +472,45 @@ class Resource(resource.Resource):
             else:
                 body = json.dumps(data)
 
-        headers = [('Content-type', accept_header),
-                   ('Content-Length', len(body))]
-        return http.ok(headers, body)
+        record_span('serialize', time.time() - started)
+
+        return {'content_type': accept_header,
+                'body': body,
+                'streamed': False,
+                'etag': '"%s"' % hashlib.sha1(body).hexdigest(),
+                'last_modified': last_modified,
+                }
+
+
+class StatsResource(resource.Resource):
+    """The number of queries and the time spent per resource, together with
+    the state of the connection pools"""
+
+    @resource.GET()
+    def show(self, request):
+        """Return the statistics as JSON, if stats_enabled is set in the
+        environ"""
+        if not request.environ.get('stats_enabled', False):
+            return http.not_found()
+        body = json.dumps({'resources': get_statistics(),
+                           'pools': get_pool_stats(),
+                           })
+        return http.ok([('Content-type', 'application/json'),
+                        ('Cache-Control', 'no-cache')], body)
+
+
+def is_not_modified(request, response):
+    """Check the conditional headers of the request against the response"""
+    if_none_match = request.headers.get('If-None-Match', None)
+    if not if_none_match is None:
+        # If-Modified-Since is ignored when If-None-Match is given
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        return '*' in tags or response['etag'] in tags
+    if_modified_since = request.headers.get('If-Modified-Since', None)
+    if if_modified_since is None or response['last_modified'] is None:
+        return False
+    parsed = parsedate_tz(if_modified_since)
+    if parsed is None:
+        return False
+    return response['last_modified'] <= mktime_tz(parsed)
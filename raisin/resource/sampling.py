@@ -0,0 +1,83 @@
+"""Sampling of the points of charts that are too large to be shown
+
+The points are added one at a time, so they never have to be held in memory
+all at once. Only the sample is kept, and its size stays bounded.
+"""
+
+import random
+
+
+class StratifiedSample(object):
+    """Uniform samples of the items added for each key, keeping at most about
+    limit items in total.
+
+    Keys with few items keep all of them, and the keys with more items share
+    the rest of the limit equally, so that rare keys are not lost when the
+    frequent ones are thinned out. Each key is sampled using reservoir
+    sampling. No more than limit items are returned, unless there are more
+    keys than that, in which case one item is kept per key.
+
+    If the limit is None, all items are kept.
+    """
+
+    def __init__(self, limit, rng=random, slack=0.1):
+        self.limit = limit
+        self.rng = rng
+        # The number of items kept per key, None until there are too many
+        self.capacity = None
+        self._samples = {}
+        self._keys = []
+        self._seen = {}
+        self._size = 0
+        # Shrinking is only done once the sample is larger than this, so
+        # that it isn't done again for every added item
+        if not limit is None:
+            self._threshold = limit + max(int(limit * slack), 1)
+
+    def add(self, key, item):
+        """Add an item for the key to the population"""
+        seen = self._seen.get(key, 0) + 1
+        self._seen[key] = seen
+        if not key in self._samples:
+            self._samples[key] = []
+            self._keys.append(key)
+        sample = self._samples[key]
+        if self.capacity is None or len(sample) < self.capacity:
+            # All items of the key are still kept
+            sample.append(item)
+            self._size = self._size + 1
+            if not self.limit is None and self._size > self._threshold and \
+               self.capacity != 1:
+                self._shrink()
+        else:
+            # Replace a kept item with the probability capacity / seen
+            index = self.rng.randrange(seen)
+            if index < self.capacity:
+                sample[index] = item
+
+    def _shrink(self):
+        """Reduce the items kept per key until they fit into the limit"""
+        sizes = sorted(len(sample) for sample in self._samples.values())
+        remaining = self.limit
+        capacity = sizes[-1]
+        for position, size in enumerate(sizes):
+            keys = len(sizes) - position
+            if size * keys > remaining:
+                capacity = max(remaining // keys, 1)
+                break
+            remaining = remaining - size
+        for key, sample in self._samples.items():
+            if len(sample) > capacity:
+                self._samples[key] = self.rng.sample(sample, capacity)
+        self.capacity = capacity
+        self._size = sum(len(sample) for sample in self._samples.values())
+
+    def items(self):
+        """Return the sampled items, key by key in the order the keys were
+        first added"""
+        if not self.limit is None and self._size > self.limit:
+            self._shrink()
+        result = []
+        for key in self._keys:
+            result.extend(self._samples[key])
+        return result
@@ -3,6 +3,9 @@
 from utils import register_resource
 from utils import aggregate
 from utils import run
+from utils import pivot_partitions
+from queries import fetch_all
+from queries import replicate_table
 
 
 @register_resource(resolution="replicate", partition=False)
@@ -49,10 +52,8 @@ def _splicing_summary(dbs, conf):
 select junc_type,
        detected,
        total
-from %(projectid)s_%(replicateid)s_splicing_summary""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+from %s""" % replicate_table(conf, 'splicing_summary')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     stats = {}
     for junc_type, detected, total in rows:
         stats[junc_type] = {'detected': detected, 'total': total}
@@ -109,20 +110,7 @@ def exon_inclusion_profile(dbs, confs):
                 for x, y in stats:
                     coords.append((index, x, y))
 
-    partition_length = len(partition_keys)
-
-    result = []
-    for index, x, y in coords:
-        found = False
-        for item in result:
-            if item[0] == x and item[index + 1] == None:
-                item[index + 1] = y
-                found = True
-                break
-        if not found:
-            line = [None] * partition_length
-            line[index] = y
-            result.append([x] + line)
+    result = pivot_partitions(coords, len(partition_keys))
 
     if result:
         chart['table_data'] = result
@@ -137,12 +125,12 @@ def _exon_inclusion_profile(dbs, conf):
     sql = """
 select incl_percent,
        support
-from %(projectid)s_%(replicateid)s_inclusion_dist
-where LaneName = "%(laneid)s"
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+from %s
+where LaneName = %%s
+""" % replicate_table(conf, 'inclusion_dist')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'],
+                     sql,
+                     (conf['laneid'], ))
     return rows
 
 
@@ -190,10 +178,8 @@ select chr,
        inc_rate * 100,
        sample_id
 from
-    %(projectid)s_%(replicateid)s_exon_inclusion_reads""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+    %s""" % replicate_table(conf, 'exon_inclusion_reads')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return list(rows)
 
 
@@ -210,12 +196,10 @@ select chr,
        inc_rate * 100,
        sample_id
 from
-    %(projectid)s_%(replicateid)s_exon_inclusion_reads
+    %s
 order by
     JuncInc desc
 ) x
-limit 20;""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+limit 20;""" % replicate_table(conf, 'exon_inclusion_reads')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     return list(rows)
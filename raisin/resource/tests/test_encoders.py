@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import sys
+import decimal
+import datetime
+import unittest
+from gvizapi import gviz_api
+from raisin.resource import encoders
+
+
+DESCRIPTION = [('Name', 'string'),
+               ('Total', 'number'),
+               ('Percent', 'number'),
+               ]
+
+ROWS = [('a, "quoted"', 1, 0.5),
+        (u'\xe9t\xe9', None, 1.0 / 3),
+        ('caf\xc3\xa9', 3L, 2),
+        (None, decimal.Decimal('1.25'), True),
+        ('</script>\n\\', -7, float('1e300')),
+        (42, 0, 0.0),
+        ]
+
+
+def data_table(data):
+    table = gviz_api.DataTable(data['table_description'])
+    table.AppendData(data['table_data'])
+    return table
+
+
+class EncodersTest(unittest.TestCase):
+
+    def assertSameJSon(self, data):
+        self.assertEqual(encoders.to_json(data), data_table(data).ToJSon())
+
+    def test_to_json(self):
+        self.assertSameJSon({'table_description': DESCRIPTION,
+                             'table_data': ROWS})
+
+    def test_to_json_without_rows(self):
+        self.assertSameJSon({'table_description': DESCRIPTION,
+                             'table_data': []})
+
+    def test_to_json_short_rows(self):
+        self.assertSameJSon({'table_description': DESCRIPTION,
+                             'table_data': [['a'], ['b', 1]]})
+
+    def test_to_json_formatted_values(self):
+        self.assertSameJSon({'table_description': DESCRIPTION,
+                             'table_data': [[('a', 'A'), (1, '1$'), None]]})
+
+    def test_to_json_other_types(self):
+        description = [('Date', 'date'),
+                       ('Time', 'datetime'),
+                       ('Paired', 'boolean'),
+                       ]
+        rows = [(datetime.date(2012, 8, 3),
+                 datetime.datetime(2012, 8, 3, 12, 30, 1),
+                 0)]
+        self.assertSameJSon({'table_description': description,
+                             'table_data': rows})
+
+    def test_to_json_labels(self):
+        description = [(u'Gen\xe9', 'string', u'Label \xe9'),
+                       ('"quoted" rows', 'number'),
+                       ]
+        self.assertSameJSon({'table_description': description,
+                             'table_data': [('x', 1)]})
+
+    def test_to_json_duplicate_column_ids(self):
+        description = [('Gene Name', 'string'),
+                       ('ENSG1', 'number'),
+                       ('ENSG1', 'number'),
+                       ]
+        self.assertSameJSon({'table_description': description,
+                             'table_data': [('lane', 1, 2)]})
+
+    def test_to_json_wrong_type(self):
+        data = {'table_description': DESCRIPTION,
+                'table_data': [('a', 'not a number', 1)]}
+        self.assertRaises(gviz_api.DataTableException, encoders.to_json, data)
+
+    def test_to_json_too_many_cells(self):
+        data = {'table_description': DESCRIPTION,
+                'table_data': [('a', 1, 2, 3)]}
+        self.assertRaises(gviz_api.DataTableException, encoders.to_json, data)
+
+    def test_iter_csv(self):
+        data = {'table_description': DESCRIPTION,
+                'table_data': ROWS}
+        table = data_table(data)
+        for separator in (',', '\t'):
+            chunks = encoders.iter_csv(data, separator, chunk_rows=2)
+            self.assertEqual(''.join(chunks),
+                             table.ToCsv(separator=separator))
+
+    def test_columns_round_trip(self):
+        description = [('Position', 'number'),
+                       ('Score', 'number'),
+                       (u'Lane \xe9', 'string'),
+                       ('Paired', 'boolean'),
+                       ('Date', 'date'),
+                       ]
+        rows = [(1, 0.5, 'a', True, datetime.date(2012, 8, 3)),
+                (2, None, u'\xe9', False, None),
+                (3L, decimal.Decimal('2.5'), None),
+                ]
+        body = encoders.to_columns({'table_description': description,
+                                    'table_data': rows})
+        table = encoders.read_columns(body)
+        self.assertEqual(table['table_description'],
+                         [(u'Position', 'number', u'Position'),
+                          (u'Score', 'number', u'Score'),
+                          (u'Lane \xe9', 'string', u'Lane \xe9'),
+                          (u'Paired', 'boolean', u'Paired'),
+                          (u'Date', 'date', u'Date'),
+                          ])
+        self.assertEqual(table['columns'],
+                         [[1, 2, 3],
+                          [0.5, None, 2.5],
+                          [u'a', u'\xe9', None],
+                          [True, False, None],
+                          [u'2012-08-03', None, None],
+                          ])
+
+    def test_columns_wrong_type(self):
+        data = {'table_description': DESCRIPTION,
+                'table_data': [('a', 'not a number', 1)]}
+        self.assertRaises(gviz_api.DataTableException,
+                          encoders.to_columns,
+                          data)
+
+
+# make the test suite.
+def suite():
+    loader = unittest.TestLoader()
+    testsuite = loader.loadTestsFromTestCase(EncodersTest)
+    return testsuite
+
+
+# Make the test suite; run the tests.
+def test_main():
+    testsuite = suite()
+    runner = unittest.TextTestRunner(sys.stdout, verbosity=2)
+    runner.run(testsuite)
+
+
+if __name__ == "__main__":
+    test_main()
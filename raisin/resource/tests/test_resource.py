@@ -1,18 +1,848 @@
+import os
+import re
+import calendar
+import datetime
 import sys
+import random
+import shutil
+import tempfile
+import threading
+import time
+import logging
 import unittest
+from restish import http
 from raisin.resource import root
+from raisin.resource import executor
+from raisin.resource import cache
+from raisin.resource import utils
+from raisin.resource import read
+from raisin.resource import expression
+from raisin.resource import reduction
+from raisin.resource import queries
+from raisin.resource import pool
+from raisin.resource import instrumentation
+from raisin.resource import benchmark
+from raisin.resource import rollup
+from raisin.resource import sampling
+from raisin.resource import warmup
+
+
+class Cursor(object):
+    description = None
+    rowcount = 0
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql, args=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class Database(object):
+    """Answer every query with the same rows and remember the queries"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def query(self, sql, args=None):
+        self.queries.append((sql, args))
+        return Cursor(self.rows)
+
+
+class CountingDatabase(object):
+    """Remember the queries passed on to a database"""
+
+    def __init__(self, database):
+        self.database = database
+        self.queries = []
+
+    def query(self, sql, args=None):
+        self.queries.append((sql, args))
+        return self.database.query(sql, args)
+
+
+class Connection(object):
+    """Connection answering every query with the same rows"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.alive = True
+        self.closed = False
+
+    def ping(self):
+        if not self.alive:
+            raise pool.MySQLdb.OperationalError(2006, 'gone away')
+
+    def cursor(self):
+        return Cursor(self.rows)
+
+    def close(self):
+        self.closed = True
+
+
+class ListHandler(logging.Handler):
+    """Remember the messages logged"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
 
 
 class ResourceTest(unittest.TestCase):
     def setUp(self):
         unittest.TestCase.setUp(self)
+        # Some tests replace the response cache of the resources
+        self.response_cache = cache.get_response_cache()
 
     def tearDown(self):
+        cache.set_response_cache(self.response_cache)
         unittest.TestCase.tearDown(self)
 
     def test_stats_registry(self):
         self.failUnless(root.STATS_REGISTRY != {})
 
+    def test_thread_pool_executor_keeps_order(self):
+        pool = executor.ThreadPoolExecutor(max_workers=4, max_per_group=2)
+        items = range(20)
+        results = pool.map(lambda x: x * x, items, group=lambda x: x % 3)
+        self.assertEqual(results, [x * x for x in items])
+
+    def test_thread_pool_executor_timeout(self):
+        pool = executor.ThreadPoolExecutor(max_workers=4)
+        event = threading.Event()
+        returned = threading.Event()
+
+        def call(x):
+            if x == 2:
+                event.wait(5)
+                returned.set()
+            return x * x
+        try:
+            results = pool.map(call, range(4), timeout=0.2, default='late')
+        finally:
+            event.set()
+            returned.wait(5)
+        self.assertEqual(results, [0, 1, 'late', 9])
+
+    def test_serial_executor_timeout(self):
+        def work(item):
+            time.sleep(0.05)
+            return item
+        self.assertEqual(executor.SerialExecutor().map(work, [1, 2, 3],
+                                                       timeout=0.01,
+                                                       default='late'),
+                         [1, 'late', 'late'])
+
+    def test_timed_out_query_gives_its_connection_back(self):
+        answer = threading.Event()
+
+        class SlowCursor(Cursor):
+            def execute(self, sql, args=None):
+                answer.wait(5)
+        connection = Connection([(1, )])
+        connection.cursor = lambda: SlowCursor([(1, )])
+        connection_pool = pool.ConnectionPool(lambda: connection)
+        thread_pool = executor.ThreadPoolExecutor()
+        self.assertEqual(thread_pool.map(connection_pool.query, ['select 1'],
+                                         timeout=0.05, default='late'),
+                         ['late'])
+        self.assertEqual(connection_pool.stats()['in_use'], 1)
+        answer.set()
+        for _ in range(100):
+            if connection_pool.stats()['in_use'] == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(connection_pool.stats()['idle'], 1)
+
+    def test_run_projects(self):
+        dbs = {'P1': {'RNAseqPipelineCommon': Database([(1, 2), (3, 4)])},
+               'P2': {'RNAseqPipelineCommon': Database([(5, 6)])},
+               'P3': {},
+               }
+
+        def method(dbs, conf):
+            return queries.fetch_all(
+                dbs[conf['projectid']]['RNAseqPipelineCommon'], 'select 1')
+        handler = ListHandler()
+        utils.log.addHandler(handler)
+        try:
+            rows = utils.run_projects(dbs, method)
+        finally:
+            utils.log.removeHandler(handler)
+        self.assertEqual(sorted(rows), [(1, 2), (3, 4), (5, 6)])
+        self.assertEqual(handler.messages,
+                         ['Error running sql method for project P3'])
+
+    def test_aggregate_batched_queries_once_per_replicate(self):
+        database = Database([('r1', 10, 4), ('r2', 20, 6)])
+        dbs = {'P': {'RNAseqPipeline': database}}
+        confs = [{'projectid': 'P', 'replicateid': 'R', 'readid': 'r1'},
+                 {'projectid': 'P', 'replicateid': 'R', 'readid': 'r2'},
+                 {'projectid': 'P', 'replicateid': 'R', 'readid': 'r3'}]
+        stats, failed = utils.aggregate_batched(
+            dbs, confs, read._average_and_average_unique_reads,
+            lambda x, y: x + y)
+        self.assertEqual(len(database.queries), 1)
+        self.assertEqual(failed, 1)
+        self.assertEqual(stats, {'total': 30, 'unique': 10})
+
+    def test_configurations_for_lanes_and_reads(self):
+        dbs = benchmark.create_databases(replicates=2, lanes=3, reads=2,
+                                         genes=10)
+        benchmark.clear_caches()
+        replicates = [{'projectid': 'P1', 'replicateid': 'R1'},
+                      {'projectid': 'P1', 'replicateid': 'R2'}]
+        lanes = utils.configurations_for_level(None, dbs, replicates, 'lane')
+        reads = utils.configurations_for_level(None, dbs, lanes, 'read')
+        self.assertEqual(len(reads), 12)
+        self.assertEqual(utils.configurations_for_lanes_and_reads(dbs,
+                                                                  replicates),
+                         reads)
+        # Replicates without tables are logged and reported as errors
+        errors = []
+        handler = ListHandler()
+        utils.log.addHandler(handler)
+        try:
+            utils.configurations_for_lanes_and_reads(
+                dbs, [{'projectid': 'P1', 'replicateid': 'R9'}], errors)
+        finally:
+            utils.log.removeHandler(handler)
+        self.assertEqual(errors, [{'projectid': 'P1', 'replicateid': 'R9'}])
+        self.assertEqual(handler.messages,
+                         ["Can't find the lanes and reads of replicate R9 "
+                          "of project P1"])
+        # One query per replicate
+        stats = instrumentation.start_request('lanes_and_reads')
+        try:
+            utils.configurations_for_lanes_and_reads(dbs, replicates)
+        finally:
+            instrumentation.activate(None)
+        self.assertEqual(stats.queries, 2)
+
+    def test_dashboard_cache(self):
+        dbs = benchmark.create_databases(replicates=1, lanes=1, reads=1,
+                                         genes=10)
+        dashboard = CountingDatabase(dbs['P1']['hg19_RNA_dashboard'])
+        dbs['P1']['hg19_RNA_dashboard'] = dashboard
+        benchmark.clear_caches()
+        request = http.Request.blank('/')
+        request.environ.update(benchmark.get_environ(dbs))
+
+        def request_info():
+            # Render the response again instead of taking it from the cache
+            cache.get_response_cache().invalidate()
+            response = root.Resource('replicate_info',
+                                     projectid='P1',
+                                     replicateid='R1')(request)
+            self.assertEqual(response.status_int, 200)
+            return response.body
+        body = request_info()
+        # One query per label table
+        self.assertEqual(len(dashboard.queries), 3)
+        self.assertEqual(request_info(), body)
+        self.assertEqual(len(dashboard.queries), 3)
+        utils.refresh_dashboard_cache()
+        self.assertEqual(request_info(), body)
+        self.assertEqual(len(dashboard.queries), 6)
+
+    def test_last_modified(self):
+        utils.invalidate_configurations()
+        project = Database([(datetime.datetime(2013, 1, 1), )])
+        common = Database([(datetime.datetime(2013, 2, 1), )])
+        dashboard = Database([(datetime.datetime(2013, 3, 1), )])
+        dbs = {'P': {'RNAseqPipeline': project,
+                     'RNAseqPipelineCommon': common,
+                     'hg19_RNA_dashboard': dashboard}}
+        confs = {'configurations': [{'projectid': 'P', 'replicateid': 'R'}],
+                 'kwargs': {'projectid': 'P'}}
+        # Changes of the experiments or the labels move the date as well
+        self.assertEqual(utils.get_last_modified(dbs, confs),
+                         calendar.timegm((2013, 3, 1, 0, 0, 0)))
+        self.assertEqual(project.queries[0][1], ['P\\_R\\_%'])
+        self.assertEqual(common.queries[0][1], None)
+        # The update times are cached
+        utils.get_last_modified(dbs, confs)
+        self.assertEqual([len(database.queries)
+                          for database in (project, common, dashboard)],
+                         [1, 1, 1])
+        # Unknown update times give no date at all
+        utils.invalidate_configurations('P')
+        common.rows = [(None, )]
+        self.assertEqual(utils.get_last_modified(dbs, confs), None)
+
+    def test_ttl_cache_evicts_and_expires(self):
+        now = [0]
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+        ttl_cache.set('a', 1)
+        ttl_cache.set('b', 2)
+        ttl_cache.get('a')
+        ttl_cache.set('c', 3)
+        self.assertEqual(ttl_cache.get('b'), None)
+        self.assertEqual(ttl_cache.get('a'), 1)
+        now[0] = 11
+        self.assertEqual(ttl_cache.get('c'), None)
+
+    def test_show_uses_response_cache(self):
+        cache.set_response_cache(cache.ResponseCache())
+        database = Database([('A project', 'Homo sapiens')])
+        request = http.Request.blank('/')
+        request.environ['dbs'] = {'P': {'RNAseqPipelineCommon': database}}
+        request.headers['Accept'] = 'text/javascript'
+        first = root.Resource('project_info', projectid='P')(request)
+        second = root.Resource('project_info', projectid='P')(request)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(len(database.queries), 1)
+        request.headers['If-None-Match'] = first.headers['ETag']
+        third = root.Resource('project_info', projectid='P')(request)
+        self.assertEqual(third.status_int, 304)
+
+    def test_show_records_queries(self):
+        cache.set_response_cache(cache.ResponseCache())
+        instrumentation.reset_statistics()
+        database = Database([('A project', 'Homo sapiens')])
+        request = http.Request.blank('/')
+        request.environ['dbs'] = {'P': {'RNAseqPipelineCommon': database}}
+        request.headers['Accept'] = 'text/javascript'
+        first = root.Resource('project_info', projectid='P')(request)
+        second = root.Resource('project_info', projectid='P')(request)
+        self.failUnless(first.headers['Server-Timing'].startswith(
+            'db;dur='))
+        self.failUnless(second.headers['Server-Timing'].startswith(
+            'cache;desc="hit"'))
+        totals = instrumentation.get_statistics()['project_info']
+        self.assertEqual(totals['requests'], 2)
+        self.assertEqual(totals['cache_hits'], 1)
+        self.assertEqual(totals['queries'], len(database.queries))
+        self.assertEqual(totals['bytes'], len(first.body) * 2)
+        self.assertEqual(instrumentation.current_stats(), None)
+        request = http.Request.blank('/_stats')
+        response = root.StatsResource()(request)
+        self.assertEqual(response.status_int, 404)
+        request.environ['stats_enabled'] = True
+        response = root.StatsResource()(request)
+        self.failUnless('project_info' in response.body)
+
+    def test_benchmark(self):
+        report = benchmark.run_benchmark(replicates=1, lanes=1, reads=2,
+                                         genes=100, repeat=1,
+                                         accept_types=['text/javascript'],
+                                         keys=['lane_top_genes',
+                                               'replicate_read_summary',
+                                               'read_read_summary'])
+        self.assertEqual([(r['key'], r['status'], r['queries'] > 0)
+                          for r in report['results']],
+                         [('lane_top_genes', 200, True),
+                          ('replicate_read_summary', 200, True)])
+        self.assertEqual(report['skipped'], ['read_read_summary'])
+
+    def test_rollups(self):
+        dbs = benchmark.create_databases(replicates=3, lanes=2, reads=2,
+                                         genes=100)
+        environ = benchmark.get_environ(dbs)
+        experiment = {'projectid': 'P1',
+                      'parameter_list': '-'.join(benchmark.PARAMETER_LIST),
+                      'parameter_values': '-'.join(
+                          [str(v) for v in benchmark.EXPERIMENTS[0]]),
+                      }
+        targets = [('project_read_summary', {'projectid': 'P1'}),
+                   ('project_genome_mapped_reads', {'projectid': 'P1'}),
+                   ('experiment_mapping_summary', experiment),
+                   ('experiment_split_mapped_reads', experiment),
+                   ]
+
+        def request_all():
+            results = []
+            for key, kwargs in targets:
+                benchmark.clear_caches()
+                instrumentation.reset_statistics()
+                request = http.Request.blank('/')
+                request.environ.update(environ)
+                response = root.Resource(key, **kwargs)(request)
+                queries = instrumentation.get_statistics()[key]['queries']
+                results.append((response.body, queries))
+            return results
+        # Without the rollup table, the replicates are expanded to reads
+        expanded = request_all()
+        self.assertEqual(rollup.build_rollups(dbs, 'P1'), 3)
+        rolled_up = request_all()
+        for (body, queries), (rollup_body, rollup_queries) in zip(expanded,
+                                                                 rolled_up):
+            self.assertEqual(body, rollup_body)
+            self.failUnless(rollup_queries < queries)
+        # Replicates missing from the rollup table are still summed up
+        dbs['P1']['RNAseqPipeline'].query(
+            "delete from P1_rollup where replicateid = 'R2'")
+        self.assertEqual(request_all()[0][0], expanded[0][0])
+
+    def test_replicate_info(self):
+        dbs = benchmark.create_databases(replicates=2, lanes=1, reads=1,
+                                         genes=100)
+        common = CountingDatabase(dbs['P1']['RNAseqPipelineCommon'])
+        dbs['P1']['RNAseqPipelineCommon'] = common
+        benchmark.clear_caches()
+        request = http.Request.blank('/')
+        request.environ.update(benchmark.get_environ(dbs))
+        request.headers['Accept'] = 'text/csv'
+        response = root.Resource('replicate_info',
+                                 projectid='P1',
+                                 replicateid='R2')(request)
+        # The configurations span all replicates of the project, as the
+        # resource is registered without a level, but only the requested
+        # replicate is queried
+        self.failIf([query for query in common.queries
+                     if 'R1' in repr(query)])
+        lines = ''.join(response.app_iter).splitlines()
+        self.assertEqual(lines[1].split(',')[2:4],
+                         ['Replicate 2', '2012-01-01'])
+
+    def test_experiment_info_qualifies_columns(self):
+        dbs = benchmark.create_databases(replicates=2, lanes=1, reads=1,
+                                         genes=10)
+        common = CountingDatabase(dbs['P1']['RNAseqPipelineCommon'])
+        dbs['P1']['RNAseqPipelineCommon'] = common
+        benchmark.clear_caches()
+        request = http.Request.blank('/')
+        request.environ.update(benchmark.get_environ(dbs))
+        parameter_values = '-'.join([str(v) for v in benchmark.EXPERIMENTS[1]])
+        response = root.Resource('experiment_info',
+                                 projectid='P1',
+                                 parameter_list='-'.join(
+                                     benchmark.PARAMETER_LIST),
+                                 parameter_values=parameter_values)(request)
+        self.assertEqual(response.status_int, 200)
+        sql = [sql for sql, _ in common.queries if 'join' in sql][0]
+        # The columns of the experiments are also found in joined tables
+        columns = re.findall(r'([\w.]+) = %s', sql)
+        self.assertEqual(len(columns), 5)
+        self.assertEqual([c for c in columns
+                          if not c.startswith('experiments.')], [])
+
+    def test_gene_expression_levels_with_few_genes(self):
+        dbs = benchmark.create_databases(replicates=2, lanes=2, reads=1,
+                                         genes=10)
+        benchmark.clear_caches()
+        request = http.Request.blank('/')
+        request.environ.update(benchmark.get_environ(dbs))
+        request.headers['Accept'] = 'text/csv'
+        response = root.Resource('replicate_gene_expression_levels',
+                                 projectid='P1',
+                                 replicateid='R1')(request)
+        lines = ''.join(response.app_iter).splitlines()
+        # All 10 genes are selected, and the levels of the two lanes shown
+        self.assertEqual(len(lines[0].split(',')), 11)
+        self.assertEqual([line.split(',')[0] for line in lines[1:]],
+                         ['R1 L1', 'R1 L2'])
+        self.assertEqual(expression.select_round_robin([['a', 'b'],
+                                                        ['b', 'c', 'd']],
+                                                       3),
+                         ['a', 'b', 'c'])
+
+    def test_warm_up(self):
+        dbs = benchmark.create_databases(replicates=2, lanes=2, reads=1,
+                                         genes=100)
+        environ = benchmark.get_environ(dbs)
+        benchmark.clear_caches()
+        entities = warmup.get_entities(dbs, environ)
+        self.assertEqual(len(entities['experiment']), 2)
+        self.assertEqual([e['laneid'] for e in entities['lane']],
+                         ['L1', 'L2', 'L1', 'L2'])
+        targets = warmup.get_targets(dbs, entities,
+                                     ['replicate_read_summary',
+                                      'lane_top_genes',
+                                      'rnadashboard_files',
+                                      'read_read_summary'])
+        self.assertEqual([(key, kwargs.get('laneid', kwargs.get('hgversion')))
+                          for key, kwargs in targets],
+                         [('lane_top_genes', 'L1'),
+                          ('lane_top_genes', 'L1'),
+                          ('lane_top_genes', 'L2'),
+                          ('lane_top_genes', 'L2'),
+                          ('replicate_read_summary', None),
+                          ('replicate_read_summary', None),
+                          ('rnadashboard_files', 'hg19')])
+        directory = tempfile.mkdtemp()
+        try:
+            environ['response_cache_dir'] = directory
+            progress = []
+            results = warmup.warm_up(environ, targets, concurrency=3,
+                                     progress=lambda *args:
+                                     progress.append(args))
+            self.assertEqual([result['status'] for result in results],
+                             [200] * len(targets))
+            self.assertEqual(sorted(done for done, _, _ in progress),
+                             range(1, len(targets) + 1))
+            # The web server, in another process, serves the responses from
+            # the directory without querying the databases
+            cache.DISK_RESPONSE_CACHES.clear()
+            dbs['P1']['RNAseqPipeline'] = Database([])
+            instrumentation.reset_statistics()
+            request = http.Request.blank('/')
+            request.environ.update(environ)
+            request.headers['Accept'] = 'text/javascript'
+            for key, kwargs in targets:
+                response = root.Resource(key, **kwargs)(request)
+                self.assertEqual(response.status_int, 200)
+            totals = instrumentation.get_statistics()
+            self.assertEqual(sum(totals[key]['cache_hits']
+                                 for key in totals), len(targets))
+            self.assertEqual(dbs['P1']['RNAseqPipeline'].queries, [])
+            # The memory cache is used without a directory
+            self.failUnless(cache.get_response_cache({}) is
+                            cache.get_response_cache())
+        finally:
+            cache.DISK_RESPONSE_CACHES.clear()
+            shutil.rmtree(directory)
+
+    def test_pivot_partitions(self):
+        def pivot(points, partition_length):
+            # The linear scan used before
+            result = []
+            for index, x, y in points:
+                found = False
+                for res in result:
+                    if res[0] == x and res[index + 1] == None:
+                        res[index + 1] = y
+                        found = True
+                        break
+                if not found:
+                    line = [None] * partition_length
+                    line[index] = y
+                    result.append([x] + line)
+            return result
+        generator = random.Random(1)
+        points = [(generator.randint(0, 2),
+                   generator.randint(1, 20),
+                   generator.choice([None, 1, 2.5, 3]))
+                  for _ in range(500)]
+        self.assertEqual(utils.pivot_partitions(points, 3), pivot(points, 3))
+        self.assertEqual(utils.pivot_partitions([], 3), [])
+
+    def test_sum_results(self):
+        generator = random.Random(2)
+        results = [{'total': generator.randint(0, 10 ** 9),
+                    'unique': generator.randint(0, 10 ** 6),
+                    'percent': generator.random()}
+                   for _ in range(50)]
+        results[3] = {'total': 5L}
+        expected = None
+        for data in results:
+            if expected is None:
+                expected = data
+            else:
+                expected = utils.merge(expected, data, reduction.add)
+        self.assertEqual(reduction.sum_results(results), expected)
+        # The results are not changed
+        self.assertEqual(sorted(results[0].keys()), sorted(expected.keys()))
+        self.failIf(results[0] is reduction.sum_results(results))
+        self.assertRaises(TypeError,
+                          reduction.sum_results,
+                          [{'total': None}] * 10)
+        self.assertEqual(reduction.sum_results([]), None)
+
+    def test_gene_expression_levels_deadline(self):
+        dbs = benchmark.create_databases(replicates=2, lanes=2, reads=1,
+                                         genes=10)
+        benchmark.clear_caches()
+        request = http.Request.blank('/')
+        request.environ.update(benchmark.get_environ(dbs))
+        request.headers['Accept'] = 'text/csv'
+        timeouts = []
+        run_batched = expression.run_batched
+
+        def slow_run_batched(dbs, confs, method, timeout=None):
+            timeouts.append(timeout)
+            time.sleep(0.05)
+            return run_batched(dbs, confs, method, timeout)
+        expression.run_batched = slow_run_batched
+        try:
+            root.Resource('replicate_gene_expression_levels',
+                          projectid='P1',
+                          replicateid='R1')(request)
+        finally:
+            expression.run_batched = run_batched
+        # Both queries share one deadline
+        self.assertEqual(timeouts[0], expression.LEVELS_TIMEOUT)
+        self.failUnless(timeouts[1] <= expression.LEVELS_TIMEOUT - 0.05)
+
+    def test_stratified_sample(self):
+        sample = sampling.StratifiedSample(100, rng=random.Random(3))
+        for item in range(10000):
+            sample.add('frequent', item)
+            if item % 1000 == 0:
+                sample.add(item, item)
+        items = sample.items()
+        self.assertEqual(len(items), 100)
+        # The rare keys keep their only item
+        self.failUnless(len([i for i in items if i % 1000 == 0]) >= 10)
+        self.assertEqual(len(set(items)), len(items))
+        everything = sampling.StratifiedSample(None)
+        for item in range(10000):
+            everything.add(item % 7, item)
+        self.assertEqual(sorted(everything.items()), range(10000))
+
+    def test_gene_expression_profile_samples_while_reading(self):
+        dbs = benchmark.create_databases(replicates=3, lanes=2, reads=1,
+                                         genes=100)
+        events = []
+        database = dbs['P1']['RNAseqPipeline']
+
+        class Database(CountingDatabase):
+            def query(self, sql, args=None):
+                if 'gene_RPKM_dist' in sql:
+                    events.append('query')
+                return self.database.query(sql, args)
+        dbs['P1']['RNAseqPipeline'] = Database(database)
+
+        class Sample(sampling.StratifiedSample):
+            def add(self, key, item):
+                events.append('add')
+                sampling.StratifiedSample.add(self, key, item)
+        benchmark.clear_caches()
+        request = http.Request.blank('/')
+        request.environ.update(benchmark.get_environ(dbs))
+        previous = executor.get_executor()
+        executor.set_executor(executor.SerialExecutor())
+        sample = expression.StratifiedSample
+        expression.StratifiedSample = Sample
+        try:
+            response = root.Resource('project_gene_expression_profile',
+                                     projectid='P1')(request)
+        finally:
+            expression.StratifiedSample = sample
+            executor.set_executor(previous)
+        self.assertEqual(response.status_int, 200)
+        # The rows of each replicate are added before the next is read
+        runs = [event for index, event in enumerate(events)
+                if index == 0 or events[index - 1] != event]
+        self.failUnless(len(runs) >= 6)
+        self.assertEqual(runs, ['query', 'add'] * (len(runs) // 2))
+
+    def test_merge_top_rows(self):
+        generator = random.Random(3)
+        rows = []
+        for number in range(30):
+            stream = [(generator.randint(0, 50), number, position)
+                      for position in range(generator.randint(0, 20))]
+            stream.sort(reverse=True)
+            rows.append(stream)
+        expected = sorted(sum(rows, []), key=lambda row: row[0])
+        expected.reverse()
+        result = utils.merge_top_rows(rows, lambda row: row[0], 20)
+        self.assertEqual(result, expected[:20])
+        self.assertEqual(utils.merge_top_rows([], lambda row: row[0]), [])
+
+    def test_top_rows_union(self):
+        database = Database([('g1', 5.0, 'R', 'L1')])
+        dbs = {'P': {'RNAseqPipeline': database}}
+        confs = [{'projectid': 'P', 'replicateid': 'R', 'laneid': 'L1'},
+                 {'projectid': 'P', 'replicateid': 'R', 'laneid': 'L2'}]
+        select = lambda conf: ("select %s as top_value", (conf['laneid'], ))
+        utils.UNION_TOP_ROWS = True
+        try:
+            rows = utils.top_rows(dbs, confs, None, None,
+                                  lambda row: row[1], select=select)
+        finally:
+            utils.UNION_TOP_ROWS = False
+        self.assertEqual(rows, [('g1', 5.0, 'R', 'L1')])
+        self.assertEqual(len(database.queries), 1)
+        self.failUnless('union all' in database.queries[0][0])
+        self.assertEqual(database.queries[0][1], ['L1', 'L2'])
+
+    def test_queries_check_identifiers(self):
+        conf = {'projectid': 'P', 'replicateid': "R; drop table x"}
+        self.assertRaises(ValueError, queries.replicate_table, conf, 'dataset')
+        self.assertEqual(queries.column_name('001N.1'), '`001N.1`')
+        self.assertRaises(ValueError, queries.column_name, "a` or 1")
+
+    def test_connection_pool(self):
+        now = [0]
+        connections = []
+
+        def connect():
+            connections.append(Connection([(1, )]))
+            return connections[-1]
+        connection_pool = pool.ConnectionPool(connect, max_size=2,
+                                              max_idle=10, timeout=0,
+                                              timer=lambda: now[0])
+        self.assertEqual(connection_pool.query('select 1').fetchall(),
+                         [(1, )])
+        self.assertEqual(connection_pool.query('select 1').fetchall(),
+                         [(1, )])
+        self.assertEqual(len(connections), 1)
+        first = connection_pool.checkout()
+        second = connection_pool.checkout()
+        self.assertRaises(pool.PoolTimeout, connection_pool.checkout)
+        connection_pool.checkin(first)
+        connection_pool.checkin(second)
+        # Stale connections are replaced
+        second.alive = False
+        connection_pool.query('select 1')
+        self.failUnless(second.closed)
+        # Connections unused for too long are closed
+        now[0] = 11
+        connection_pool.query('select 1')
+        self.failUnless(first.closed)
+        stats = connection_pool.stats()
+        self.assertEqual(stats['stale'], 1)
+        self.assertEqual(stats['queries'], 4)
+        self.assertEqual(stats['size'], 1)
+
+    def test_connection_pool_pings_without_lock(self):
+        connections = []
+
+        def connect():
+            connections.append(Connection([(1, )]))
+            return connections[-1]
+        connection_pool = pool.ConnectionPool(connect, max_size=2)
+        slow = connection_pool.checkout()
+        connection_pool.checkin(slow)
+        pinging = threading.Event()
+        answer = threading.Event()
+        answered = threading.Event()
+
+        def ping():
+            pinging.set()
+            answer.wait(5)
+            answered.set()
+        slow.ping = ping
+        thread = threading.Thread(target=connection_pool.checkout)
+        thread.start()
+        pinging.wait(5)
+        # Other threads go on while the server is slow to answer the ping
+        other = connection_pool.checkout()
+        connection_pool.checkin(other)
+        self.failIf(answered.isSet())
+        answer.set()
+        thread.join()
+        self.assertEqual(len(connections), 2)
+
+    def test_get_pool_stats(self):
+        class DB(object):
+            def __init__(self, database, server, user='raisin'):
+                self.database = database
+                self.connection = {'server': server, 'port': 3306,
+                                   'user': user, 'password': 'secret'}
+        pools = pool.POOLS.copy()
+        pool.POOLS.clear()
+        try:
+            demo = pool.get_pool(DB('Demo', 'db1.example.org'))
+            pool.get_pool(DB('Demo', 'db2.example.org'))
+            pool.get_pool(DB('Common', 'db1.example.org'))
+            # Each user gets its own connections
+            self.failIf(pool.get_pool(DB('Demo', 'db1.example.org',
+                                         'admin')) is demo)
+            self.failUnless(pool.get_pool(DB('Demo', 'db1.example.org'))
+                            is demo)
+            stats = pool.get_pool_stats()
+            keys = pool.POOLS.keys()
+        finally:
+            pool.POOLS.clear()
+            pool.POOLS.update(pools)
+        self.assertEqual(sorted(stats),
+                         ['Common', 'Demo', 'Demo#2', 'Demo#3'])
+        self.failIf('secret' in repr(keys))
+        for value in ('db1', 'raisin', 'admin', 'secret'):
+            self.failIf(value in repr(stats))
+
+    def test_single_flight(self):
+        flight = cache.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def render():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'body'
+        results = []
+
+        def request():
+            results.append(flight.do('key', render))
+        threads = [threading.Thread(target=request) for _ in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('body', False),
+                                           ('body', True),
+                                           ('body', True)])
+        # Once finished, the function is run again
+        self.assertEqual(flight.do('key', lambda: 'new'), ('new', False))
+
+    def test_disk_backend(self):
+        directory = tempfile.mkdtemp()
+        try:
+            backend = cache.DiskBackend(directory, maxbytes=10000)
+            response_cache = cache.ResponseCache(backend)
+            key = cache.get_response_cache_key('project_info',
+                                               {'projectid': 'P'},
+                                               'text/csv')
+            response_cache.set(key, {'content_type': 'text/csv',
+                                     'body': 'a,b'})
+            self.assertEqual(response_cache.get(key)['body'], 'a,b')
+            other = cache.get_response_cache_key('project_info',
+                                                 {'projectid': 'Q'},
+                                                 'text/csv')
+            response_cache.set(other, {'content_type': 'text/csv',
+                                       'body': 'c,d'})
+            # The files of other projects are neither read nor removed
+            loaded = []
+            backend._load = lambda path: loaded.append(path)
+            response_cache.invalidate('P')
+            self.assertEqual(loaded, [])
+            del backend._load
+            self.assertEqual(response_cache.get(key), None)
+            self.assertEqual(response_cache.get(other)['body'], 'c,d')
+            # The directory is only listed when it gets too large
+            listed = []
+            names = backend._names
+            backend._names = lambda: listed.append(1) or names()
+            for number in range(100):
+                response_cache.set(
+                    cache.get_response_cache_key('project_info',
+                                                 {'projectid': 'Q'},
+                                                 number),
+                    {'content_type': 'text/csv', 'body': 'x' * 100})
+            self.failUnless(0 < len(listed) < 25, len(listed))
+            self.failUnless(sum(os.path.getsize(os.path.join(directory, n))
+                                for n in names()) <= 10000)
+            self.assertEqual(backend._size,
+                             sum(os.path.getsize(os.path.join(directory, n))
+                                 for n in names()))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_memory_backend_invalidate(self):
+        response_cache = cache.ResponseCache(cache.MemoryBackend())
+        keys = [cache.get_response_cache_key('project_info',
+                                             {'projectid': projectid},
+                                             'text/csv')
+                for projectid in ('P', 'Q')]
+        for key in keys:
+            response_cache.set(key, {'content_type': 'text/csv',
+                                     'body': 'a,b'})
+        response_cache.invalidate('P')
+        self.assertEqual(response_cache.get(keys[0]), None)
+        self.assertEqual(response_cache.get(keys[1])['body'], 'a,b')
+        response_cache.invalidate()
+        self.assertEqual(response_cache.backend.keys(), [])
+
 
 # make the test suite.
 def suite():
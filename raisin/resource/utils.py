@@ -1,8 +1,53 @@
 """Utility methods for descriptive titles, level information and aggregation"""
 
+import heapq
+import logging
+import calendar
+from functools import wraps
 from root import STATS_REGISTRY
-from raisin.mysqldb import run_method_using_mysqldb
 from restish import http
+from executor import get_executor
+from cache import TTLCache
+from reduction import add
+from reduction import sum_results
+from queries import fetch_all
+from queries import placeholders
+from queries import replicate_table
+from queries import rollup_table
+from instrumentation import timed
+from instrumentation import run_method_using_mysqldb
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# The project, experiment, replicate, lane and read hierarchy only changes
+# when new data is loaded by the pipeline.
+CONFIGURATIONS_CACHE = TTLCache(maxsize=256, ttl=600)
+
+# The last update times of the tables read by the resources. They are only
+# kept briefly, so that the Last-Modified dates follow new data soon.
+UPDATE_TIMES_CACHE = TTLCache(maxsize=256, ttl=60)
+
+# The vocabularies in the RNA dashboard databases change about once a month.
+DASHBOARD_CACHE = TTLCache(maxsize=32, ttl=3600)
+
+# Query the top rows of all configurations of a project in a single UNION ALL
+# query. This only works if the tables of all configurations exist, as one
+# missing table makes the query fail for the whole project.
+UNION_TOP_ROWS = False
+
+# The number of seconds to wait for the database of a project when querying
+# all projects, after which the project is left out
+PROJECT_TIMEOUT = 10
+
+# The batched methods whose sums per replicate are stored in the rollup
+# tables by the rollup module, by name
+ROLLUP_REGISTRY = {}
+
+# The name of the rows of the rollup tables holding the number of reads found
+ROLLUP_FOUND = ''
+
+# The levels at which resources registered with rollup=True read the rollups
+ROLLUP_LEVELS = ('project', 'experiment')
 
 
 def get_rna_extract_display_mapping(dbs):
@@ -10,15 +55,7 @@ def get_rna_extract_display_mapping(dbs):
     sql = """
 select ucscName, displayName
 from rnaExtract"""
-    dashboard_db = get_dashboard_db(dbs, 'hg19')
-    if dashboard_db is None:
-        return {}
-    cursor = dashboard_db.query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    mapping = {}
-    for row in rows:
-        mapping[row[0]] = row[1]
+    mapping = _get_display_mapping(dbs, 'rnaExtract', sql)
 
     # Add HBM project specific RNA Type, which is a ribosomal depleted RNA type
     if not 'RIBOFREE' in mapping:
@@ -33,16 +70,7 @@ def get_cell_display_mapping(dbs):
 select ucscName,
        displayName
 from cell"""
-    dashboard_db = get_dashboard_db(dbs, 'hg19')
-    if dashboard_db is None:
-        return {}
-    cursor = dashboard_db.query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    mapping = {}
-    for row in rows:
-        mapping[row[0]] = row[1]
-    return mapping
+    return _get_display_mapping(dbs, 'cell', sql)
 
 
 def get_localization_display_mapping(dbs):
@@ -50,16 +78,32 @@ def get_localization_display_mapping(dbs):
     sql = """
 select ucscName, displayName
 from localization"""
-    dashboard_db = get_dashboard_db(dbs, 'hg19')
-    if dashboard_db is None:
-        return {}
-    cursor = dashboard_db.query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
-    mapping = {}
-    for row in rows:
-        mapping[row[0]] = row[1]
-    return mapping
+    return _get_display_mapping(dbs, 'localization', sql)
+
+
+def _get_display_mapping(dbs, table, sql):
+    """Return the display mapping of a dashboard table.
+
+    The mapping is only queried if it is not found in the dashboard cache.
+    """
+    key = ('display_mapping', table)
+    mapping = DASHBOARD_CACHE.get(key)
+    if mapping is None:
+        dashboard_db = get_dashboard_db(dbs, 'hg19')
+        if dashboard_db is None:
+            return {}
+        rows = fetch_all(dashboard_db, sql)
+        mapping = {}
+        for row in rows:
+            mapping[row[0]] = row[1]
+        DASHBOARD_CACHE.set(key, mapping)
+    # Callers may add labels, so keep the cached mapping untouched
+    return dict(mapping)
+
+
+def refresh_dashboard_cache():
+    """Forget the cached dashboard labels and dashboard database lookups"""
+    DASHBOARD_CACHE.invalidate()
 
 
 def get_parameter_list(confs, separator='-'):
@@ -193,8 +237,12 @@ order by
     return order_by
 
 
-def get_experiment_where(confs, meta):
-    """Return experiment where clause"""
+def get_experiment_where(confs, meta, table=None):
+    """Return experiment where clause and the values for its arguments.
+
+    The columns are qualified with the name of the table if one is given,
+    as needed when the experiments are joined with other tables.
+    """
     projectid = meta['projectid']
     parameter_mapping = confs['request'].environ['parameter_mapping']
     parameter_columns = confs['request'].environ['parameter_columns']
@@ -203,15 +251,20 @@ def get_experiment_where(confs, meta):
     where = """where
 %s
 """
-    ands = ["project_id='%s'" % meta['projectid']]
+    prefix = ''
+    if not table is None:
+        prefix = table + '.'
+    ands = ["%sproject_id = %%s" % prefix]
+    args = [meta['projectid']]
     for parameter in parameter_mapping.get(projectid, parameter_labels.keys()):
         if parameter in parameter_list:
             # Take the parameter out of the parameter_values from the same
             # position as the parameter in the parameter_list.
             if parameter in meta:
                 key, value = parameter_columns[parameter], meta[parameter]
-                ands.append("%s = '%s'" % (key, value))
-    return where % ('\nand\n    '.join(ands))
+                ands.append("%s%s = %%s" % (prefix, key))
+                args.append(value)
+    return where % ('\nand\n    '.join(ands)), args
 
 
 def get_experiment_replicates(dbs, confs):
@@ -219,28 +272,85 @@ def get_experiment_replicates(dbs, confs):
     projectid = confs['kwargs']['projectid']
     if 'parameter_values' in confs['kwargs']:
         meta = get_experiment_dict(confs)
+        where, args = get_experiment_where(confs, meta)
         sql = """
     select experiment_id
     from experiments
     %s
     order by
-        experiment_id;""" % get_experiment_where(confs, meta)
-        cursor = dbs[projectid]['RNAseqPipelineCommon'].query(sql)
+        experiment_id;""" % where
     else:
         sql = """
     select experiment_id
     from experiments
-    where project_id = '%s'
+    where project_id = %s
     order by
-        experiment_id;""" % projectid
-        cursor = dbs[projectid]['RNAseqPipelineCommon'].query(sql)
+        experiment_id;"""
+        args = (projectid, )
 
-    rows = cursor.fetchall()
-    cursor.close()
+    rows = fetch_all(dbs[projectid]['RNAseqPipelineCommon'], sql, args)
     replicateids = [row[0] for row in rows]
     return replicateids
 
 
+def get_experiment_info(dbs, projectid, where, args):
+    """Return the information about the first replicate matching the where
+    clause, or None if there is none.
+
+    The replicate is queried together with its species, annotation and
+    genome in one query, and the dashboard labels are taken from the
+    dashboard cache.
+    """
+    sql = """
+select experiments.read_length,
+       experiments.mismatches,
+       experiments.exp_description,
+       experiments.expDate,
+       experiments.CellType,
+       experiments.RNAType,
+       experiments.Compartment,
+       experiments.Bioreplicate,
+       experiments.partition,
+       experiments.paired,
+       species_info.species,
+       annotation_files.version,
+       annotation_files.source,
+       genome_files.assembly,
+       genome_files.source,
+       genome_files.gender
+from experiments
+left join species_info
+    on experiments.species_id = species_info.species_id
+left join annotation_files
+    on experiments.annotation_id = annotation_files.annotation_id
+left join genome_files
+    on experiments.genome_id = genome_files.genome_id
+%s
+order by
+    experiments.experiment_id
+limit 1""" % where
+    rows = fetch_all(dbs[projectid]['RNAseqPipelineCommon'], sql, args)
+    if not rows:
+        return None
+    row = rows[0]
+    result = [int(row[0]), int(row[1]), row[2], str(row[3])]
+    # Use labels instead of the raw values
+    mapping = get_cell_display_mapping(dbs)
+    result.append(mapping.get(row[4], row[4]))
+    mapping = get_rna_extract_display_mapping(dbs)
+    result.append(mapping.get(row[5], row[5]))
+    mapping = get_localization_display_mapping(dbs)
+    result.append(mapping.get(row[6], row[6]))
+    result.append(row[7])
+    result.append(row[8])
+    paired = row[9]
+    if not paired is None:
+        paired = ord(paired)
+    result.append(paired)
+    result.extend(row[10:])
+    return result
+
+
 def get_level(replicateid, laneid, readid):
     """Return level"""
     level = {}
@@ -255,8 +365,13 @@ def get_level(replicateid, laneid, readid):
     return level
 
 
-def configurations_for_level(request, dbs, configurations, level):
-    """Return configurations for level"""
+def configurations_for_level(request, dbs, configurations, level,
+                             errors=None):
+    """Return configurations for level
+
+    If a list is given for the errors, the configurations that could not be
+    expanded are appended to it.
+    """
     level_confs = []
     for kwargs in configurations:
         if level is None:
@@ -280,9 +395,85 @@ def configurations_for_level(request, dbs, configurations, level):
                 configuration = kwargs.copy()
                 configuration["%sid" % level] = item
                 level_confs.append(configuration)
+        elif not errors is None:
+            errors.append(kwargs)
     return level_confs
 
 
+def configurations_for_lanes_and_reads(dbs, configurations, errors=None):
+    """Return configurations for the lane and read levels in one step.
+
+    The lanes and reads are loaded with one query per replicate.
+
+    If a list is given for the errors, the configurations that could not be
+    expanded are appended to it.
+    """
+    level_confs = []
+    results = run_configurations(dbs, configurations, get_replicate_lane_reads)
+    for kwargs, items in zip(configurations, results):
+        if items == http.not_found:
+            log.warning("Can't find the lanes and reads of replicate %s "
+                        "of project %s", kwargs['replicateid'],
+                        kwargs['projectid'])
+            if not errors is None:
+                errors.append(kwargs)
+            continue
+        for laneid, readid in items:
+            configuration = kwargs.copy()
+            configuration['laneid'] = laneid
+            configuration['readid'] = readid
+            level_confs.append(configuration)
+    return level_confs
+
+
+def expand_configurations(request, dbs, kwargs, level_range):
+    """Return the configurations for all levels in the level range.
+
+    The expanded configurations are cached by project, so that repeated
+    requests for the same experiment do not walk the hierarchy again.
+    Expansions that failed for some configuration are not cached.
+    """
+    configurations = [kwargs.copy()]
+    if not level_range:
+        return configurations
+    key = (kwargs.get('projectid', None),
+           tuple(level_range),
+           tuple(sorted(kwargs.items())))
+    cached = CONFIGURATIONS_CACHE.get(key)
+    if cached is None:
+        errors = []
+        levels = list(level_range)
+        while levels:
+            configuration_level = levels.pop(0)
+            if configuration_level == 'lane' and levels == ['read']:
+                # Load the lanes together with their reads
+                levels.pop(0)
+                configurations = configurations_for_lanes_and_reads(
+                    dbs, configurations, errors)
+            else:
+                configurations = configurations_for_level(request,
+                                                          dbs,
+                                                          configurations,
+                                                          configuration_level,
+                                                          errors)
+        if errors:
+            return configurations
+        cached = configurations
+        CONFIGURATIONS_CACHE.set(key, cached)
+    # The configurations are updated by the methods, so hand out copies
+    return [conf.copy() for conf in cached]
+
+
+def invalidate_configurations(projectid=None):
+    """Forget the cached configurations of a project, or of all projects"""
+    if projectid is None:
+        CONFIGURATIONS_CACHE.invalidate()
+        UPDATE_TIMES_CACHE.invalidate()
+    else:
+        CONFIGURATIONS_CACHE.invalidate(lambda key: key[0] == projectid)
+        UPDATE_TIMES_CACHE.invalidate(lambda key: key[0] == projectid)
+
+
 def partition_configurations(configurations, level):
     """Return partition configurations"""
     part_id = '%sid' % level
@@ -296,6 +487,45 @@ def partition_configurations(configurations, level):
     return part_confs
 
 
+def pivot_partitions(points, partition_length):
+    """Return the rows of a chart with one column per partition.
+
+    The points are (index, x, y) tuples, where index is the position of the
+    partition. Each y value is put into the first row for x that has no
+    value for the partition yet, and a new row [x, None, ...] is added at the
+    end if there is none.
+    """
+    result = []
+    # The rows for each x value in the order in which they were added
+    rows_by_x = {}
+    # The number of rows for each x and partition that hold a value. They
+    # are always the first rows for x, so the count points to the free row.
+    filled = {}
+    for index, x, y in points:
+        rows = rows_by_x.setdefault(x, [])
+        position = filled.get((x, index), 0)
+        if position < len(rows):
+            rows[position][index + 1] = y
+        else:
+            line = [None] * partition_length
+            line[index] = y
+            line = [x] + line
+            rows.append(line)
+            result.append(line)
+        if not y is None:
+            filled[(x, index)] = position + 1
+    return result
+
+
+RESOLUTION_TITLES = {'project': 'Project Level',
+                     'experiment': 'Experiment Level',
+                     'replicate': 'Replicate Level',
+                     'lane': 'Lane Level',
+                     'read': 'Read Level',
+                     None: None,
+                     }
+
+
 def get_configurations(request, level, resolution, partition, dbs, **kwargs):
     """Return configurations"""
     level_titles = {'project': 'Project Id',
@@ -305,15 +535,7 @@ def get_configurations(request, level, resolution, partition, dbs, **kwargs):
                     'read': 'Read Id',
                     None: None,
                     }
-    resolution_titles = {'project': 'Project Level',
-                         'experiment': 'Experiment Level',
-                         'replicate': 'Replicate Level',
-                         'lane': 'Lane Level',
-                         'read': 'Read Level',
-                         None: None,
-                         }
     # Create the configuration partitions for this level
-    configurations = [kwargs.copy()]
     levels = [None, 'project', 'experiment', 'replicate', 'lane', 'read']
     partition_levels = {None: 'project',
                         'project': 'experiment',
@@ -323,11 +545,7 @@ def get_configurations(request, level, resolution, partition, dbs, **kwargs):
                         'read': 'read'}
     level_range = levels[levels.index(level) + 1:levels.index(resolution) + 1]
 
-    for configuration_level in level_range:
-        configurations = configurations_for_level(request,
-                                                  dbs,
-                                                  configurations,
-                                                  configuration_level)
+    configurations = expand_configurations(request, dbs, kwargs, level_range)
 
     if partition:
         if level_range == []:
@@ -344,7 +562,7 @@ def get_configurations(request, level, resolution, partition, dbs, **kwargs):
               },
               'resolution': {
                   'id': resolution,
-                  'title': resolution_titles[resolution],
+                  'title': RESOLUTION_TITLES[resolution],
               },
               'partition': partition,
               'partition_level': {
@@ -373,11 +591,11 @@ select project_id,
        paired
 from experiments
 where
-      project_id='%(projectid)s'
-""" % confs['kwargs']
-    cursor = dbs[projectid]['RNAseqPipelineCommon'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+      project_id = %s
+"""
+    rows = fetch_all(dbs[projectid]['RNAseqPipelineCommon'],
+                     sql,
+                     (projectid, ))
     results = {}
     for row in rows:
         if row in results:
@@ -410,13 +628,11 @@ def get_replicate_lanes(dbs, conf):
 select
     distinct pair_id
 from
-    %(projectid)s_%(replicateid)s_dataset
+    %s
 order by
     pair_id
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+""" % replicate_table(conf, 'dataset')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
     laneids = [r[0] for r in rows]
     return laneids
 
@@ -427,19 +643,143 @@ def get_lane_reads(dbs, conf):
 select distinct
     lane_id
 from
-    %(projectid)s_%(replicateid)s_dataset
+    %s
 where
-    pair_id = '%(laneid)s'
+    pair_id = %%s
 order by
     lane_id
-""" % conf
-    cursor = dbs[conf['projectid']]['RNAseqPipeline'].query(sql)
-    rows = cursor.fetchall()
-    cursor.close()
+""" % replicate_table(conf, 'dataset')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'],
+                     sql,
+                     (conf['laneid'], ))
     readids = [r[0] for r in rows]
     return readids
 
 
+def get_lane_name_rows(dbs, confs, tableid, columns, key='readid'):
+    """Return rows of a replicate table for all lane names in one query.
+
+    All configurations have to belong to the same replicate. The rows are
+    returned in a dictionary by lane name, keeping only the first row found
+    for each lane name.
+    """
+    conf = confs[0]
+    lane_names = [c[key] for c in confs]
+    sql = """
+select
+    LaneName,
+    %s
+from
+    %s
+where
+    LaneName in (%s)
+""" % (',\n    '.join(columns),
+       replicate_table(conf, tableid),
+       placeholders(lane_names))
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'],
+                     sql,
+                     lane_names)
+    result = {}
+    for row in rows:
+        if not row[0] in result:
+            result[row[0]] = row[1:]
+    return result
+
+
+def get_replicate_lane_reads(dbs, conf):
+    """Return the lanes of a replicate together with their reads"""
+    sql = """
+select distinct
+    pair_id,
+    lane_id
+from
+    %s
+order by
+    pair_id,
+    lane_id
+""" % replicate_table(conf, 'dataset')
+    rows = fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql)
+    return [(r[0], r[1]) for r in rows]
+
+
+def get_last_modified(dbs, confs):
+    """Return when the tables read for the configurations were last updated,
+    as seconds since the epoch, or None if this is not known.
+
+    These are the replicate tables of the configurations, or all tables of
+    the project database if there are no replicates, and all tables of the
+    common and RNA dashboard databases. The update times are taken from the
+    information_schema, using one query per database, and are kept in the
+    UPDATE_TIMES_CACHE.
+    """
+    configurations = confs['configurations']
+    if isinstance(configurations, dict):
+        configurations = sum(configurations.values(), [])
+    projects = {}
+    for conf in configurations + [confs['kwargs']]:
+        if 'projectid' in conf:
+            prefixes = projects.setdefault(conf['projectid'], set())
+            if 'replicateid' in conf:
+                prefixes.add('%(projectid)s_%(replicateid)s_' % conf)
+    if not projects:
+        return None
+    tables = []
+    for projectid, prefixes in sorted(projects.items()):
+        tables.append((projectid, 'RNAseqPipeline', tuple(sorted(prefixes))))
+        tables.append((projectid, 'RNAseqPipelineCommon', ()))
+    for dashboard_db in ('hg18_RNA_dashboard', 'hg19_RNA_dashboard'):
+        # The dashboard databases are shared by the projects
+        for projectid in sorted(dbs):
+            if dashboard_db in dbs[projectid]:
+                tables.append((projectid, dashboard_db, ()))
+                break
+    last_modified = None
+    for key in tables:
+        update_time = UPDATE_TIMES_CACHE.get(key)
+        if update_time is None:
+            projectid, database, prefixes = key
+            update_time, success = run(dbs,
+                                       _get_update_time,
+                                       {'projectid': projectid,
+                                        'database': database,
+                                        'prefixes': prefixes})
+            if not success or update_time is None:
+                # Without the update times of all tables nothing is known
+                return None
+            UPDATE_TIMES_CACHE.set(key, update_time)
+        last_modified = max(last_modified, update_time)
+    return last_modified
+
+
+def _get_update_time(dbs, conf):
+    """Query a database for the last update time of the tables starting
+    with the prefixes, or of all its tables if there are no prefixes"""
+    # The underscores in the prefixes must not be taken as wildcards
+    patterns = [prefix.replace('_', '\\_') + '%'
+                for prefix in conf['prefixes']]
+    where = ''
+    if patterns:
+        likes = ['table_name like %s'] * len(patterns)
+        where = """
+and
+    (%s)""" % '\n     or '.join(likes)
+    sql = """
+select
+    max(update_time)
+from
+    information_schema.tables
+where
+    table_schema = database()%s""" % where
+    rows = fetch_all(dbs[conf['projectid']][conf['database']],
+                     sql,
+                     patterns or None)
+    if not rows or rows[0][0] is None:
+        return None
+    # The update times are taken to be in UTC
+    return calendar.timegm(rows[0][0].timetuple())
+
+
+@timed('run')
 def run(dbs, method, conf):
     """Run a method running sql code.
 
@@ -457,32 +797,244 @@ def run(dbs, method, conf):
     return data, success
 
 
+def run_configurations(dbs, confs, method):
+    """Run a method running sql code for each of the configurations.
+
+    The queries are run by the current executor, but the results are always
+    returned in the order of the configurations.
+    """
+    def call(conf):
+        """Run the method for one configuration"""
+        return run_method_using_mysqldb(method, dbs, conf, http.not_found)
+    return get_executor().map(call, confs, group=lambda c: c['projectid'])
+
+
+def run_projects(dbs, method, timeout=None):
+    """Run a method running sql code once for every project.
+
+    The method is called with a configuration holding the project id, and
+    returns a list of rows. The projects are queried concurrently by the
+    current executor, and the rows of all projects are returned in one list.
+
+    Projects for which the method fails, or has not returned after the
+    timeout, by default PROJECT_TIMEOUT seconds, are left out.
+    """
+    if timeout is None:
+        timeout = PROJECT_TIMEOUT
+    projectids = dbs.keys()
+
+    def call(projectid):
+        """Run the method for one project"""
+        return run_method_using_mysqldb(method,
+                                        dbs,
+                                        {'projectid': projectid},
+                                        http.not_found)
+    results = get_executor().map(call,
+                                 projectids,
+                                 group=lambda p: p,
+                                 timeout=timeout,
+                                 default=http.not_found)
+    rows = []
+    for projectid, data in zip(projectids, results):
+        if data == http.not_found:
+            log.warning("Error running sql method for project %s",
+                        projectid)
+        else:
+            rows.extend(data)
+    return rows
+
+
+def run_batched(dbs, confs, method, timeout=None):
+    """Run a batched method running sql code for groups of configurations.
+
+    The configurations are grouped by replicate, and the method is called
+    once per group with the list of configurations of the replicate. It has
+    to return one result per configuration in the same order, using the
+    http.not_found marker for configurations it has no data for.
+
+    The results are returned in the order of the configurations. If a
+    timeout is given, the groups that have not returned after that many
+    seconds get the http.not_found marker.
+    """
+    groups = {}
+    keys = []
+    for index, conf in enumerate(confs):
+        key = (conf['projectid'], conf['replicateid'])
+        if key in groups:
+            groups[key].append(index)
+        else:
+            groups[key] = [index]
+            keys.append(key)
+
+    def call(key):
+        """Run the method for the configurations of one replicate"""
+        group = [confs[index] for index in groups[key]]
+        return run_method_using_mysqldb(method, dbs, group, http.not_found)
+
+    results = [None] * len(confs)
+    batches = get_executor().map(call,
+                                 keys,
+                                 group=lambda k: k[0],
+                                 timeout=timeout,
+                                 default=http.not_found)
+    for key, data in zip(keys, batches):
+        if data == http.not_found:
+            data = [http.not_found] * len(groups[key])
+        for index, item in zip(groups[key], data):
+            results[index] = item
+    return results
+
+
+@timed('aggregate')
 def aggregate(dbs, confs, method, strategy, **kwargs):
     """Aggregate results from multiple queries to the database using
     a strategy."""
-    stats = None
-    failed = 0
     for conf in confs:
         conf.update(kwargs)
-        data = run_method_using_mysqldb(method, dbs, conf, http.not_found)
+    return _aggregate_results(run_configurations(dbs, confs, method),
+                              strategy)
+
+
+@timed('aggregate_batched')
+def aggregate_batched(dbs, confs, method, strategy, **kwargs):
+    """Aggregate results from one query per replicate using a strategy.
+
+    The method is a batched method as expected by run_batched.
+    """
+    for conf in confs:
+        conf.update(kwargs)
+    return _aggregate_results(run_batched(dbs, confs, method), strategy)
+
+
+def _aggregate_results(results, strategy):
+    """Merge the results in order and count the missing ones.
+
+    Results that are added up are summed using the reduction module.
+    """
+    found = []
+    failed = 0
+    for data in results:
         if data == http.not_found:
             print "Can't aggregate because of missing data."
             failed = failed + 1
         else:
-            if stats is None:
-                stats = data
-            else:
-                stats = merge(stats, data, strategy=strategy)
+            found.append(data)
+    if strategy is add:
+        return sum_results(found), failed
+    stats = None
+    for data in found:
+        if stats is None:
+            stats = data
+        else:
+            stats = merge(stats, data, strategy=strategy)
     return stats, failed
 
 
+def register_rollup(method, **kwargs):
+    """Register a batched method whose sums are stored in the rollup tables.
+
+    The keyword arguments are those passed to aggregate_reads with it.
+    """
+    ROLLUP_REGISTRY[rollup_name(method, kwargs)] = (method, kwargs)
+
+
+def rollup_name(method, kwargs):
+    """Return the name under which the sums of a method are stored.
+
+    >>> rollup_name(rollup_name, {'tableid': 'genome_mapping'})
+    'rollup_name:tableid=genome_mapping'
+    """
+    parts = [method.__name__.lstrip('_')]
+    for key, value in sorted(kwargs.items()):
+        parts.append('%s=%s' % (key, value))
+    return ':'.join(parts)
+
+
+@timed('aggregate_reads')
+def aggregate_reads(dbs, confs, method, **kwargs):
+    """Sum up the results of a batched method over the reads.
+
+    Returns the sums and the number of reads found.
+
+    Configurations marked as rollup are replicates, see register_resource.
+    Their sums are read from the rollup table of the project, and those
+    missing from it are expanded to their reads and summed up as usual.
+    """
+    if not confs or not confs[0].get('rollup', False):
+        stats, failed = aggregate_batched(dbs, confs, method, add, **kwargs)
+        return stats, len(confs) - failed
+    name = rollup_name(method, kwargs)
+    results = []
+    found = 0
+    missing = []
+    projectids = []
+    for conf in confs:
+        if not conf['projectid'] in projectids:
+            projectids.append(conf['projectid'])
+    for projectid in projectids:
+        project_confs = [c for c in confs if c['projectid'] == projectid]
+        rows, success = run(dbs, _rollup_rows, {'projectid': projectid,
+                                                'name': name,
+                                                'confs': project_confs})
+        if not success:
+            rows = {}
+        for conf in project_confs:
+            if conf['replicateid'] in rows:
+                stats, reads = rows[conf['replicateid']]
+                if reads:
+                    results.append(stats)
+                found = found + reads
+            else:
+                conf = conf.copy()
+                del conf['rollup']
+                missing.append(conf)
+    if missing:
+        read_confs = configurations_for_lanes_and_reads(dbs, missing)
+        stats, failed = aggregate_batched(dbs, read_confs, method, add,
+                                          **kwargs)
+        if not stats is None:
+            results.append(stats)
+        found = found + len(read_confs) - failed
+    return sum_results(results), found
+
+
+def _rollup_rows(dbs, confs):
+    """Return the stored sums and number of reads by replicate"""
+    projectid = confs['projectid']
+    replicateids = [conf['replicateid'] for conf in confs['confs']]
+    sql = """
+select
+    replicateid,
+    name,
+    value
+from
+    %s
+where
+    statistic = %%s
+and
+    replicateid in (%s)
+""" % (rollup_table(projectid), placeholders(replicateids))
+    rows = fetch_all(dbs[projectid]['RNAseqPipeline'],
+                     sql,
+                     [confs['name']] + replicateids)
+    result = {}
+    for replicateid, name, value in rows:
+        stats = result.setdefault(replicateid, ({}, 0))[0]
+        if name == ROLLUP_FOUND:
+            result[replicateid] = (stats, int(value))
+        else:
+            stats[name] = int(value)
+    return result
+
+
+@timed('collect')
 def collect(dbs, confs, method, strategy, **kwargs):
     """Collect results from multiple queries to the database using
     a strategy."""
-    results = []
     for conf in confs:
         conf.update(kwargs)
-        data = run_method_using_mysqldb(method, dbs, conf, http.not_found)
+    results = []
+    for conf, data in zip(confs, run_configurations(dbs, confs, method)):
         if data == http.not_found:
             print "Can't collect because of missing data."
         else:
@@ -491,6 +1043,115 @@ def collect(dbs, confs, method, strategy, **kwargs):
     return results
 
 
+@timed('top_rows')
+def top_rows(dbs, confs, method, strategy, key, limit=20, select=None):
+    """Return the rows with the largest key over all configurations.
+
+    The method returns the rows of one configuration ordered by the key in
+    descending order, and the strategy builds the row of the chart from the
+    configuration and a returned row. The rows are returned in the same
+    order as when sorting all rows by the key and reversing them.
+
+    If UNION_TOP_ROWS is set and a select function is given, one query is
+    run per project instead of one per configuration. The select function
+    returns the select statement for a configuration and its arguments. It
+    has to return the rows of the chart, with the key in a column named
+    top_value.
+    """
+    if UNION_TOP_ROWS and not select is None:
+        return _union_top_rows(dbs, confs, select, key, limit)
+    rows = []
+    for conf, data in zip(confs, run_configurations(dbs, confs, method)):
+        if data == http.not_found:
+            print "Error running sql method."
+        else:
+            rows.append([strategy(conf, row) for row in data])
+    return merge_top_rows(rows, key, limit)
+
+
+def _union_top_rows(dbs, confs, select, key, limit):
+    """Return the top rows using one UNION ALL query per project"""
+    projects = []
+    for conf in confs:
+        if not projects or projects[-1]['projectid'] != conf['projectid']:
+            projects.append({'projectid': conf['projectid'],
+                             'confs': [],
+                             'select': select,
+                             'limit': limit,
+                             })
+        projects[-1]['confs'].append(conf)
+    rows = []
+    for data in run_configurations(dbs, projects, _union_top_rows_query):
+        if data == http.not_found:
+            print "Error running sql method."
+        else:
+            rows.append(data)
+    return merge_top_rows(rows, key, limit)
+
+
+def _union_top_rows_query(dbs, conf):
+    """Query the database for the top rows of all selects of a project"""
+    parts = []
+    args = []
+    for select_conf in conf['confs']:
+        sql, select_args = conf['select'](select_conf)
+        parts.append("""(%s
+order by
+    top_value desc
+limit %s)""" % (sql, conf['limit']))
+        args.extend(select_args)
+    sql = """%s
+order by
+    top_value desc
+limit %s""" % ("\nunion all\n".join(parts), conf['limit'])
+    return fetch_all(dbs[conf['projectid']]['RNAseqPipeline'], sql, args)
+
+
+class _Descending(object):
+    """Wrap a value so that larger values are sorted first"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def merge_top_rows(rows, key, limit=20):
+    """Merge lists of rows, returning the limit rows with the largest key.
+
+    The result is the same as sorting the concatenated lists by the key,
+    reversing them and keeping the first rows, so rows with the same key
+    appear in reverse order. Only the first rows of the lists are compared
+    until the limit is reached.
+    """
+    # Sorting the reversed rows in descending order keeps equal rows in
+    # reverse order. The rows are usually sorted already.
+    streams = [sorted(reversed(stream), key=key, reverse=True)
+               for stream in rows]
+    heap = []
+    for number, stream in enumerate(streams):
+        if stream:
+            # Rows of later lists come first when their keys are equal
+            heap.append((_Descending(key(stream[0])), -number, 0))
+    heapq.heapify(heap)
+    result = []
+    while heap and len(result) < limit:
+        _, number, position = heapq.heappop(heap)
+        stream = streams[-number]
+        result.append(stream[position])
+        position = position + 1
+        if position < len(stream):
+            entry = (_Descending(key(stream[position])), number, position)
+            heapq.heappush(heap, entry)
+    return result
+
+
 def merge(d_1, d_2, strategy=None):
     """
     http://stackoverflow.com/q/38987/203926
@@ -543,13 +1204,18 @@ class register_resource(object):
     - a lane with reads when partition is True
 
     - a lane aggregating the reads when partition is False
+
+    If rollup is True, the project and experiment levels are only expanded
+    down to the replicates, and aggregate_reads reads the sums of the
+    replicates from the rollup tables instead of the reads.
     """
     # pylint: disable-msg=C0103
     # This class is used as a decorator, so allow lower case name
 
-    def __init__(self, resolution, partition):
+    def __init__(self, resolution, partition, rollup=False):
         self.resolution = resolution
         self.partition = partition
+        self.rollup = rollup
 
     def __call__(self, wrapped=None):
         if not wrapped:
@@ -567,10 +1233,34 @@ class register_resource(object):
             else:
                 key = "%s_%s" % (level, wrapped.__name__)
             # Now store the new statistics level in the registry
-            value = (wrapped, level, self.resolution, self.partition)
+            if self.rollup and level in ROLLUP_LEVELS:
+                value = (_read_rollups(wrapped, self.resolution),
+                         level,
+                         'replicate',
+                         self.partition)
+            else:
+                value = (wrapped, level, self.resolution, self.partition)
             STATS_REGISTRY[key] = value
 
 
+def _read_rollups(method, resolution):
+    """Return the method called with the replicates marked as rollup"""
+    @wraps(method)
+    def wrapper(dbs, confs):
+        """Mark the configurations and restore the resolution of the
+        method, which is used in the titles"""
+        confs['resolution'] = {'id': resolution,
+                               'title': RESOLUTION_TITLES[resolution],
+                               }
+        configurations = confs['configurations']
+        if isinstance(configurations, dict):
+            configurations = sum(configurations.values(), [])
+        for conf in configurations:
+            conf['rollup'] = True
+        return method(dbs, confs)
+    return wrapper
+
+
 def get_dashboard_db(dbs, hgversion):
     """Get the dashboard database for this human genome version"""
     if hgversion == 'hg19':
@@ -579,11 +1269,17 @@ def get_dashboard_db(dbs, hgversion):
         dashboard_db = 'hg18_RNA_dashboard'
     else:
         raise AttributeError
+    # Reuse the project found by an earlier search, if it is still there
+    key = ('dashboard_db', dashboard_db)
+    projectid = DASHBOARD_CACHE.get(key)
+    if projectid in dbs and dashboard_db in dbs[projectid]:
+        return dbs[projectid][dashboard_db]
     # Search for the first matching db. This is done because we are not given
     # a specific project, and want to avoid hard-coding the project from which
     # to take the db
-    for project_dbs in dbs.values():
+    for projectid, project_dbs in dbs.items():
         if dashboard_db in project_dbs:
+            DASHBOARD_CACHE.set(key, projectid)
             return project_dbs[dashboard_db]
 
 
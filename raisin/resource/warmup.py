@@ -0,0 +1,332 @@
+"""Warming up the response cache after new data has been loaded
+
+The first request of a resource after a Grape run has finished, or after the
+cache has expired, runs all its queries. warm_up walks all projects,
+experiments, replicates and lanes, and requests every entry of the
+STATS_REGISTRY at the levels it is registered for, so that the responses are
+in the cache before anybody asks for them:
+
+    raisin-resource-warmup --database Demo_RNAseqPipeline \\
+                           --common-database Demo_RNAseqPipelineCommon \\
+                           --settings settings.json \\
+                           --cache-dir /var/cache/raisin Demo
+
+The web server has to keep its response cache in the same directory, by
+setting response_cache_dir in the WSGI environ, see get_response_cache in
+the cache module. The settings file holds the parameter_labels,
+parameter_columns and parameter_mapping the web server is configured with,
+as JSON. The parameter_mapping has to list the parameters of all projects
+warmed up, as otherwise their order is taken from the parameter_labels,
+which may differ from the order used by the web server.
+
+Streamed content types, like CSV, are never cached, so they are not worth
+warming up.
+"""
+
+import re
+import sys
+import time
+import threading
+import optparse
+
+try:
+    import simplejson as json
+except ImportError:
+    import json  # NOQA
+
+from restish import http
+import root
+from root import STATS_REGISTRY
+from executor import ThreadPoolExecutor
+from utils import run
+from utils import get_parameter_list
+from utils import get_replicate_lanes
+from utils import get_project_experiments
+from utils import get_experiment_replicates
+
+# The URL parameters of the levels of the statistics resources
+LEVEL_PARAMETERS = {'project': ['projectid'],
+                    'experiment': ['projectid',
+                                   'parameter_list',
+                                   'parameter_values'],
+                    'replicate': ['projectid', 'replicateid'],
+                    'lane': ['projectid', 'replicateid', 'laneid'],
+                    }
+
+# Valid values of the URL parameters, only used for finding the routes
+ROUTE_VALUES = {'projectid': 'P',
+                'parameter_list': 'cell',
+                'parameter_values': 'K562',
+                'replicateid': 'R',
+                'laneid': 'L',
+                'hgversion': 'hg19',
+                }
+
+# The content types requested by default
+ACCEPT_TYPES = ['text/javascript']
+
+# The number of resources requested at the same time by default
+CONCURRENCY = 4
+
+# The versions of the RNA dashboard databases
+HGVERSIONS = ['hg18', 'hg19']
+
+
+def get_routes():
+    """Return the names of the URL parameters of each registry key.
+
+    The parameters of the resources of the root are taken from their URL
+    patterns, the ones of the statistics from their level. Keys that can't
+    be requested with any parameters are returned with None.
+    """
+    routed = {}
+    for function in vars(root.Root).values():
+        matcher = getattr(function, 'restish_child', None)
+        if matcher is None:
+            continue
+        names = re.findall(r'{(\w+)}', matcher.pattern)
+        if 'statid' in names:
+            continue
+        kwargs = dict((name, ROUTE_VALUES[name]) for name in names)
+        resource, _ = function(root.Root(), None, [], **kwargs)
+        if isinstance(resource, root.Resource):
+            routed[resource.key] = names
+    routes = {}
+    for key, (_, level, _, _) in STATS_REGISTRY.items():
+        if key in routed:
+            routes[key] = routed[key]
+        elif level == 'project' and key[len('project_'):] in routed:
+            # The same method registered at the project level
+            routes[key] = routed[key[len('project_'):]]
+        elif level in LEVEL_PARAMETERS:
+            routes[key] = LEVEL_PARAMETERS[level]
+        else:
+            # There is no URL parameter for the read level
+            routes[key] = None
+    return routes
+
+
+def get_entities(dbs, environ, projectids=None):
+    """Return the URL parameters of all projects, experiments, replicates
+    and lanes, by level.
+
+    The entities that can't be found are left out.
+    """
+    request = http.Request.blank('/')
+    request.environ.update(environ)
+    if projectids is None:
+        projectids = sorted(dbs)
+    entities = {'project': [], 'experiment': [], 'replicate': [], 'lane': []}
+    for projectid in projectids:
+        project = {'projectid': projectid}
+        entities['project'].append(project)
+        confs = {'kwargs': project, 'request': request}
+        parameter_list = get_parameter_list(confs)
+        experiments, success = run(dbs, get_project_experiments, confs)
+        if success:
+            for parameter_values in experiments:
+                entities['experiment'].append(
+                    {'projectid': projectid,
+                     'parameter_list': parameter_list,
+                     'parameter_values': parameter_values})
+        replicateids, success = run(dbs, get_experiment_replicates, confs)
+        if not success:
+            continue
+        for replicateid in replicateids:
+            replicate = {'projectid': projectid, 'replicateid': replicateid}
+            entities['replicate'].append(replicate)
+            laneids, success = run(dbs, get_replicate_lanes, replicate)
+            if not success:
+                continue
+            for laneid in laneids:
+                entities['lane'].append({'projectid': projectid,
+                                         'replicateid': replicateid,
+                                         'laneid': laneid})
+    return entities
+
+
+def get_targets(dbs, entities, keys=None):
+    """Return the sorted (key, kwargs) pairs of the resources to request.
+
+    Each key is requested for all entities of the deepest level among its
+    URL parameters. The RNA dashboard resources are only requested for the
+    versions whose database is configured for the project.
+    """
+    routes = get_routes()
+    targets = set()
+    for key in routes:
+        names = routes[key]
+        if names is None or (not keys is None and not key in keys):
+            continue
+        if 'laneid' in names:
+            level = 'lane'
+        elif 'replicateid' in names:
+            level = 'replicate'
+        elif 'parameter_list' in names:
+            level = 'experiment'
+        elif 'projectid' in names:
+            level = 'project'
+        else:
+            targets.add((key, ()))
+            continue
+        for entity in entities[level]:
+            kwargs = [(name, entity[name]) for name in names
+                      if name != 'hgversion']
+            if not 'hgversion' in names:
+                targets.add((key, tuple(sorted(kwargs))))
+                continue
+            for hgversion in HGVERSIONS:
+                dashboard = '%s_RNA_dashboard' % hgversion
+                if dashboard in dbs.get(entity['projectid'], {}):
+                    targets.add((key, tuple(sorted(kwargs +
+                                                   [('hgversion',
+                                                     hgversion)]))))
+    return [(key, dict(kwargs)) for key, kwargs in sorted(targets)]
+
+
+def warm_up(environ, targets, accept_types=None, concurrency=CONCURRENCY,
+            progress=None):
+    """Request the resources of the targets in each content type, so that
+    their responses are cached.
+
+    At most concurrency resources are requested at the same time. After
+    each request, progress is called with the number of requests done, the
+    total number of requests and the result of the request, a dictionary
+    holding the key, kwargs, accept, status and seconds, and the error if
+    one was raised.
+
+    Returns the list of results.
+    """
+    if accept_types is None:
+        accept_types = ACCEPT_TYPES
+    requests = [(key, kwargs, accept)
+                for key, kwargs in targets
+                for accept in accept_types]
+    lock = threading.Lock()
+    done = [0]
+
+    def warm(item):
+        """Request one resource in one content type"""
+        key, kwargs, accept = item
+        result = {'key': key, 'kwargs': kwargs, 'accept': accept}
+        request = http.Request.blank('/')
+        request.environ.update(environ)
+        request.headers['Accept'] = accept
+        started = time.time()
+        try:
+            response = root.Resource(key, **kwargs)(request)
+            result['status'] = response.status_int
+        except Exception, err:  # pylint: disable-msg=W0703
+            result['status'] = 500
+            result['error'] = '%s: %s' % (err.__class__.__name__, err)
+        result['seconds'] = time.time() - started
+        if not progress is None:
+            lock.acquire()
+            try:
+                done[0] = done[0] + 1
+                progress(done[0], len(requests), result)
+            finally:
+                lock.release()
+        return result
+    return ThreadPoolExecutor(max_workers=concurrency).map(warm, requests)
+
+
+def print_progress(done, total, result):
+    """Print a line for each request"""
+    status = result['status']
+    if 'error' in result:
+        status = '%s %s' % (status, result['error'])
+    print "[%s/%s] %s %s %s %.2fs %s" % (done,
+                                         total,
+                                         result['key'],
+                                         '/'.join(value for _, value in
+                                                  sorted(result['kwargs']
+                                                         .items())),
+                                         result['accept'],
+                                         result['seconds'],
+                                         status)
+    sys.stdout.flush()
+
+
+def main(args=None):
+    """Warm up the response cache of the projects in a MySQL database"""
+    from raisin.mysqldb import DB
+    parser = optparse.OptionParser(usage="%prog [options] projectid ...")
+    parser.add_option('--server', default='localhost')
+    parser.add_option('--port', default='3306')
+    parser.add_option('--user', default='')
+    parser.add_option('--password', default='')
+    parser.add_option('--database',
+                      help="the RNAseqPipeline database of the projects")
+    parser.add_option('--common-database', dest='common_database',
+                      help="the RNAseqPipelineCommon database")
+    parser.add_option('--dashboard-database', action='append',
+                      dest='dashboard_databases', default=[],
+                      help="an RNA dashboard database, like "
+                           "hg19_RNA_dashboard, may be repeated")
+    parser.add_option('--settings',
+                      help="JSON file with the parameter_labels, "
+                           "parameter_columns and parameter_mapping")
+    parser.add_option('--cache-dir', dest='cache_dir',
+                      help="the directory of the response cache of the "
+                           "web server")
+    parser.add_option('--ttl', type='int', default=3600,
+                      help="seconds the responses are kept, as set with "
+                           "response_cache_ttl for the web server")
+    parser.add_option('--accept', action='append', dest='accept_types',
+                      help="content type to request, may be repeated")
+    parser.add_option('--key', action='append', dest='keys',
+                      help="registry key to request, may be repeated")
+    parser.add_option('--concurrency', type='int', default=CONCURRENCY,
+                      help="resources requested at the same time")
+    options, projectids = parser.parse_args(args)
+    if not projectids:
+        parser.error("no project given")
+    if not options.database or not options.common_database:
+        parser.error("--database and --common-database are required")
+    if not options.settings or not options.cache_dir:
+        parser.error("--settings and --cache-dir are required")
+    if options.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    settings = json.load(open(options.settings))
+    parameter_mapping = settings.get('parameter_mapping', {})
+    missing = [projectid for projectid in projectids
+               if not projectid in parameter_mapping]
+    if missing:
+        parser.error("no parameter_mapping in the settings for %s" %
+                     ', '.join(missing))
+    connection = {'server': options.server,
+                  'port': options.port,
+                  'user': options.user,
+                  'password': options.password,
+                  }
+    databases = {'RNAseqPipeline': DB(options.database, connection),
+                 'RNAseqPipelineCommon': DB(options.common_database,
+                                            connection),
+                 }
+    for name in options.dashboard_databases:
+        databases[name] = DB(name, connection)
+    dbs = dict((projectid, databases) for projectid in projectids)
+    environ = {'dbs': dbs,
+               'parameter_labels': settings['parameter_labels'],
+               'parameter_columns': settings['parameter_columns'],
+               'parameter_mapping': parameter_mapping,
+               'response_cache_dir': options.cache_dir,
+               'response_cache_ttl': options.ttl,
+               }
+    started = time.time()
+    entities = get_entities(dbs, environ, projectids)
+    targets = get_targets(dbs, entities, options.keys)
+    results = warm_up(environ, targets, options.accept_types,
+                      options.concurrency, print_progress)
+    failed = len([result for result in results if result['status'] != 200])
+    print "Requested %s resources in %.1fs, %s failed" % (len(results),
+                                                         time.time() - started,
+                                                         failed)
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -35,5 +35,9 @@ setup(name='raisin.resource',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      raisin-resource-benchmark = raisin.resource.benchmark:main
+      raisin-resource-rollup = raisin.resource.rollup:main
+      raisin-resource-warmup = raisin.resource.warmup:main
       """,
       )